@@ -1,18 +1,67 @@
-from .transport import (
-    publish_domain_event,
-    Subscriber,
-    Retry,
-    Publisher,
-)
+from typing import TYPE_CHECKING, Any, Dict, List
+import importlib
 
-from .replay import (
-    replay_event,
-    replay_all,
-    RETRY,
-    DISCARD,
-    LEAVE,
-)
+if TYPE_CHECKING:
+    from .publish import publish_domain_event
+    from .transport import (
+        Subscriber,
+        Retry,
+        BatchError,
+        Publisher,
+        PublishBatch,
+        PublisherPool,
+        get_publisher_pool,
+    )
+    from .replay import (
+        replay_event,
+        replay_all,
+        replay_queue,
+        ReplayStats,
+        scan,
+        EventFilter,
+        RETRY,
+        DISCARD,
+        LEAVE,
+    )
+    from .events import (
+        DomainEvent,
+    )
 
-from .events import (
-    DomainEvent,
-)
+# The public API and the modules defining it. Modules are imported on first
+# access, so that importing the package doesn't load pika and the subscriber
+# machinery in processes that only publish events.
+_exports: Dict[str, str] = {
+    'publish_domain_event': 'publish',
+    'Subscriber': 'transport',
+    'Retry': 'transport',
+    'BatchError': 'transport',
+    'Publisher': 'transport',
+    'PublishBatch': 'transport',
+    'PublisherPool': 'transport',
+    'get_publisher_pool': 'transport',
+    'replay_event': 'replay',
+    'replay_all': 'replay',
+    'replay_queue': 'replay',
+    'ReplayStats': 'replay',
+    'scan': 'replay',
+    'EventFilter': 'replay',
+    'RETRY': 'replay',
+    'DISCARD': 'replay',
+    'LEAVE': 'replay',
+    'DomainEvent': 'events',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name: str) -> Any:
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
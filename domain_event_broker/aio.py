@@ -0,0 +1,504 @@
+"""
+Publisher and subscriber for asyncio applications. They mirror the API of
+:py:class:`domain_event_broker.Publisher` and
+:py:class:`domain_event_broker.Subscriber` but never block the event loop.
+"""
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+import asyncio
+import logging
+from pika import URLParameters, spec
+from pika import channel, frame
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.exceptions import ChannelClosed, ConnectionClosed, NackError
+from .events import DomainEvent
+from .transport import (
+    Retry,
+    _delay_queue,
+    _is_delay_queue_declared,
+    _load_event,
+    _message,
+    _remember_delay_queue,
+    requires_broker,
+    )
+from . import memory, serializers, settings
+
+log = logging.getLogger(__name__)
+
+
+class AsyncTransport(object):
+    """
+    Base class for asyncio transports. The connection is opened by awaiting
+    ``connect`` or when it is needed first.
+    """
+
+    def __init__(self,
+                 connection_settings: Optional[str] = '',
+                 exchange: str = "domain-events",
+                 exchange_type: str = "topic",
+                 ):
+        if connection_settings == '':
+            connection_settings = settings.BROKER
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.connection_settings = connection_settings
+        self.connection: Optional[AsyncioConnection] = None
+        self.channel: Optional[channel.Channel] = None
+        # Futures of pending RPCs; failed when the channel is closed.
+        self.pending: Set[asyncio.Future] = set()
+
+    async def __aenter__(self) -> 'AsyncTransport':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.disconnect()
+
+    def _future(self) -> Tuple[asyncio.Future, Callable]:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.add(future)
+
+        def resolve(*args: Any) -> None:
+            self.pending.discard(future)
+            if not future.done():
+                future.set_result(args[0] if args else None)
+        return future, resolve
+
+    def _fail_pending(self, reason: Exception) -> None:
+        pending, self.pending = self.pending, set()
+        for future in pending:
+            if not future.done():
+                future.set_exception(reason)
+
+    def _on_channel_closed(self, channel: channel.Channel, reason: Exception) -> None:
+        log.debug("Channel closed: {}".format(reason))
+        self._fail_pending(reason)
+
+    def _on_connection_closed(self, connection: AsyncioConnection, reason: Exception) -> None:
+        log.debug("Connection closed: {}".format(reason))
+        self._fail_pending(reason)
+        self.connection = None
+        self.channel = None
+
+    @property
+    def is_connected(self) -> bool:
+        return (self.connection is not None and self.connection.is_open and
+                self.channel is not None and self.channel.is_open)
+
+    @requires_broker
+    async def connect(self) -> None:
+        """
+        Open connection and channel and declare the exchange.
+        """
+        if self.is_connected:
+            return
+        assert self.connection_settings is not None
+        if self.connection_settings.startswith(memory.SCHEME):
+            raise ValueError("The in-memory broker doesn't support asyncio")
+        opened, on_open = self._future()
+
+        def on_open_error(connection: AsyncioConnection, error: BaseException) -> None:
+            self.pending.discard(opened)
+            if not opened.done():
+                opened.set_exception(error)
+
+        connection = AsyncioConnection(
+            URLParameters(self.connection_settings),
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=asyncio.get_running_loop())
+        await opened
+        channel_opened, on_channel_open = self._future()
+        connection.channel(on_open_callback=on_channel_open)
+        channel = await channel_opened
+        channel.add_on_close_callback(self._on_channel_closed)
+        self.connection = connection
+        self.channel = channel
+        await self._setup_channel()
+
+    async def _setup_channel(self) -> None:
+        await self.call(
+            'exchange_declare',
+            exchange=self.exchange,
+            exchange_type=self.exchange_type,
+            durable=True,
+            auto_delete=False)
+
+    async def call(self, method_name: str, **kwargs: Any) -> Any:
+        """
+        Invoke a synchronous AMQP method on the channel and wait for the
+        broker's reply frame.
+        """
+        if self.channel is None:
+            raise Exception('Not connected to broker.')
+        future, callback = self._future()
+        getattr(self.channel, method_name)(callback=callback, **kwargs)
+        return await future
+
+    @requires_broker
+    async def disconnect(self) -> None:
+        """
+        Close the connection and wait until it is closed.
+        """
+        connection = self.connection
+        if connection is None or connection.is_closed:
+            return
+        closed = asyncio.get_running_loop().create_future()
+
+        def on_close(connection: AsyncioConnection, reason: Exception) -> None:
+            if not closed.done():
+                closed.set_result(None)
+
+        connection.add_on_close_callback(on_close)
+        if not connection.is_closing:
+            connection.close()
+        await closed
+
+
+class AsyncPublisher(AsyncTransport):
+    """
+    Publish messages with publisher confirms without blocking the event loop::
+
+        async with AsyncPublisher() as publisher:
+            await publisher.publish_event(DomainEvent('user.registered', data))
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.delivery_tag = 0
+        self.unconfirmed: Dict[int, asyncio.Future] = {}
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def _setup_channel(self) -> None:
+        await super()._setup_channel()
+        assert self.channel is not None
+        self.delivery_tag = 0
+        self.unconfirmed = {}
+        future, callback = self._future()
+        self.channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=callback)
+        await future
+
+    def _on_confirm(self, method_frame: frame.Method) -> None:
+        method = method_frame.method
+        success = isinstance(method, spec.Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            future = self.unconfirmed.pop(tag, None)
+            if future is not None and not future.done():
+                future.set_result(success)
+
+    def _on_channel_closed(self, channel: channel.Channel, reason: Exception) -> None:
+        super()._on_channel_closed(channel, reason)
+        unconfirmed, self.unconfirmed = self.unconfirmed, {}
+        for future in unconfirmed.values():
+            if not future.done():
+                future.set_result(False)
+
+    def _on_connection_closed(self, connection: AsyncioConnection, reason: Exception) -> None:
+        super()._on_connection_closed(connection, reason)
+        unconfirmed, self.unconfirmed = self.unconfirmed, {}
+        for future in unconfirmed.values():
+            if not future.done():
+                future.set_result(False)
+
+    async def _ensure_connected(self) -> None:
+        # Concurrent publishers must not open several connections.
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.is_connected:
+                await self.connect()
+
+    def _send(self,
+              message: Union[bytes, str],
+              routing_key: Optional[str],
+              content_type: Optional[str] = None,
+              ) -> asyncio.Future:
+        assert self.channel is not None
+        confirmed = asyncio.get_running_loop().create_future()
+        body, properties = _message(message, content_type)
+        self.channel.basic_publish(
+            exchange=self.exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=properties)
+        self.delivery_tag += 1
+        self.unconfirmed[self.delivery_tag] = confirmed
+        return confirmed
+
+    @requires_broker
+    async def publish(self,
+                      message: Union[bytes, str],
+                      routing_key: Optional[str] = None,
+                      content_type: Optional[str] = None,
+                      ) -> None:
+        """
+        Send as persistent message and wait for the broker's confirmation.
+
+        :raises pika.exceptions.NackError: if the broker rejected the message.
+        """
+        await self._ensure_connected()
+        if not await self._send(message, routing_key, content_type):
+            raise NackError([message])
+
+    async def publish_event(self, event: DomainEvent) -> DomainEvent:
+        """
+        Publish a ``DomainEvent`` and wait for the broker's confirmation.
+        """
+        body, content_type = serializers.dumps(event.event_data)
+        await self.publish(body, event.routing_key, content_type=content_type)
+        return event
+
+    async def publish_many(self, events: List[DomainEvent]) -> List[bool]:
+        """
+        Publish domain events without waiting for each confirmation in turn.
+
+        :return: One entry per event, ``True`` if the broker confirmed the
+            event and ``False`` otherwise.
+        :rtype: list
+        """
+        if self.connection_settings is None:
+            return [True] * len(events)
+        await self._ensure_connected()
+        confirmations = []
+        for event in events:
+            body, content_type = serializers.dumps(event.event_data)
+            confirmations.append(self._send(body, event.routing_key, content_type))
+        return list(await asyncio.gather(*confirmations))
+
+
+class AsyncSubscriber(AsyncTransport):
+    """
+    Asyncio counterpart of :py:class:`domain_event_broker.Subscriber`.
+    Handlers are coroutine functions. Up to ``concurrency`` events are
+    processed at the same time across all handlers of the subscriber::
+
+        async def send_welcome_mail(event):
+            ...
+
+        subscriber = AsyncSubscriber(concurrency=20)
+        await subscriber.register(send_welcome_mail, 'welcome-mail', ['user.registered'])
+        await subscriber.start_consuming()
+
+    :param int concurrency: Maximum number of handlers running concurrently.
+        This is also used as the prefetch count.
+    """
+
+    def __init__(self, *args: Any, concurrency: int = 10, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.tasks: Set[asyncio.Task] = set()
+        self.consumer_tags: List[str] = []
+        self.stopped: Optional[asyncio.Event] = None
+
+    async def _setup_channel(self) -> None:
+        await super()._setup_channel()
+        await self.call('basic_qos', prefetch_count=self.concurrency)
+
+    async def bind_routing_keys(self,
+                                exchange: str,
+                                queue_name: str,
+                                binding_keys: Union[List[str], Tuple[str]],
+                                ) -> None:
+        for binding_key in binding_keys:
+            await self.call(
+                'queue_bind',
+                exchange=exchange,
+                routing_key=binding_key,
+                queue=queue_name)
+
+    @requires_broker
+    async def register(self,
+                       handler: Callable[[DomainEvent], Awaitable[Any]],
+                       name: str,
+                       binding_keys: Union[List[str], Tuple[str]],
+                       dead_letter: bool = False,
+                       durable: bool = True,
+                       exclusive: bool = False,
+                       auto_delete: bool = False,
+                       max_retries: int = 0,
+                       ) -> None:
+        """
+        Register a coroutine function for one or more types of domain events.
+        The parameters are the same as for
+        :py:meth:`domain_event_broker.Subscriber.register`.
+        """
+        await self.connect()
+        assert self.channel is not None
+        retry_exchange = name + '-retry'
+        dead_letter_exchange = name + '-dlx'
+
+        arguments = {}
+        if dead_letter:
+            await self.call(
+                'exchange_declare',
+                exchange=dead_letter_exchange,
+                exchange_type=self.exchange_type)
+            await self.call('queue_declare', queue=name + '-dl', durable=True)
+            await self.bind_routing_keys(dead_letter_exchange, name + '-dl', binding_keys)
+            arguments["x-dead-letter-exchange"] = dead_letter_exchange
+
+        await self.call(
+            'queue_declare',
+            queue=name,
+            durable=durable,
+            exclusive=exclusive,
+            auto_delete=auto_delete,
+            arguments=arguments)
+        await self.bind_routing_keys(self.exchange, name, binding_keys)
+
+        await self.call(
+            'exchange_declare',
+            exchange=retry_exchange,
+            exchange_type=self.exchange_type)
+        await self.bind_routing_keys(retry_exchange, name, binding_keys)
+
+        callback = partial(
+            self._receive,
+            handler,
+            name,
+            retry_exchange,
+            max_retries)
+        consumer_tag = self.channel.basic_consume(queue=name, on_message_callback=callback)
+        self.consumer_tags.append(consumer_tag)
+
+    def _receive(self,
+                 handler: Callable[[DomainEvent], Awaitable[Any]],
+                 name: str,
+                 retry_exchange: str,
+                 max_retries: int,
+                 channel: channel.Channel,
+                 method: spec.Basic.Deliver,
+                 properties: spec.BasicProperties,
+                 body: bytes,
+                 ) -> None:
+        try:
+            event = _load_event(properties, body)
+        except Exception:
+            # We cannot parse the message; requeuing would not help.
+            channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+            log.exception("Failed to load message: %s", body)
+            return
+        log.debug("Received {}:{}".format(method.routing_key, event))
+        task = asyncio.ensure_future(self._call_event_handler(
+            handler, event, name, retry_exchange, max_retries,
+            channel, method, properties, body))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _call_event_handler(self,
+                                  handler: Callable[[DomainEvent], Awaitable[Any]],
+                                  event: DomainEvent,
+                                  name: str,
+                                  retry_exchange: str,
+                                  max_retries: int,
+                                  channel: channel.Channel,
+                                  method: spec.Basic.Deliver,
+                                  properties: spec.BasicProperties,
+                                  body: bytes,
+                                  ) -> None:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            try:
+                await handler(event)
+            except Retry as error:
+                if event.retries < max_retries:
+                    msg = "Retry ({retries}) consuming event {event} in {delay:.1f}s"
+                    log.info(msg.format(
+                        event=event,
+                        retries=event.retries,
+                        delay=error.delay))
+                    await self._retry_message(
+                        name, retry_exchange, method, properties, body, error.delay)
+                    channel.basic_ack(delivery_tag=method.delivery_tag)
+                else:
+                    msg = "Exceeded max retries ({}) for {} event".format(
+                        max_retries, event.routing_key)
+                    log.error(msg, exc_info=True, extra=event.event_data)
+                    channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+                log.exception("Event has been dead-lettered or discarded")
+            else:
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    async def _retry_message(self,
+                             name: str,
+                             retry_exchange: str,
+                             method: spec.Basic.Deliver,
+                             properties: spec.BasicProperties,
+                             body: bytes,
+                             delay: float,
+                             ) -> None:
+        assert self.channel is not None
+        delay_name, arguments = _delay_queue(name, retry_exchange, delay)
+        if not _is_delay_queue_declared(self.channel, delay_name):
+            await self.call('queue_declare', queue=delay_name, durable=True, arguments=arguments)
+            await self.call(
+                'exchange_declare',
+                exchange=delay_name,
+                durable=True,
+                auto_delete=True,
+                exchange_type='topic')
+            await self.call('queue_bind', exchange=delay_name, routing_key='#', queue=delay_name)
+            _remember_delay_queue(self.channel, delay_name, arguments)
+        self.channel.basic_publish(
+            exchange=delay_name,
+            routing_key=method.routing_key,
+            body=body,
+            properties=properties)
+
+    @requires_broker
+    async def stop_consuming(self) -> None:
+        """
+        Cancel all consumers, wait for running handlers and disconnect.
+        """
+        if self.stopped is not None:
+            self.stopped.set()
+        if self.is_connected:
+            for consumer_tag in self.consumer_tags:
+                try:
+                    await self.call('basic_cancel', consumer_tag=consumer_tag)
+                except (ChannelClosed, ConnectionClosed):
+                    break
+        self.consumer_tags = []
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.disconnect()
+
+    @requires_broker
+    async def start_consuming(self, timeout: Optional[float] = None) -> None:
+        """
+        Process events until ``stop_consuming`` is awaited or the connection
+        is lost. If timeout is given, the consumer will be stopped after the
+        specified number of seconds.
+        """
+        if self.connection is None or self.channel is None:
+            raise Exception('Not connected to broker.')
+        self.stopped = asyncio.Event()
+        closed = asyncio.get_running_loop().create_future()
+
+        def on_close(connection: AsyncioConnection, reason: Exception) -> None:
+            if not closed.done():
+                closed.set_exception(reason)
+
+        self.connection.add_on_close_callback(on_close)
+        stopped = asyncio.ensure_future(self.stopped.wait())
+        try:
+            done, _ = await asyncio.wait([stopped, closed], timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if closed in done and not self.stopped.is_set():
+                closed.result()
+        finally:
+            stopped.cancel()
+            if not closed.done():
+                closed.cancel()
+            await self.stop_consuming()
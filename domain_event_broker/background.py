@@ -0,0 +1,355 @@
+"""
+Publish domain events from a background thread so that publishing never
+blocks the caller. Enable it process-wide with ``settings.BACKGROUND = True``
+(``DOMAIN_EVENT_BROKER_BACKGROUND`` in Django) to make
+:py:func:`domain_event_broker.publish_domain_event` return immediately.
+"""
+from collections import deque
+from functools import partial
+from typing import Any, Callable, Deque, Dict, List, Optional
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+from .events import DomainEvent
+from .transport import CONNECTION_ERRORS, Publisher
+from . import serializers, settings
+
+try:
+    # Only importable in processes run by uWSGI
+    import uwsgi  # type: ignore
+except ImportError:  # pragma: no cover
+    uwsgi = None
+
+log = logging.getLogger(__name__)
+
+
+# Overflow policies when the buffer is full
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+RAISE = 'raise'
+
+
+class BufferFull(Exception):
+    """
+    Raised by :py:meth:`BackgroundPublisher.publish` if the buffer is full and
+    the overflow policy is ``RAISE`` (or ``BLOCK`` timed out).
+    """
+
+
+class BackgroundPublisher(object):
+    """
+    Buffer domain events in memory and publish them in batches with publisher
+    confirms from a dedicated IO thread.
+
+    Events the broker did not confirm are put back at the front of the buffer
+    and published again, up to ``max_attempts`` times, if the buffer has room
+    for them.
+
+    Events still buffered when the process exits are flushed by an ``atexit``
+    handler, and by the ``uwsgi.atexit`` hook under uWSGI. Other servers that
+    end worker processes without running ``atexit`` handlers, e.g. with
+    ``os._exit``, must call :py:func:`flush_background_publishers` from their
+    worker shutdown hook. Events are lost if the process is killed or the
+    flush times out.
+
+    A forked child starts with an empty buffer and its own IO thread.
+
+    :param str connection_settings: Specify the broker with an AMQP URL.
+    :param int max_size: Maximum number of buffered events.
+    :param str overflow: What to do when the buffer is full: ``BLOCK`` the
+        caller until there is room, ``DROP_OLDEST`` buffered event or
+        ``RAISE`` ``BufferFull``.
+    :param float block_timeout: Maximum number of seconds to block with
+        ``BLOCK`` before raising ``BufferFull``. Blocks indefinitely if
+        ``None``.
+    :param int batch_size: Maximum number of events per batch.
+    :param float retry_delay: Seconds to wait before reconnecting after the
+        connection to the broker was lost, and before publishing events again
+        that the broker did not confirm.
+    :param int max_attempts: Maximum number of times an event is published if
+        the broker doesn't confirm it.
+    """
+
+    def __init__(self,
+                 connection_settings: Optional[str] = '',
+                 max_size: int = 10000,
+                 overflow: str = BLOCK,
+                 block_timeout: Optional[float] = None,
+                 batch_size: int = 100,
+                 retry_delay: float = 1.0,
+                 max_attempts: int = 3,
+                 ):
+        if overflow not in (BLOCK, DROP_OLDEST, RAISE):
+            raise ValueError("Invalid overflow policy '{}'".format(overflow))
+        if connection_settings == '':
+            connection_settings = settings.BROKER
+        self.connection_settings = connection_settings
+        self.max_size = max_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.buffer: Deque[DomainEvent] = deque()
+        # Attempts to publish events that were not confirmed, by UUID
+        self.attempts: Dict[str, int] = {}
+        self.condition = threading.Condition()
+        # Number of events taken from the buffer but not yet confirmed
+        self.in_flight = 0
+        self.published = 0
+        self.dropped = 0
+        self.failed = 0
+        self.stopping = False
+        self.thread: Optional[threading.Thread] = None
+        self.pid = os.getpid()
+        _publisher_instances.add(self)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.buffer)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Counters for monitoring: events buffered, in flight, published,
+        dropped because of overflow and failed to publish.
+        """
+        with self.condition:
+            return {
+                'queue_depth': len(self.buffer),
+                'in_flight': self.in_flight,
+                'published': self.published,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+    def _reset(self) -> None:
+        # Runs in a freshly forked child. Threads don't survive a fork, and
+        # events buffered by the parent must not be published twice. Another
+        # thread of the parent might have held the lock of the condition at
+        # fork time, so it is replaced rather than reused.
+        self.condition = threading.Condition()
+        self.buffer = deque()
+        self.attempts = {}
+        self.in_flight = 0
+        self.stopping = False
+        self.thread = None
+        self.pid = os.getpid()
+
+    def _ensure_thread(self) -> None:
+        # Called with the condition held
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping = False
+            self.thread = threading.Thread(
+                target=self._run,
+                name='domain-event-publisher',
+                daemon=True)
+            self.thread.start()
+
+    def publish(self, event: DomainEvent) -> None:
+        """
+        Add a domain event to the buffer and return immediately.
+        """
+        with self.condition:
+            self._ensure_thread()
+            if len(self.buffer) >= self.max_size:
+                if self.overflow == DROP_OLDEST:
+                    dropped = self.buffer.popleft()
+                    self.dropped += 1
+                    log.warning("Publish buffer full, dropped {}".format(dropped))
+                elif self.overflow == RAISE:
+                    raise BufferFull("{} events buffered".format(len(self.buffer)))
+                elif not self.condition.wait_for(
+                        lambda: len(self.buffer) < self.max_size,
+                        timeout=self.block_timeout):
+                    raise BufferFull("{} events buffered".format(len(self.buffer)))
+            self.buffer.append(event)
+            self.condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until all buffered events have been published.
+
+        :return: ``False`` if events are still pending after ``timeout``.
+        :rtype: bool
+        """
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                return not self.buffer
+            return self.condition.wait_for(
+                lambda: not self.buffer and not self.in_flight,
+                timeout=timeout)
+
+    def stop(self, timeout: Optional[float] = None) -> bool:
+        """
+        Flush buffered events and stop the IO thread.
+
+        :return: ``False`` if events were still pending after ``timeout``.
+        :rtype: bool
+        """
+        flushed = self.flush(timeout)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+            thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        if not flushed:
+            log.error("{} buffered domain events were not published".format(len(self.buffer)))
+        return flushed
+
+    def _take_batch(self) -> List[DomainEvent]:
+        with self.condition:
+            self.condition.wait_for(lambda: self.buffer or self.stopping)
+            batch: List[DomainEvent] = []
+            while self.buffer and len(batch) < self.batch_size:
+                batch.append(self.buffer.popleft())
+            self.in_flight = len(batch)
+            # Wake up callers blocked on a full buffer
+            self.condition.notify_all()
+            return batch
+
+    def _done(self, batch: List[DomainEvent], results: List[bool], retry: bool = True) -> int:
+        # Count the results of a batch and put events that were not confirmed
+        # back into the buffer. Returns the number of events to retry.
+        with self.condition:
+            self.in_flight = 0
+            pending: List[DomainEvent] = []
+            failed = 0
+            for event, confirmed in zip(batch, results):
+                if confirmed:
+                    self.published += 1
+                    self.attempts.pop(event.uuid_string, None)
+                    continue
+                attempts = self.attempts.pop(event.uuid_string, 0) + 1
+                if not retry or attempts >= self.max_attempts:
+                    failed += 1
+                elif len(self.buffer) + len(pending) >= self.max_size:
+                    # Events to retry are the oldest ones in the buffer
+                    if self.overflow == DROP_OLDEST:
+                        self.dropped += 1
+                    else:
+                        failed += 1
+                else:
+                    self.attempts[event.uuid_string] = attempts
+                    pending.append(event)
+            self.buffer.extendleft(reversed(pending))
+            self.failed += failed
+            self.condition.notify_all()
+        if failed:
+            log.error("{} domain events were not confirmed by the broker".format(failed))
+        return len(pending)
+
+    def _run(self) -> None:
+        publisher: Optional[Publisher] = None
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            results: List[bool] = []
+            retry = True
+            while not results:
+                try:
+                    if publisher is None:
+                        publisher = Publisher(self.connection_settings)
+                    with publisher.publish_batch() as publish_batch:
+                        for event in batch:
+                            body, content_type = serializers.dumps(event.event_data)
+                            publish_batch.publish(body, event.routing_key, content_type=content_type)
+                    results = publish_batch.results
+                except CONNECTION_ERRORS:
+                    log.warning("Lost connection to broker, retrying in {}s".format(
+                        self.retry_delay), exc_info=True)
+                    publisher = None
+                    if self.stopping:
+                        results = [False] * len(batch)
+                    else:
+                        time.sleep(self.retry_delay)
+                except Exception:
+                    log.exception("Failed to publish domain events")
+                    results = [False] * len(batch)
+                    retry = False
+            if self._done(batch, results, retry) and not self.stopping:
+                log.warning("Domain events were not confirmed by the broker, retrying in {}s".format(
+                    self.retry_delay))
+                time.sleep(self.retry_delay)
+        if publisher is not None:
+            try:
+                publisher.disconnect()
+            except CONNECTION_ERRORS:
+                pass
+
+
+_publishers: Dict[Optional[str], BackgroundPublisher] = {}
+_publishers_lock = threading.Lock()
+# All background publishers, including ones not created by
+# ``get_background_publisher``, to reset them after a fork.
+_publisher_instances: 'weakref.WeakSet[BackgroundPublisher]' = weakref.WeakSet()
+
+#: Seconds to wait for buffered events to be published when the process exits
+FLUSH_TIMEOUT = 5.0
+
+
+def get_background_publisher(connection_settings: Optional[str] = '', **kwargs: Any) -> BackgroundPublisher:
+    """
+    Return the process-wide background publisher for the given broker. The
+    keyword arguments of ``BackgroundPublisher`` are only used when the
+    publisher is created.
+    """
+    if connection_settings == '':
+        connection_settings = settings.BROKER
+    with _publishers_lock:
+        publisher = _publishers.get(connection_settings)
+        if publisher is None:
+            publisher = BackgroundPublisher(connection_settings, **kwargs)
+            _publishers[connection_settings] = publisher
+    return publisher
+
+
+def flush_background_publishers(timeout: Optional[float] = None) -> bool:
+    """
+    Publish all buffered events and stop the background threads. It is
+    registered with ``atexit`` and, under uWSGI, with ``uwsgi.atexit``. Other
+    servers that don't run ``atexit`` handlers must call it from their worker
+    shutdown hook, e.g. in the ``worker_exit`` hook of gunicorn::
+
+        def worker_exit(server, worker):
+            from domain_event_broker.background import flush_background_publishers
+            flush_background_publishers()
+    """
+    if timeout is None:
+        timeout = FLUSH_TIMEOUT
+    with _publishers_lock:
+        publishers = list(_publishers.values())
+    deadline = time.monotonic() + timeout
+    flushed = True
+    for publisher in publishers:
+        flushed = publisher.stop(max(0.0, deadline - time.monotonic())) and flushed
+    return flushed
+
+
+def _reset_background_publishers() -> None:
+    # Runs in a freshly forked child, see ``BackgroundPublisher._reset``
+    global _publishers_lock
+    _publishers_lock = threading.Lock()
+    for publisher in list(_publisher_instances):
+        publisher._reset()
+
+
+def _uwsgi_atexit(previous: Optional[Callable[[], Any]] = None) -> None:
+    flush_background_publishers()
+    if previous is not None:
+        previous()
+
+
+atexit.register(flush_background_publishers)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_background_publishers)
+
+if uwsgi is not None:
+    # uWSGI doesn't run ``atexit`` handlers of workers in all configurations,
+    # but calls ``uwsgi.atexit`` on shutdown. Keep a hook set by the app.
+    uwsgi.atexit = partial(_uwsgi_atexit, getattr(uwsgi, 'atexit', None))
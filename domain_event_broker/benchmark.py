@@ -0,0 +1,283 @@
+"""
+Benchmarks of the publish, consume, retry and replay paths.
+
+Run them against the in-memory broker or a RabbitMQ instance::
+
+    python -m domain_event_broker.benchmark
+    python -m domain_event_broker.benchmark --broker amqp://localhost --output results.json
+
+Every benchmark reports the throughput in events per second and, where it
+applies, the 50th and 99th percentile of the latency in milliseconds. With
+``--output``, the results are written as JSON for tracking them over time.
+The benchmarks create queues prefixed with ``benchmark-`` and delete them
+afterwards.
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+import json
+import math
+import platform
+import sys
+import threading
+import time
+from pika import BasicProperties
+from .events import DomainEvent
+from .replay import replay_queue
+from .transport import Publisher, Retry, Subscriber, _load_event, publish_domain_event
+from . import serializers
+
+#: Payload of the events used by all benchmarks
+DATA = {'user_id': 1234, 'email': 'user@example.com', 'tags': ['benchmark'] * 10}
+
+ROUTING_KEY = 'benchmark.event'
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of ``values``, e.g. ``fraction=0.99``.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def result(name: str,
+           events: int,
+           seconds: float,
+           latencies: Optional[List[float]] = None,
+           **params: Any,
+           ) -> Dict[str, Any]:
+    """
+    One benchmark result. Latencies are given in seconds and reported in
+    milliseconds.
+    """
+    latencies = latencies or []
+    p50 = percentile(latencies, 0.5)
+    p99 = percentile(latencies, 0.99)
+    return {
+        'name': name,
+        'params': params,
+        'events': events,
+        'seconds': round(seconds, 6),
+        'events_per_second': round(events / seconds, 1) if seconds else None,
+        'p50_ms': None if p50 is None else round(p50 * 1000, 3),
+        'p99_ms': None if p99 is None else round(p99 * 1000, 3),
+    }
+
+
+def _delete_queues(broker: str, *names: str) -> None:
+    publisher = Publisher(broker)
+    assert publisher.channel is not None
+    for name in names:
+        publisher.channel.queue_delete(queue=name)
+    publisher.disconnect()
+
+
+def bench_decode(broker: str, events: int) -> List[Dict[str, Any]]:
+    # Decoding without a broker, as done for every received message
+    body, content_type = serializers.dumps(DomainEvent(ROUTING_KEY, DATA).event_data)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    properties = BasicProperties(content_type=content_type)
+    start = time.perf_counter()
+    for _ in range(events):
+        _load_event(properties, body)
+    return [result('decode', events, time.perf_counter() - start)]
+
+
+def bench_publish(broker: str, events: int) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    name = 'benchmark-publish'
+    subscriber = Subscriber(broker)
+    subscriber.register(lambda event: None, name, [ROUTING_KEY])
+    subscriber.disconnect()
+
+    publisher = Publisher(broker)
+    latencies: List[float] = []
+    start = time.perf_counter()
+    for _ in range(events):
+        sent = time.perf_counter()
+        body, content_type = serializers.dumps(DomainEvent(ROUTING_KEY, DATA).event_data)
+        publisher.publish(body, ROUTING_KEY, content_type=content_type)
+        latencies.append(time.perf_counter() - sent)
+    results.append(result('publish', events, time.perf_counter() - start, latencies))
+
+    # The public API, which publishes on pooled connections
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(events):
+        sent = time.perf_counter()
+        publish_domain_event(ROUTING_KEY, DATA, connection_settings=broker)
+        latencies.append(time.perf_counter() - sent)
+    results.append(result('publish_domain_event', events, time.perf_counter() - start, latencies))
+
+    for batch_size in (10, 100, 1000):
+        latencies = []
+        batches = max(1, events // batch_size)
+        start = time.perf_counter()
+        for _ in range(batches):
+            sent = time.perf_counter()
+            publisher.publish_many([DomainEvent(ROUTING_KEY, DATA) for _ in range(batch_size)])
+            latencies.append(time.perf_counter() - sent)
+        results.append(result('publish_batch', batches * batch_size, time.perf_counter() - start,
+                              latencies, batch_size=batch_size))
+    publisher.disconnect()
+    _delete_queues(broker, name)
+    return results
+
+
+def _subscriber(broker: str,
+                name: str,
+                events: int,
+                handle: Callable[[DomainEvent], bool],
+                **kwargs: Any,
+                ) -> Subscriber:
+    # A subscriber that stops consuming once ``handle`` returned True for
+    # ``events`` events. It drains, so ``start_consuming`` returns after the
+    # last events were acknowledged.
+    subscriber = Subscriber(broker, max_workers=kwargs.pop('max_workers', 1),
+                            prefetch_count=kwargs.pop('prefetch_count', None))
+    lock = threading.Lock()
+    done = [0]
+
+    def handler(event: DomainEvent) -> None:
+        finished = handle(event)
+        with lock:
+            done[0] += finished
+            if done[0] == events:
+                assert subscriber.connection is not None
+                subscriber.connection.add_callback_threadsafe(subscriber.drain)
+
+    subscriber.register(handler, name, [ROUTING_KEY], **kwargs)
+    return subscriber
+
+
+def bench_consume(broker: str, events: int) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    name = 'benchmark-consume'
+    for max_workers, prefetch_count in ((1, 1), (1, 100), (4, 100), (16, 1000)):
+        latencies: List[float] = []
+        lock = threading.Lock()
+
+        def handle(event: DomainEvent) -> bool:
+            with lock:
+                latencies.append(time.time() - event.timestamp)
+            return True
+
+        subscriber = _subscriber(broker, name, events, handle,
+                                 max_workers=max_workers, prefetch_count=prefetch_count)
+        publisher = Publisher(broker)
+        for offset in range(0, events, 1000):
+            publisher.publish_many([DomainEvent(ROUTING_KEY, DATA) for _ in range(min(1000, events - offset))])
+        publisher.disconnect()
+        # The end-to-end latency includes the wait in the queue
+        start = time.perf_counter()
+        subscriber.start_consuming()
+        results.append(result('consume', events, time.perf_counter() - start, latencies,
+                              max_workers=max_workers, prefetch_count=prefetch_count))
+        _delete_queues(broker, name)
+    return results
+
+
+def bench_retry(broker: str, events: int) -> List[Dict[str, Any]]:
+    name = 'benchmark-retry'
+    first_seen: Dict[str, float] = {}
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def handle(event: DomainEvent) -> bool:
+        with lock:
+            if event.retries == 0:
+                first_seen[event.uuid_string] = time.perf_counter()
+                raise Retry(0)
+            latencies.append(time.perf_counter() - first_seen[event.uuid_string])
+            return True
+
+    subscriber = _subscriber(broker, name, events, handle, max_retries=1, prefetch_count=100)
+    publisher = Publisher(broker)
+    for offset in range(0, events, 1000):
+        publisher.publish_many([DomainEvent(ROUTING_KEY, DATA) for _ in range(min(1000, events - offset))])
+    publisher.disconnect()
+    start = time.perf_counter()
+    subscriber.start_consuming()
+    elapsed = time.perf_counter() - start
+    _delete_queues(broker, name, name + '-delay-0')
+    return [result('retry', events, elapsed, latencies)]
+
+
+def bench_replay(broker: str, events: int) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    name = 'benchmark-replay'
+    for batch_size in (1, 100):
+        subscriber = Subscriber(broker)
+        subscriber.register(lambda event: None, name, [ROUTING_KEY], dead_letter=True)
+        subscriber.disconnect()
+        publisher = Publisher(broker)
+        assert publisher.channel is not None
+        body, content_type = serializers.dumps(DomainEvent(ROUTING_KEY, DATA).event_data)
+        for _ in range(events):
+            publisher.channel.basic_publish('', name + '-dl', body)
+        publisher.disconnect()
+        stats = replay_queue(name, connection_settings=broker, prefetch_count=batch_size, batch_size=batch_size)
+        results.append(result('replay', stats.retried, stats.elapsed, batch_size=batch_size))
+        _delete_queues(broker, name, name + '-dl')
+    return results
+
+
+BENCHMARKS: Dict[str, Callable[[str, int], List[Dict[str, Any]]]] = {
+    'decode': bench_decode,
+    'publish': bench_publish,
+    'consume': bench_consume,
+    'retry': bench_retry,
+    'replay': bench_replay,
+}
+
+
+def run(broker: str = 'memory://benchmark',
+        events: int = 10000,
+        names: Optional[List[str]] = None,
+        ) -> Dict[str, Any]:
+    """
+    Run the benchmarks given by ``names``, by default all of them.
+
+    :return: Environment information and the list of results.
+    :rtype: dict
+    """
+    results: List[Dict[str, Any]] = []
+    for name in names or list(BENCHMARKS):
+        results.extend(BENCHMARKS[name](broker, events))
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'broker': broker.split('://')[0],
+        'events': events,
+        'results': results,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = ArgumentParser(
+        prog='python -m domain_event_broker.benchmark',
+        description='Measure throughput and latency of publishing and consuming domain events.')
+    parser.add_argument('--broker', default='memory://benchmark', help='AMQP or memory:// URL of the broker.')
+    parser.add_argument('--events', type=int, default=10000, help='Number of events per benchmark.')
+    parser.add_argument(
+        '--only', action='append', choices=list(BENCHMARKS), dest='names',
+        help='Run only this benchmark. Can be given several times.')
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    options = parser.parse_args(argv)
+    report = run(options.broker, options.events, options.names)
+    for entry in report['results']:
+        params = ' '.join('{}={}'.format(key, value) for key, value in entry['params'].items())
+        sys.stdout.write('{:<22} {:<34} {:>10} events/s  p50 {:>9} ms  p99 {:>9} ms\n'.format(
+            entry['name'], params, *[str(entry[key]) for key in ('events_per_second', 'p50_ms', 'p99_ms')]))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
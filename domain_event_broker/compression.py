@@ -0,0 +1,147 @@
+"""
+Compression of large message bodies.
+
+Compression is enabled by setting ``settings.COMPRESSION`` to the name of a
+codec (``DOMAIN_EVENT_BROKER_COMPRESSION`` in Django). Message bodies of at
+least ``settings.COMPRESSION_THRESHOLD`` bytes are then compressed when they
+are published, and the codec is signalled in the ``content_encoding`` of the
+message. Subscribers and the replay functions decompress messages
+automatically, whatever codec they are configured with.
+
+``gzip`` and ``deflate`` are always available, ``zstd`` and ``lz4`` if the
+``zstandard`` or ``lz4`` package is installed.
+"""
+from typing import Dict, Optional, Tuple, Union
+import gzip
+import zlib
+from . import settings
+
+try:
+    import zstandard  # type: ignore
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame  # type: ignore
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+
+class Codec(object):
+    """
+    A compression algorithm. Subclass this and call :py:func:`register_codec`
+    to add a codec.
+    """
+
+    #: Value of ``content_encoding`` for compressed messages
+    name = ''
+
+    def compress(self, body: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, body: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+
+    def compress(self, body: bytes) -> bytes:
+        return gzip.compress(body, compresslevel=6)
+
+    def decompress(self, body: bytes) -> bytes:
+        return gzip.decompress(body)
+
+
+class DeflateCodec(Codec):
+    name = 'deflate'
+
+    def compress(self, body: bytes) -> bytes:
+        return zlib.compress(body, 6)
+
+    def decompress(self, body: bytes) -> bytes:
+        return zlib.decompress(body)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+
+    def compress(self, body: bytes) -> bytes:
+        return zstandard.ZstdCompressor().compress(body)
+
+    def decompress(self, body: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(body)
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+
+    def compress(self, body: bytes) -> bytes:
+        return lz4.frame.compress(body)
+
+    def decompress(self, body: bytes) -> bytes:
+        return lz4.frame.decompress(body)
+
+
+_codecs: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec) -> None:
+    """
+    Make a codec available for compression and decompression.
+    """
+    _codecs[codec.name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError("Unknown compression codec '{}'".format(name))
+
+
+def compress(body: Union[bytes, str],
+             codec: Optional[str] = None,
+             threshold: Optional[int] = None,
+             ) -> Tuple[Union[bytes, str], Optional[str]]:
+    """
+    Compress ``body`` if it is at least ``threshold`` bytes long. By default,
+    ``settings.COMPRESSION`` and ``settings.COMPRESSION_THRESHOLD`` are used.
+    The body is left as it is if compression doesn't make it smaller.
+
+    :return: The message body and its ``content_encoding``, which is ``None``
+        if the body was not compressed.
+    :rtype: tuple
+    """
+    if codec is None:
+        codec = settings.COMPRESSION
+    if not codec:
+        return body, None
+    if threshold is None:
+        threshold = settings.COMPRESSION_THRESHOLD
+    data = body.encode('utf-8') if isinstance(body, str) else body
+    if len(data) < threshold:
+        return body, None
+    compressed = get_codec(codec).compress(data)
+    if len(compressed) >= len(data):
+        return body, None
+    return compressed, codec
+
+
+def decompress(body: bytes, content_encoding: Optional[str] = None) -> bytes:
+    """
+    Decompress a message body according to its ``content_encoding``. Bodies
+    with an encoding that isn't a known codec, such as ``identity`` or a
+    character set, are returned unchanged.
+    """
+    if not content_encoding or content_encoding not in _codecs:
+        return body
+    return _codecs[content_encoding].decompress(body)
+
+
+register_codec(GzipCodec())
+register_codec(DeflateCodec())
+if zstandard is not None:
+    register_codec(ZstdCodec())
+if lz4 is not None:
+    register_codec(Lz4Codec())
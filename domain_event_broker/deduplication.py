@@ -0,0 +1,216 @@
+"""
+De-duplication of events on the consumer side.
+
+Events may be delivered more than once: after the subscriber reconnected,
+when they are replayed or when publishing was retried. Handlers registered
+with ``deduplicate`` skip events they already handled. Duplicates are
+acknowledged without calling the handler::
+
+    from domain_event_broker.deduplication import Deduplicator, SQLiteBackend
+
+    deduplicator = Deduplicator(SQLiteBackend('/var/lib/app/events.db'))
+    subscriber.register(send_mail, 'send-mail', ['user.registered'], deduplicate=deduplicator)
+
+Events are identified by the handler name and their ``uuid_string``. Each
+``Deduplicator`` keeps recently handled events in a bounded in-process
+cache. A shared backend makes handled events known to all processes of a
+handler and across restarts. An event is only remembered after the handler
+returned successfully, so retries and replays of failed events are handled
+again. Duplicates that are delivered while the first copy is still being
+handled are not detected.
+"""
+from collections import OrderedDict
+from typing import Any, Optional
+import logging
+import sqlite3
+import threading
+import time
+from .events import DomainEvent
+
+log = logging.getLogger(__name__)
+
+
+class DeduplicationBackend(object):
+    """
+    Storage of the keys of handled events. Backends are called from the worker
+    threads of the subscriber, so they must be threadsafe.
+    """
+
+    def contains(self, key: str) -> bool:
+        """
+        Whether ``key`` was added and did not expire yet.
+        """
+        raise NotImplementedError
+
+    def add(self, key: str, ttl: Optional[float]) -> None:
+        """
+        Store ``key`` for ``ttl`` seconds, or forever if ``ttl`` is ``None``.
+        """
+        raise NotImplementedError
+
+
+class MemoryBackend(DeduplicationBackend):
+    """
+    Keys in process memory. If more than ``max_size`` keys are stored, the
+    least recently used ones are dropped.
+
+    :param int max_size: Maximum number of keys.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.keys: 'OrderedDict[str, Optional[float]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def contains(self, key: str) -> bool:
+        with self.lock:
+            if key not in self.keys:
+                return False
+            expires = self.keys[key]
+            if expires is not None and expires <= time.monotonic():
+                del self.keys[key]
+                return False
+            self.keys.move_to_end(key)
+            return True
+
+    def add(self, key: str, ttl: Optional[float]) -> None:
+        with self.lock:
+            self.keys[key] = None if ttl is None else time.monotonic() + ttl
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+class SQLiteBackend(DeduplicationBackend):
+    """
+    Keys in an SQLite database file, shared by all processes on a host.
+
+    :param str path: Path of the database file. It is created if it doesn't
+        exist.
+    :param str table: Name of the table storing the keys.
+    :param int cleanup_interval: Delete expired keys after this many keys
+        were added.
+    """
+
+    def __init__(self, path: str, table: str = 'domain_event_keys', cleanup_interval: int = 1000):
+        self.table = table
+        self.cleanup_interval = cleanup_interval
+        self.added = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, expires REAL)'.format(table))
+
+    def contains(self, key: str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM {} WHERE key = ? AND (expires IS NULL OR expires > ?)'.format(self.table),
+                (key, time.time())).fetchone()
+        return row is not None
+
+    def add(self, key: str, ttl: Optional[float]) -> None:
+        # Wall clock time, the file is shared with other processes
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO {} (key, expires) VALUES (?, ?)'.format(self.table),
+                (key, None if ttl is None else now + ttl))
+            self.added += 1
+            if self.added % self.cleanup_interval == 0:
+                self.connection.execute('DELETE FROM {} WHERE expires <= ?'.format(self.table), (now,))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class RedisBackend(DeduplicationBackend):
+    """
+    Keys in Redis, shared by all processes of a handler. Works with any
+    client with the interface of ``redis.Redis``; only ``exists`` and ``set``
+    with the ``px`` argument are used.
+
+    :param client: Redis client, e.g. ``redis.Redis.from_url(...)``.
+    :param str prefix: Prepended to all keys.
+    """
+
+    def __init__(self, client: Any, prefix: str = 'domain-event:'):
+        self.client = client
+        self.prefix = prefix
+
+    def contains(self, key: str) -> bool:
+        return bool(self.client.exists(self.prefix + key))
+
+    def add(self, key: str, ttl: Optional[float]) -> None:
+        self.client.set(self.prefix + key, 1, px=None if ttl is None else max(1, int(ttl * 1000)))
+
+
+class Deduplicator(object):
+    """
+    Detects events that were already handled. Handled events are kept in an
+    in-process cache and, if given, a shared backend. Lookups are first
+    answered from the cache. If the backend fails, events are treated as new,
+    so they are rather handled twice than lost.
+
+    A deduplicator may be used by several handlers; their events are kept
+    apart by the handler name.
+
+    :param backend: Shared ``DeduplicationBackend``, e.g. ``SQLiteBackend``
+        or ``RedisBackend``.
+    :param int max_size: Maximum number of events in the in-process cache.
+    :param float ttl: Seconds an event is remembered. ``None`` remembers
+        events until they are dropped from the cache or backend.
+    """
+
+    def __init__(self,
+                 backend: Optional[DeduplicationBackend] = None,
+                 max_size: int = 10000,
+                 ttl: Optional[float] = 86400.0,
+                 ):
+        self.cache = MemoryBackend(max_size)
+        self.backend = backend
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        #: Number of duplicates detected
+        self.hits = 0
+        #: Number of events that were not handled before
+        self.misses = 0
+
+    @staticmethod
+    def key(name: str, event: DomainEvent) -> str:
+        return '{}:{}'.format(name, event.uuid_string)
+
+    def is_duplicate(self, name: str, event: DomainEvent) -> bool:
+        """
+        Whether the handler ``name`` already handled ``event``.
+        """
+        key = self.key(name, event)
+        duplicate = self.cache.contains(key)
+        if not duplicate and self.backend is not None:
+            try:
+                duplicate = self.backend.contains(key)
+            except Exception:
+                log.warning("Cannot look up event {} for de-duplication".format(event), exc_info=True)
+            if duplicate:
+                self.cache.add(key, self.ttl)
+        with self.lock:
+            if duplicate:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return duplicate
+
+    def remember(self, name: str, event: DomainEvent) -> None:
+        """
+        Record that the handler ``name`` handled ``event``.
+        """
+        key = self.key(name, event)
+        self.cache.add(key, self.ttl)
+        if self.backend is not None:
+            try:
+                self.backend.add(key, self.ttl)
+            except Exception:
+                log.warning("Cannot store event {} for de-duplication".format(event), exc_info=True)
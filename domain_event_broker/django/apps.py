@@ -12,3 +12,15 @@ class DomainEventsConfig(AppConfig):
     def ready(self) -> None:
         if hasattr(djsettings, 'DOMAIN_EVENT_BROKER'):
             settings.BROKER = djsettings.DOMAIN_EVENT_BROKER
+        if hasattr(djsettings, 'DOMAIN_EVENT_BROKER_BACKGROUND'):
+            settings.BACKGROUND = djsettings.DOMAIN_EVENT_BROKER_BACKGROUND
+        if settings.BACKGROUND:
+            # Install the hooks flushing buffered events on shutdown before
+            # the server starts workers.
+            from domain_event_broker import background  # noqa: F401
+        if hasattr(djsettings, 'DOMAIN_EVENT_BROKER_SERIALIZER'):
+            settings.SERIALIZER = djsettings.DOMAIN_EVENT_BROKER_SERIALIZER
+        if hasattr(djsettings, 'DOMAIN_EVENT_BROKER_COMPRESSION'):
+            settings.COMPRESSION = djsettings.DOMAIN_EVENT_BROKER_COMPRESSION
+        if hasattr(djsettings, 'DOMAIN_EVENT_BROKER_COMPRESSION_THRESHOLD'):
+            settings.COMPRESSION_THRESHOLD = djsettings.DOMAIN_EVENT_BROKER_COMPRESSION_THRESHOLD
@@ -0,0 +1,54 @@
+from typing import Any
+from django.core.management.base import BaseCommand
+
+from argparse import ArgumentParser
+from domain_event_broker.django import outbox
+from domain_event_broker.transport import CONFIRM_TIMEOUT
+
+
+class Command(BaseCommand):
+
+    help = "Publish domain events stored in the transactional outbox"
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=100,
+            help='Number of events read from the outbox and confirmed by the broker at once.',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            dest='interval',
+            default=1.0,
+            help='Seconds to wait before polling an empty outbox again.',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Drain the outbox once and exit.',
+        )
+        parser.add_argument(
+            '--confirm-timeout',
+            type=float,
+            dest='confirm_timeout',
+            default=CONFIRM_TIMEOUT,
+            help='Seconds to wait for the broker to confirm a batch. Unconfirmed '
+                 'events stay in the outbox.',
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options['once']:
+            total = 0
+            while True:
+                published = outbox.relay_outbox(options['batch_size'], confirm_timeout=options['confirm_timeout'])
+                total += published
+                if published < options['batch_size']:
+                    break
+            self.stdout.write("{} events published".format(total))
+        else:
+            outbox.run_relay(options['interval'], options['batch_size'], confirm_timeout=options['confirm_timeout'])
@@ -2,11 +2,13 @@ import json
 import select
 import sys
 
-from typing import Any, Optional
-from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from django.core.management.base import BaseCommand, CommandError
 
 from argparse import ArgumentParser
-from domain_event_broker import replay
+from pika import spec
+from domain_event_broker import compression, replay, serializers
 
 
 def input_timeout(timeout: int) -> Optional[str]:
@@ -14,6 +16,19 @@ def input_timeout(timeout: int) -> Optional[str]:
     return sys.stdin.readline().strip() if inp else None
 
 
+def parse_match(matches: List[str]) -> Dict[str, Any]:
+    criteria = {}
+    for match in matches:
+        path, sep, value = match.partition('=')
+        if not sep:
+            raise CommandError("--match expects PATH=VALUE, got '{}'".format(match))
+        try:
+            criteria[path] = json.loads(value)
+        except ValueError:
+            criteria[path] = value
+    return criteria
+
+
 class Command(BaseCommand):
 
     help = "Move dead-lettered event back into given subscriber queue"
@@ -34,9 +49,61 @@ class Command(BaseCommand):
             default=False,
             help='Ask for desired action for each event.',
         )
+        parser.add_argument(
+            '--parallel',
+            type=int,
+            dest='parallel',
+            default=1,
+            help='Number of queues replayed concurrently (requires --all).',
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            dest='rate',
+            default=None,
+            help='Maximum number of events replayed per second and queue.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=100,
+            help='Number of events confirmed and acknowledged at once.',
+        )
+        filters = parser.add_argument_group(
+            'filters',
+            'Scan the dead-letter queue and only act on matching events.')
+        filters.add_argument(
+            '--routing-key',
+            help='Shell-style pattern for the routing key, e.g. "user.*".')
+        filters.add_argument('--domain-object-id')
+        filters.add_argument(
+            '--since',
+            type=float,
+            help='Only events with a timestamp at or after this Unix time.')
+        filters.add_argument(
+            '--until',
+            type=float,
+            help='Only events with a timestamp before this Unix time.')
+        filters.add_argument(
+            '--match',
+            action='append',
+            default=[],
+            metavar='PATH=VALUE',
+            help='JSON path and expected value, e.g. data.country="DE".')
+        filters.add_argument(
+            '--action',
+            choices=[replay.RETRY, replay.DISCARD, replay.LEAVE],
+            default=replay.LEAVE,
+            help='Action for matching events. By default they are only listed.')
 
-    def interactive_filter(self, body: bytes, **kwargs: Any) -> str:
-        payload = json.loads(body)
+    def interactive_filter(self,
+                           body: bytes,
+                           header: Optional[spec.BasicProperties] = None,
+                           **kwargs: Any) -> str:
+        if header is not None:
+            body = compression.decompress(body, header.content_encoding)
+        payload = serializers.loads(body, header.content_type if header is not None else None)
         self.stdout.write("Please specify action for:")
         self.stdout.write(json.dumps(payload, indent=4, sort_keys=True))
         self.stdout.write("(R)eplay, (D)iscard or (L)eave?")
@@ -64,13 +131,64 @@ class Command(BaseCommand):
         self.stdout.flush()
         return return_value
 
-    def handle(self, *args: Any, **options: Any) -> None:
+    def replay_queue(self, queue_name: str, **options: Any) -> replay.ReplayStats:
+        # ``options`` holds the list of all queues as 'queue'
         callback = replay.retry_event
         if options['interactive']:
             callback = self.interactive_filter
+            # Don't hold many events while waiting for user input
+            options['batch_size'] = 1
+        return replay.replay_queue(
+            queue_name,
+            callback,
+            prefetch_count=options['batch_size'],
+            batch_size=options['batch_size'],
+            rate=options['rate'],
+        )
+
+    def scan(self, **options: Any) -> None:
+        event_filter = replay.EventFilter(
+            routing_key=options['routing_key'],
+            domain_object_id=options['domain_object_id'],
+            since=options['since'],
+            until=options['until'],
+            match=parse_match(options['match']),
+        )
         for queue in options['queue']:
-            if options['replay_all']:
-                remaining = replay.replay_all(queue, callback)
-            else:
+            matches = 0
+            events = replay.scan(
+                queue, event_filter, action=options['action'],
+                prefetch_count=options['batch_size'])
+            for event in events:
+                matches += 1
+                self.stdout.write(json.dumps(event.event_data, sort_keys=True))
+            self.stdout.write("{} matching events in {} ({})".format(matches, queue, options['action']))
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        filter_options = ['routing_key', 'domain_object_id', 'since', 'until', 'match']
+        if any(options[name] not in (None, []) for name in filter_options):
+            self.scan(**options)
+            return
+        if options['parallel'] < 1:
+            raise CommandError("--parallel must be at least 1")
+        if options['parallel'] > 1 and not options['replay_all']:
+            raise CommandError("--parallel requires --all")
+        if options['parallel'] > 1 and options['interactive']:
+            raise CommandError("--parallel can't be combined with --interactive")
+        if not options['replay_all']:
+            callback = replay.retry_event
+            if options['interactive']:
+                callback = self.interactive_filter
+            for queue in options['queue']:
                 remaining = replay.replay_event(queue, callback)
-            self.stdout.write("{} dead-lettered events remaining for {}".format(remaining, queue))
+                self.stdout.write("{} dead-lettered events remaining for {}".format(remaining, queue))
+            return
+        with ThreadPoolExecutor(max_workers=options['parallel']) as executor:
+            futures = [
+                executor.submit(self.replay_queue, queue, **options)
+                for queue in options['queue']]
+            for queue, future in zip(options['queue'], futures):
+                stats = future.result()
+                self.stdout.write("{} events replayed for {} in {:.1f}s ({:.1f}/s)".format(
+                    stats.retried, queue, stats.elapsed, stats.rate))
+                self.stdout.write("{} dead-lettered events remaining for {}".format(stats.remaining, queue))
@@ -0,0 +1,66 @@
+from typing import Any
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from argparse import ArgumentParser
+from domain_event_broker.supervisor import Supervisor
+
+
+class Command(BaseCommand):
+
+    help = "Consume domain events in several worker processes"
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            'setup',
+            help='Dotted path of a function that registers handlers on a Subscriber.',
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            dest='processes',
+            default=2,
+            help='Number of worker processes.',
+        )
+        parser.add_argument(
+            '--max-processes',
+            type=int,
+            dest='max_processes',
+            default=None,
+            help='Maximum number of worker processes when autoscaling.',
+        )
+        parser.add_argument(
+            '--queue',
+            action='append',
+            dest='queues',
+            default=[],
+            help='Queue polled for autoscaling. Can be given several times.',
+        )
+        parser.add_argument(
+            '--messages-per-process',
+            type=int,
+            dest='messages_per_process',
+            default=1000,
+            help='Number of waiting messages that justify one more worker.',
+        )
+        parser.add_argument(
+            '--max-workers',
+            type=int,
+            dest='max_workers',
+            default=1,
+            help='Number of threads per worker process.',
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        setup = import_string(options['setup'])
+        # Worker processes must not share database connections
+        connections.close_all()
+        Supervisor(
+            setup,
+            processes=options['processes'],
+            max_processes=options['max_processes'],
+            queues=options['queues'],
+            messages_per_process=options['messages_per_process'],
+            subscriber_kwargs={'max_workers': options['max_workers']},
+        ).run()
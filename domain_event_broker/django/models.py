@@ -0,0 +1,22 @@
+from django.db import models
+
+
+class OutboxEvent(models.Model):
+    """
+    A domain event waiting to be published. Events are written in the same
+    database transaction as the changes they describe and are published by
+    the outbox relay after the transaction has been committed.
+    """
+    id = models.BigAutoField(primary_key=True)
+    routing_key = models.CharField(max_length=255)
+    # Serialized event as it is sent to the broker
+    body = models.TextField()
+    # AMQP URL of the broker, empty for the broker of the relay
+    connection_settings = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self) -> str:
+        return "OutboxEvent({}, {})".format(self.id, self.routing_key)
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import json
+import logging
+import threading
+from django.db import close_old_connections, connection, transaction
+
+from domain_event_broker import DomainEvent, get_publisher_pool
+from domain_event_broker.serializers import JSON
+from domain_event_broker.transport import CONFIRM_TIMEOUT
+from .models import OutboxEvent
+from .transaction import _event_arguments
+
+log = logging.getLogger(__name__)
+
+
+def publish_to_outbox(*args: Any, **kwargs: Any) -> DomainEvent:
+    """
+    Store a domain event in the outbox table as part of the current database
+    transaction. Takes the same arguments as
+    :py:func:`domain_event_broker.publish_domain_event`. The event is
+    published to the broker given by ``connection_settings``, or the broker
+    of the relay if it is not given. If ``connection_settings`` is ``None``,
+    the event is not stored.
+    """
+    arguments, connection_settings = _event_arguments(args, kwargs)
+    event = DomainEvent(**arguments)
+    if connection_settings is None:
+        log.debug("No broker configured: event {} is not stored in the outbox.".format(event))
+        return event
+    OutboxEvent.objects.create(
+        routing_key=event.routing_key,
+        body=json.dumps(event.event_data),
+        connection_settings=connection_settings)
+    return event
+
+
+def relay_outbox(batch_size: int = 100,
+                 connection_settings: Optional[str] = '',
+                 confirm_timeout: Optional[float] = CONFIRM_TIMEOUT,
+                 ) -> int:
+    """
+    Publish up to ``batch_size`` events from the outbox with publisher
+    confirms and delete the ones confirmed by the broker. Rows are locked
+    while they are published so that several relays can run concurrently on
+    databases that support ``SELECT ... FOR UPDATE SKIP LOCKED``.
+
+    :param str connection_settings: Broker of events stored without
+        ``connection_settings``. Defaults to the default broker.
+    :param float confirm_timeout: Maximum number of seconds to publish the
+        events of one broker. Events not confirmed in time stay in the outbox
+        and are published again later.
+    :return: The number of published events.
+    :rtype: int
+    """
+    with transaction.atomic():
+        events = OutboxEvent.objects.order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            events = events.select_for_update(skip_locked=True)
+        batch: List[OutboxEvent] = list(events[:batch_size])
+        if not batch:
+            return 0
+        by_broker: Dict[Optional[str], List[OutboxEvent]] = OrderedDict()
+        for event in batch:
+            by_broker.setdefault(event.connection_settings or connection_settings, []).append(event)
+        published: List[int] = []
+        for broker, broker_events in by_broker.items():
+            with get_publisher_pool(broker).acquire() as publisher:
+                with publisher.publish_batch(timeout=confirm_timeout) as publish_batch:
+                    for event in broker_events:
+                        publish_batch.publish(event.body, event.routing_key, content_type=JSON)
+            published.extend(event.id for event, ok in zip(broker_events, publish_batch.results) if ok)
+        OutboxEvent.objects.filter(id__in=published).delete()
+    if len(published) < len(batch):
+        log.warning("{} outbox events were not confirmed by the broker".format(
+            len(batch) - len(published)))
+    return len(published)
+
+
+def run_relay(interval: float = 1.0,
+              batch_size: int = 100,
+              connection_settings: Optional[str] = '',
+              stop: Optional[threading.Event] = None,
+              confirm_timeout: Optional[float] = CONFIRM_TIMEOUT,
+              ) -> None:
+    """
+    Drain the outbox until ``stop`` is set. The outbox is polled every
+    ``interval`` seconds while it is empty. This can run in a management
+    command (``relay_domain_events``) or in a background thread.
+    """
+    if stop is None:
+        stop = threading.Event()
+    while not stop.is_set():
+        close_old_connections()
+        try:
+            published = relay_outbox(
+                batch_size, connection_settings=connection_settings, confirm_timeout=confirm_timeout)
+        except Exception:
+            log.exception("Failed to relay outbox events")
+            published = 0
+        if published < batch_size:
+            stop.wait(interval)
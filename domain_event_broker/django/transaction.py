@@ -1,6 +1,103 @@
-from typing import Any
+from collections import defaultdict
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+import inspect
+import logging
+from django.conf import settings as djsettings
 from django.db import transaction
-from domain_event_broker import publish_domain_event
+from domain_event_broker import DomainEvent, get_publisher_pool, publish_domain_event, settings
+
+log = logging.getLogger(__name__)
+
+_publish_signature = inspect.signature(publish_domain_event)
+
+
+def _event_arguments(args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    # Bind the arguments of ``publish_domain_event`` by name. Returns the
+    # arguments of the ``DomainEvent`` and the ``connection_settings``.
+    arguments = dict(_publish_signature.bind(*args, **kwargs).arguments)
+    connection_settings = arguments.pop('connection_settings', '')
+    return arguments, connection_settings
+
+
+class _PendingEvent(object):
+
+    def __init__(self, args: Tuple[Any, ...], kwargs: Dict[str, Any], savepoints: Tuple[Any, ...]):
+        self.args = args
+        self.kwargs = kwargs
+        # Savepoints active when the event was emitted. Django drops the
+        # commit hook of the event if one of them is rolled back.
+        self.savepoints = savepoints
+        # Whether an event emitted later is certain to be committed if this
+        # one is.
+        self.followed = False
+
+
+class _EventBatch(object):
+    """
+    Domain events emitted within one transaction. The commit hook of each
+    event adds it to the batch, and the batch is published by the last hook.
+
+    Django runs commit hooks in the order they were registered and drops the
+    hooks registered within a savepoint that is rolled back. An event emitted
+    later at the same or an outer savepoint level survives any rollback this
+    event survives, so its hook is certain to run later. The hook of an event
+    that is not followed by such an event publishes the batch. Without
+    savepoints that's the hook of the last event.
+    """
+
+    def __init__(self) -> None:
+        self.events: List[_PendingEvent] = []
+        # Events that are not followed yet
+        self.unfollowed: List[_PendingEvent] = []
+        self.done = False
+
+    def register(self, args: Tuple[Any, ...], kwargs: Dict[str, Any], savepoints: Tuple[Any, ...]) -> None:
+        event = _PendingEvent(args, kwargs, savepoints)
+        unfollowed = []
+        for earlier in self.unfollowed:
+            if earlier.savepoints[:len(savepoints)] == savepoints:
+                earlier.followed = True
+            else:
+                unfollowed.append(earlier)
+        unfollowed.append(event)
+        self.unfollowed = unfollowed
+        transaction.on_commit(partial(self.commit, event))
+
+    def commit(self, event: _PendingEvent) -> None:
+        # Runs as commit hook of ``event``
+        self.done = True
+        self.events.append(event)
+        if not event.followed:
+            events, self.events = self.events, []
+            _publish_events(events)
+
+
+def _publish_events(events: List[_PendingEvent]) -> None:
+    if len(events) == 1 or settings.BACKGROUND:
+        # Background publishing batches events on its own
+        for event in events:
+            publish_domain_event(*event.args, **event.kwargs)
+        return
+    by_broker: Dict[Optional[str], List[DomainEvent]] = defaultdict(list)
+    for event in events:
+        arguments, connection_settings = _event_arguments(event.args, event.kwargs)
+        by_broker[connection_settings].append(DomainEvent(**arguments))
+    for connection_settings, domain_events in by_broker.items():
+        with get_publisher_pool(connection_settings).acquire() as publisher:
+            results = publisher.publish_many(domain_events)
+        for domain_event, ok in zip(domain_events, results):
+            if not ok:
+                # Publish events the broker did not confirm one by one, which
+                # raises if the broker can't be reached.
+                log.warning("Domain event was not confirmed by the broker, retrying: {}".format(domain_event))
+                publish_domain_event(
+                    domain_event.routing_key,
+                    domain_event.data,
+                    domain_object_id=domain_event.domain_object_id,
+                    uuid_string=domain_event.uuid_string,
+                    timestamp=domain_event.timestamp,
+                    connection_settings=connection_settings)
 
 
 def publish_on_commit(*args: Any, **kwargs: Any) -> None:
@@ -9,11 +106,35 @@ def publish_on_commit(*args: Any, **kwargs: Any) -> None:
     there is no transaction, it'll be sent right away. If atomic blocks are
     nested, it will be sent when exiting the outermost atomic block.
 
+    All domain events emitted within a transaction are published together
+    over one connection with publisher confirms. Events the broker did not
+    confirm are published again one by one. Events emitted within a
+    savepoint that is rolled back are discarded.
+
+    If ``DOMAIN_EVENT_BROKER_OUTBOX`` is enabled in the Django settings, the
+    event is written to the outbox table within the transaction instead and
+    published by the ``relay_domain_events`` management command.
+
     More information can be found here:
 
     https://docs.djangoproject.com/en/dev/topics/db/transactions/#performing-actions-after-commit
     """
-    def publish() -> None:
-        publish_domain_event(*args, **kwargs)
+    if getattr(djsettings, 'DOMAIN_EVENT_BROKER_OUTBOX', False):
+        # Imported here because models can't be loaded before the app
+        # registry is ready.
+        from .outbox import publish_to_outbox
+        publish_to_outbox(*args, **kwargs)
+        return
+
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        transaction.on_commit(partial(publish_domain_event, *args, **kwargs))
+        return
 
-    transaction.on_commit(publish)
+    # Once a hook of the batch ran, the transaction was committed. Events of a
+    # transaction that was rolled back stay in the batch but never commit.
+    batch = getattr(connection, 'domain_event_batch', None)
+    if batch is None or batch.done:
+        batch = _EventBatch()
+        connection.domain_event_batch = batch
+    batch.register(args, kwargs, tuple(connection.savepoint_ids))
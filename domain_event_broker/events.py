@@ -1,7 +1,8 @@
 from datetime import datetime
 import json
-from typing import Dict, Optional, Union
+from typing import Any, Dict, Optional, Union
 from uuid import uuid4
+import time
 
 FACTOR = 10**6
 
@@ -14,6 +15,18 @@ def to_timestamp(dt: datetime, epoch: datetime = datetime(1970, 1, 1)) -> float:
 
 class DomainEvent(object):
 
+    # Domain events are buffered in large numbers by publishers and
+    # consumers; without an instance dict they take a fraction of the memory.
+    __slots__ = (
+        'routing_key',
+        'data',
+        'domain_object_id',
+        'uuid_string',
+        'timestamp',
+        'retries',
+        '_event_data',
+    )
+
     def __init__(self,
                  routing_key: str = "",
                  data: Dict = {},
@@ -41,16 +54,32 @@ class DomainEvent(object):
         self.routing_key = routing_key
         self.data = data
         self.domain_object_id = domain_object_id
-        self.uuid_string = uuid_string
         if uuid_string is None:
-            self.uuid_string = str(uuid4())
-        self.timestamp = timestamp
+            uuid_string = str(uuid4())
+        self.uuid_string = uuid_string
         if timestamp is None:
-            timestamp = to_timestamp(datetime.utcnow())
-            self.timestamp = timestamp
-        event_data = self.__dict__.copy()
-        self.event_data = event_data
+            # Same value as to_timestamp(datetime.utcnow()), without the
+            # datetime arithmetic.
+            timestamp = round(time.time(), 6)
+        self.timestamp = timestamp
         self.retries = retries
+        self._event_data: Optional[Dict[str, Any]] = None
+
+    @property
+    def event_data(self) -> Dict[str, Any]:
+        """
+        The serializable representation of the event. It is built on first
+        access and cached; ``retries`` is not part of it.
+        """
+        if self._event_data is None:
+            self._event_data = {
+                'routing_key': self.routing_key,
+                'data': self.data,
+                'domain_object_id': self.domain_object_id,
+                'uuid_string': self.uuid_string,
+                'timestamp': self.timestamp,
+            }
+        return self._event_data
 
     @classmethod
     def from_json(cls, json_data: Union[bytes, str]) -> 'DomainEvent':
@@ -0,0 +1,925 @@
+"""
+An in-process broker for tests and benchmarks.
+
+Connect to it with a ``memory://`` URL, e.g. by setting
+``settings.BROKER = 'memory://'``. Publishers and subscribers of the same
+process then exchange messages without RabbitMQ::
+
+    subscriber = Subscriber('memory://')
+    subscriber.register(send_welcome_mail, 'welcome-mail', ['user.registered'])
+    publish_domain_event('user.registered', {}, connection_settings='memory://')
+    subscriber.start_consuming(timeout=0.1)
+
+The connections and channels mimic the subset of pika's
+``BlockingConnection`` and ``BlockingChannel`` used by this package:
+
+* direct, fanout and topic exchanges with ``*`` and ``#`` wildcards, and
+  the default exchange,
+* durable, exclusive and auto-delete queues with ``x-dead-letter-exchange``,
+  ``x-dead-letter-routing-key``, ``x-message-ttl``, ``x-expires`` and
+  per-message ``expiration``; dead-lettered messages get ``x-death``
+  headers like in RabbitMQ 3.5 and later,
+* ``basic_consume``, ``consume``, ``basic_get``, acknowledgements,
+  rejections, per-consumer prefetch, publisher confirms and transactions.
+
+Each host name in the URL is a separate broker, ``memory://`` and
+``memory://other`` don't share queues. Brokers live as long as the process;
+they are not shared with worker processes. Call :py:func:`reset` between
+tests to start from scratch. The asyncio transport is not supported.
+"""
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+import copy
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from pika import BasicProperties, frame, spec
+from pika.exceptions import (
+    ChannelClosedByBroker,
+    ChannelClosedByClient,
+    ChannelWrongStateError,
+    ConnectionClosedByClient,
+    ConnectionWrongStateError,
+    )
+
+SCHEME = 'memory://'
+
+# Maximum number of messages delivered per call of ``process_data_events``,
+# so that timers and callbacks are not starved by a long queue.
+MAX_DELIVERIES = 1000
+
+# Routing results cached per exchange before the cache is cleared
+ROUTE_CACHE_SIZE = 10000
+
+
+def topic_matches(binding_key: str, routing_key: str) -> bool:
+    """
+    Whether ``routing_key`` matches the binding key of a topic exchange. A
+    ``*`` matches exactly one word, a ``#`` zero or more words.
+    """
+    pattern = binding_key.split('.')
+    words = routing_key.split('.')
+    # Glob matching with backtracking to the last '#'
+    p = w = 0
+    hash_p, hash_w = -1, 0
+    while w < len(words):
+        if p < len(pattern) and pattern[p] == '#':
+            hash_p, hash_w = p, w
+            p += 1
+        elif p < len(pattern) and pattern[p] in ('*', words[w]):
+            p += 1
+            w += 1
+        elif hash_p >= 0:
+            hash_w += 1
+            p, w = hash_p + 1, hash_w
+        else:
+            return False
+    while p < len(pattern) and pattern[p] == '#':
+        p += 1
+    return p == len(pattern)
+
+
+def _not_found(kind: str, name: str) -> ChannelClosedByBroker:
+    return ChannelClosedByBroker(404, "NOT_FOUND - no {} '{}' in vhost '/'".format(kind, name))
+
+
+class _Message(object):
+    __slots__ = ('exchange', 'routing_key', 'body', 'properties', 'expires_at', 'redelivered')
+
+    def __init__(self,
+                 exchange: str,
+                 routing_key: str,
+                 body: bytes,
+                 properties: spec.BasicProperties,
+                 expires_at: Optional[float] = None,
+                 ):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.expires_at = expires_at
+        self.redelivered = False
+
+
+class _Exchange(object):
+
+    def __init__(self, name: str, exchange_type: str, durable: bool, auto_delete: bool):
+        self.name = name
+        self.type = exchange_type
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.bindings: List[Tuple[str, str]] = []
+        self.routes: Dict[str, List[str]] = {}
+
+    def bind(self, queue: str, routing_key: str) -> None:
+        if (routing_key, queue) not in self.bindings:
+            self.bindings.append((routing_key, queue))
+            self.routes.clear()
+
+    def unbind(self, queue: str, routing_key: Optional[str] = None) -> None:
+        self.bindings = [(key, name) for key, name in self.bindings
+                         if name != queue or (routing_key is not None and key != routing_key)]
+        self.routes.clear()
+
+    def route(self, routing_key: str) -> List[str]:
+        queues = self.routes.get(routing_key)
+        if queues is None:
+            if self.type == 'fanout':
+                matches = [queue for _, queue in self.bindings]
+            elif self.type == 'topic':
+                matches = [queue for key, queue in self.bindings if topic_matches(key, routing_key)]
+            else:
+                matches = [queue for key, queue in self.bindings if key == routing_key]
+            # A queue gets a message once, even if several bindings match
+            queues = list(OrderedDict.fromkeys(matches))
+            if len(self.routes) >= ROUTE_CACHE_SIZE:
+                self.routes.clear()
+            self.routes[routing_key] = queues
+        return queues
+
+
+class _Consumer(object):
+
+    def __init__(self,
+                 tag: str,
+                 queue: '_Queue',
+                 channel: 'MemoryChannel',
+                 callback: Callable,
+                 auto_ack: bool,
+                 prefetch_count: int,
+                 ):
+        self.tag = tag
+        self.queue = queue
+        self.channel = channel
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+        self.active = True
+
+    @property
+    def ready(self) -> bool:
+        if not self.queue.messages:
+            return False
+        if self.auto_ack:
+            return True
+        limit = self.channel.global_prefetch_count
+        if limit and len(self.channel.unacked) >= limit:
+            return False
+        return not self.prefetch_count or self.unacked < self.prefetch_count
+
+
+class _Queue(object):
+
+    def __init__(self,
+                 name: str,
+                 durable: bool,
+                 exclusive: Optional['MemoryConnection'],
+                 auto_delete: bool,
+                 arguments: Dict[str, Any],
+                 ):
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = arguments
+        self.messages: Deque[_Message] = deque()
+        self.consumers: List[_Consumer] = []
+        self.message_ttl = arguments.get('x-message-ttl')
+        expires = arguments.get('x-expires')
+        self.expires = None if expires is None else expires / 1000.0
+        self.last_used = time.monotonic()
+
+    def next_expiry(self) -> Optional[float]:
+        # Messages expire at the head of the queue only, like in RabbitMQ
+        deadlines = []
+        if self.messages and self.messages[0].expires_at is not None:
+            deadlines.append(self.messages[0].expires_at)
+        if self.expires is not None and not self.consumers:
+            deadlines.append(self.last_used + self.expires)
+        return min(deadlines) if deadlines else None
+
+
+class MemoryBroker(object):
+    """
+    Exchanges and queues shared by all connections to the same
+    ``memory://`` URL. All state is guarded by one lock.
+    """
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self.condition = threading.Condition(threading.RLock())
+        self.exchanges: Dict[str, _Exchange] = {}
+        self.queues: Dict[str, _Queue] = {}
+        # Queues with messages or the queue itself about to expire
+        self.expiring: Dict[str, _Queue] = {}
+
+    def queue(self, name: str) -> _Queue:
+        try:
+            return self.queues[name]
+        except KeyError:
+            raise _not_found('queue', name)
+
+    def publish(self,
+                exchange: str,
+                routing_key: str,
+                body: bytes,
+                properties: spec.BasicProperties,
+                ) -> int:
+        # Route a message and return the number of queues it was put in.
+        if exchange == '':
+            names = [routing_key] if routing_key in self.queues else []
+        else:
+            try:
+                names = self.exchanges[exchange].route(routing_key)
+            except KeyError:
+                raise _not_found('exchange', exchange)
+        now = time.monotonic()
+        for name in names:
+            queue = self.queues[name]
+            ttl = queue.message_ttl
+            if properties.expiration is not None:
+                expiration = int(properties.expiration)
+                ttl = expiration if ttl is None else min(ttl, expiration)
+            expires_at = None if ttl is None else now + ttl / 1000.0
+            queue.messages.append(_Message(exchange, routing_key, body, properties, expires_at))
+            if expires_at is not None:
+                self.expiring[name] = queue
+        if names:
+            self.condition.notify_all()
+        return len(names)
+
+    def dead_letter(self, queue: _Queue, message: _Message, reason: str) -> None:
+        exchange = queue.arguments.get('x-dead-letter-exchange')
+        if exchange is None:
+            return
+        routing_key = queue.arguments.get('x-dead-letter-routing-key', message.routing_key)
+        properties = copy.copy(message.properties)
+        headers = dict(properties.headers or {})
+        deaths = list(headers.get('x-death') or [])
+        for index, death in enumerate(deaths):
+            if death.get('queue') == queue.name and death.get('reason') == reason:
+                death = dict(death, count=death.get('count', 1) + 1)
+                del deaths[index]
+                break
+        else:
+            death = {
+                'count': 1,
+                'reason': reason,
+                'queue': queue.name,
+                'exchange': message.exchange,
+                'routing-keys': [message.routing_key],
+                }
+        death['time'] = int(time.time())
+        deaths.insert(0, death)
+        headers['x-death'] = deaths
+        headers.setdefault('x-first-death-reason', reason)
+        headers.setdefault('x-first-death-queue', queue.name)
+        headers.setdefault('x-first-death-exchange', message.exchange)
+        properties.headers = headers
+        properties.expiration = None
+        try:
+            self.publish(exchange, routing_key, message.body, properties)
+        except ChannelClosedByBroker:
+            # RabbitMQ drops messages for a missing dead-letter exchange
+            pass
+
+    def expire(self, now: float) -> None:
+        for name, queue in list(self.expiring.items()):
+            messages = queue.messages
+            while messages and messages[0].expires_at is not None and messages[0].expires_at <= now:
+                self.dead_letter(queue, messages.popleft(), 'expired')
+            if queue.expires is not None and not queue.consumers and queue.last_used + queue.expires <= now:
+                self.delete_queue(name)
+            elif queue.next_expiry() is None:
+                del self.expiring[name]
+
+    def next_expiry(self) -> Optional[float]:
+        deadlines = [deadline for deadline in (queue.next_expiry() for queue in self.expiring.values())
+                     if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def delete_queue(self, name: str) -> int:
+        queue = self.queues.pop(name, None)
+        if queue is None:
+            return 0
+        self.expiring.pop(name, None)
+        for consumer in queue.consumers:
+            consumer.active = False
+            consumer.channel.consumers.pop(consumer.tag, None)
+        for exchange in list(self.exchanges.values()):
+            bound = any(binding_queue == name for _, binding_queue in exchange.bindings)
+            if bound:
+                exchange.unbind(name)
+                if exchange.auto_delete and not exchange.bindings:
+                    del self.exchanges[exchange.name]
+        self.condition.notify_all()
+        return len(queue.messages)
+
+
+class _Timer(object):
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline: float, callback: Callable[[], Any]):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+
+class MemoryConnection(object):
+    """
+    Stand-in for pika's ``BlockingConnection``. Like the original, it must
+    only be used from one thread, except for ``add_callback_threadsafe``.
+    """
+
+    def __init__(self, broker: MemoryBroker):
+        self.broker = broker
+        self.is_open = True
+        self.channels: Dict[int, 'MemoryChannel'] = {}
+        self.channel_numbers = itertools.count(1)
+        self.callbacks: Deque[Callable[[], Any]] = deque()
+        self.timers: List[Tuple[float, int, _Timer]] = []
+        self.timer_sequence = itertools.count()
+
+    def __repr__(self) -> str:
+        return '<MemoryConnection {}{} open={}>'.format(SCHEME, self.broker.name, self.is_open)
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    def _check_open(self) -> None:
+        if not self.is_open:
+            raise ConnectionWrongStateError('Connection is closed.')
+
+    def channel(self, channel_number: Optional[int] = None) -> 'MemoryChannel':
+        self._check_open()
+        if channel_number is None:
+            channel_number = next(self.channel_numbers)
+        channel = MemoryChannel(self, channel_number)
+        self.channels[channel_number] = channel
+        return channel
+
+    def close(self, reply_code: int = 200, reply_text: str = 'Normal shutdown') -> None:
+        self._check_open()
+        reason = ConnectionClosedByClient(reply_code, reply_text)
+        for channel in list(self.channels.values()):
+            if channel.is_open:
+                channel._close(reason)
+        with self.broker.condition:
+            self.is_open = False
+            for name, queue in list(self.broker.queues.items()):
+                if queue.exclusive is self:
+                    self.broker.delete_queue(name)
+            self.broker.condition.notify_all()
+
+    def add_callback_threadsafe(self, callback: Callable[[], Any]) -> None:
+        with self.broker.condition:
+            self._check_open()
+            self.callbacks.append(callback)
+            self.broker.condition.notify_all()
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> _Timer:
+        self._check_open()
+        timer = _Timer(time.monotonic() + delay, callback)
+        heapq.heappush(self.timers, (timer.deadline, next(self.timer_sequence), timer))
+        return timer
+
+    def remove_timeout(self, timeout_id: _Timer) -> None:
+        timeout_id.cancelled = True
+
+    def sleep(self, duration: float) -> None:
+        deadline = time.monotonic() + duration
+        while self.is_open:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.process_data_events(time_limit=remaining)
+
+    def _collect(self) -> List[Tuple['MemoryChannel', _Consumer, _Message, int]]:
+        # Take deliveries for the consumers of this connection, one message
+        # per consumer and round, so that consumers of a queue take turns.
+        deliveries: List[Tuple['MemoryChannel', _Consumer, _Message, int]] = []
+        consumers = [consumer for channel in self.channels.values() if channel.is_open
+                     for consumer in channel.consumers.values()]
+        while consumers and len(deliveries) < MAX_DELIVERIES:
+            consumers = [consumer for consumer in consumers if consumer.ready]
+            for consumer in consumers:
+                # An earlier consumer of the same queue may have emptied it
+                if consumer.ready:
+                    message = consumer.queue.messages.popleft()
+                    delivery_tag = consumer.channel._track(consumer, consumer.queue, message)
+                    deliveries.append((consumer.channel, consumer, message, delivery_tag))
+        return deliveries
+
+    def _ready(self) -> bool:
+        return bool(self.callbacks) or any(
+            consumer.ready for channel in self.channels.values() if channel.is_open
+            for consumer in channel.consumers.values())
+
+    def _process(self) -> bool:
+        # Run one round of callbacks, timers and deliveries. Returns whether
+        # there was anything to do.
+        now = time.monotonic()
+        with self.broker.condition:
+            self.broker.expire(now)
+            callbacks = list(self.callbacks)
+            self.callbacks.clear()
+            deliveries = self._collect()
+        timers = []
+        while self.timers and self.timers[0][0] <= now:
+            timers.append(heapq.heappop(self.timers)[2])
+        # Nothing is dispatched anymore once a callback closed the connection
+        for callback in callbacks:
+            if self.is_open:
+                callback()
+        for timer in timers:
+            if self.is_open and not timer.cancelled:
+                timer.callback()
+        for channel, consumer, message, delivery_tag in deliveries:
+            if not channel.is_open:
+                # Closing the channel requeued the message
+                continue
+            if not consumer.active:
+                channel.basic_reject(delivery_tag, requeue=True)
+                continue
+            method = spec.Basic.Deliver(
+                consumer_tag=consumer.tag,
+                delivery_tag=delivery_tag,
+                redelivered=message.redelivered,
+                exchange=message.exchange,
+                routing_key=message.routing_key)
+            consumer.callback(channel, method, message.properties, message.body)
+        return bool(callbacks or timers or deliveries)
+
+    def process_data_events(self, time_limit: Optional[float] = 0) -> None:
+        """
+        Run due timers and callbacks and deliver messages. Waits up to
+        ``time_limit`` seconds, or indefinitely if it is ``None``, until
+        there is something to do.
+        """
+        self._check_open()
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        while True:
+            if self._process() or not self.is_open:
+                return
+            with self.broker.condition:
+                if self._ready():
+                    continue
+                wakeups = [deadline, self.broker.next_expiry()]
+                while self.timers and self.timers[0][2].cancelled:
+                    heapq.heappop(self.timers)
+                if self.timers:
+                    wakeups.append(self.timers[0][0])
+                wakeup = min([wakeup for wakeup in wakeups if wakeup is not None], default=None)
+                timeout = None if wakeup is None else wakeup - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    if wakeup == deadline:
+                        return
+                    continue
+                self.broker.condition.wait(timeout)
+
+
+class MemoryChannel(object):
+    """
+    Stand-in for pika's ``BlockingChannel``. Messages are routed while they
+    are published, so publisher confirms don't need to wait. In transaction
+    mode messages are held back until ``tx_commit``.
+    """
+
+    def __init__(self, connection: MemoryConnection, channel_number: int):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self.is_open = True
+        self.consumers: Dict[str, _Consumer] = OrderedDict()
+        self.unacked: Dict[int, Tuple[Optional[_Consumer], _Queue, _Message]] = OrderedDict()
+        self.delivery_tags = itertools.count(1)
+        self.prefetch_count = 0
+        self.global_prefetch_count = 0
+        self.confirms = False
+        # Messages of the open transaction, ``None`` outside transaction mode
+        self.transaction: Optional[List[Tuple[str, str, bytes, spec.BasicProperties]]] = None
+        # Messages received by ``consume``
+        self.buffer: Deque[Tuple[spec.Basic.Deliver, spec.BasicProperties, bytes]] = deque()
+        self.buffer_tag: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return '<MemoryChannel number={} open={}>'.format(self.channel_number, self.is_open)
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    @property
+    def consumer_tags(self) -> List[str]:
+        return list(self.consumers)
+
+    def _check_open(self) -> None:
+        if not self.is_open:
+            raise ChannelWrongStateError('Channel is closed.')
+
+    def _fail(self, error: ChannelClosedByBroker) -> ChannelClosedByBroker:
+        # Errors close the channel, like they do in RabbitMQ
+        self._close(error)
+        return error
+
+    def _close(self, reason: Exception) -> None:
+        with self.broker.condition:
+            for tag in list(self.consumers):
+                self._cancel(tag)
+            self._requeue(list(self.unacked))
+            self.is_open = False
+            self.connection.channels.pop(self.channel_number, None)
+
+    def close(self, reply_code: int = 0, reply_text: str = 'Normal shutdown') -> None:
+        self._check_open()
+        self._close(ChannelClosedByClient(reply_code, reply_text))
+
+    def _track(self, consumer: Optional[_Consumer], queue: _Queue, message: _Message) -> int:
+        # Remember an unacknowledged delivery; called with the lock held.
+        delivery_tag = next(self.delivery_tags)
+        queue.last_used = time.monotonic()
+        if consumer is not None and consumer.auto_ack:
+            return delivery_tag
+        if consumer is not None:
+            consumer.unacked += 1
+        self.unacked[delivery_tag] = (consumer, queue, message)
+        return delivery_tag
+
+    def _take(self, delivery_tag: int, multiple: bool) -> List[int]:
+        if multiple:
+            tags = [tag for tag in self.unacked if delivery_tag == 0 or tag <= delivery_tag]
+        elif delivery_tag in self.unacked:
+            tags = [delivery_tag]
+        else:
+            tags = []
+        if not tags and (delivery_tag or not multiple):
+            raise self._fail(ChannelClosedByBroker(
+                406, 'PRECONDITION_FAILED - unknown delivery tag {}'.format(delivery_tag)))
+        return tags
+
+    def _settle(self, tags: List[int]) -> List[Tuple[_Queue, _Message]]:
+        settled = []
+        for tag in tags:
+            consumer, queue, message = self.unacked.pop(tag)
+            if consumer is not None:
+                consumer.unacked -= 1
+            settled.append((queue, message))
+        # Freed prefetch capacity may allow further deliveries
+        self.broker.condition.notify_all()
+        return settled
+
+    def _requeue(self, tags: List[int]) -> None:
+        for queue, message in reversed(self._settle(tags)):
+            if queue.name in self.broker.queues:
+                message.redelivered = True
+                queue.messages.appendleft(message)
+
+    def _discard(self, tags: List[int]) -> None:
+        for queue, message in self._settle(tags):
+            self.broker.dead_letter(queue, message, 'rejected')
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False) -> None:
+        self._check_open()
+        with self.broker.condition:
+            self._settle(self._take(delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True) -> None:
+        self._check_open()
+        with self.broker.condition:
+            tags = self._take(delivery_tag, multiple)
+            if requeue:
+                self._requeue(tags)
+            else:
+                self._discard(tags)
+
+    def basic_reject(self, delivery_tag: int = 0, requeue: bool = True) -> None:
+        self.basic_nack(delivery_tag, multiple=False, requeue=requeue)
+
+    def basic_qos(self, prefetch_size: int = 0, prefetch_count: int = 0, global_qos: bool = False) -> None:
+        # Like in RabbitMQ, a per-consumer prefetch count applies to consumers
+        # started afterwards, a global one to all consumers of the channel.
+        self._check_open()
+        with self.broker.condition:
+            if global_qos:
+                self.global_prefetch_count = prefetch_count
+                self.broker.condition.notify_all()
+            else:
+                self.prefetch_count = prefetch_count
+
+    def exchange_declare(self,
+                         exchange: str,
+                         exchange_type: str = 'direct',
+                         passive: bool = False,
+                         durable: bool = False,
+                         auto_delete: bool = False,
+                         internal: bool = False,
+                         arguments: Optional[Dict[str, Any]] = None,
+                         ) -> frame.Method:
+        self._check_open()
+        exchange_type = getattr(exchange_type, 'value', exchange_type)
+        if exchange_type not in ('direct', 'fanout', 'topic'):
+            raise ValueError("Exchange type '{}' is not supported".format(exchange_type))
+        with self.broker.condition:
+            existing = self.broker.exchanges.get(exchange)
+            if existing is None:
+                if passive:
+                    raise self._fail(_not_found('exchange', exchange))
+                self.broker.exchanges[exchange] = _Exchange(exchange, exchange_type, durable, auto_delete)
+            elif not passive and (existing.type, existing.durable) != (exchange_type, durable):
+                raise self._fail(ChannelClosedByBroker(
+                    406, "PRECONDITION_FAILED - inequivalent arg for exchange '{}'".format(exchange)))
+        return frame.Method(self.channel_number, spec.Exchange.DeclareOk())
+
+    def exchange_delete(self, exchange: Optional[str] = None, if_unused: bool = False) -> frame.Method:
+        self._check_open()
+        with self.broker.condition:
+            self.broker.exchanges.pop(exchange or '', None)
+        return frame.Method(self.channel_number, spec.Exchange.DeleteOk())
+
+    def queue_declare(self,
+                      queue: str,
+                      passive: bool = False,
+                      durable: bool = False,
+                      exclusive: bool = False,
+                      auto_delete: bool = False,
+                      arguments: Optional[Dict[str, Any]] = None,
+                      ) -> frame.Method:
+        self._check_open()
+        arguments = dict(arguments or {})
+        if not queue:
+            queue = 'amq.gen-{}'.format(uuid.uuid4().hex)
+        with self.broker.condition:
+            existing = self.broker.queues.get(queue)
+            if existing is None:
+                if passive:
+                    raise self._fail(_not_found('queue', queue))
+                existing = _Queue(queue, durable, self.connection if exclusive else None, auto_delete, arguments)
+                self.broker.queues[queue] = existing
+                if existing.expires is not None:
+                    self.broker.expiring[queue] = existing
+            elif existing.exclusive is not None and existing.exclusive is not self.connection:
+                raise self._fail(ChannelClosedByBroker(
+                    405, "RESOURCE_LOCKED - cannot obtain exclusive access to locked queue '{}'".format(queue)))
+            elif not passive and (existing.durable != durable or existing.arguments != arguments):
+                raise self._fail(ChannelClosedByBroker(
+                    406, "PRECONDITION_FAILED - inequivalent arg for queue '{}'".format(queue)))
+            existing.last_used = time.monotonic()
+            result = spec.Queue.DeclareOk(queue, len(existing.messages), len(existing.consumers))
+        return frame.Method(self.channel_number, result)
+
+    def queue_bind(self,
+                   queue: str,
+                   exchange: str,
+                   routing_key: Optional[str] = None,
+                   arguments: Optional[Dict[str, Any]] = None,
+                   ) -> frame.Method:
+        self._check_open()
+        with self.broker.condition:
+            self.broker.queue(queue)
+            if exchange not in self.broker.exchanges:
+                raise self._fail(_not_found('exchange', exchange))
+            self.broker.exchanges[exchange].bind(queue, queue if routing_key is None else routing_key)
+        return frame.Method(self.channel_number, spec.Queue.BindOk())
+
+    def queue_unbind(self,
+                     queue: str,
+                     exchange: Optional[str] = None,
+                     routing_key: Optional[str] = None,
+                     arguments: Optional[Dict[str, Any]] = None,
+                     ) -> frame.Method:
+        self._check_open()
+        with self.broker.condition:
+            if exchange in self.broker.exchanges:
+                self.broker.exchanges[exchange].unbind(queue, queue if routing_key is None else routing_key)
+        return frame.Method(self.channel_number, spec.Queue.UnbindOk())
+
+    def queue_delete(self, queue: str, if_unused: bool = False, if_empty: bool = False) -> frame.Method:
+        self._check_open()
+        with self.broker.condition:
+            message_count = self.broker.delete_queue(queue)
+        return frame.Method(self.channel_number, spec.Queue.DeleteOk(message_count))
+
+    def queue_purge(self, queue: str) -> frame.Method:
+        self._check_open()
+        with self.broker.condition:
+            existing = self.broker.queue(queue)
+            message_count = len(existing.messages)
+            existing.messages.clear()
+        return frame.Method(self.channel_number, spec.Queue.PurgeOk(message_count))
+
+    def basic_publish(self,
+                      exchange: str,
+                      routing_key: str,
+                      body: Union[bytes, str],
+                      properties: Optional[spec.BasicProperties] = None,
+                      mandatory: bool = False,
+                      ) -> None:
+        self._check_open()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if self.transaction is not None:
+            self.transaction.append((exchange, routing_key, body, properties or BasicProperties()))
+            return
+        with self.broker.condition:
+            try:
+                self.broker.publish(exchange, routing_key, body, properties or BasicProperties())
+            except ChannelClosedByBroker as error:
+                raise self._fail(error)
+
+    def confirm_delivery(self) -> None:
+        self._check_open()
+        self.confirms = True
+
+    def tx_select(self) -> None:
+        self._check_open()
+        self.transaction = []
+
+    def tx_commit(self) -> None:
+        self._check_open()
+        if self.transaction is None:
+            raise self._fail(ChannelClosedByBroker(406, 'PRECONDITION_FAILED - channel is not transactional'))
+        messages, self.transaction = self.transaction, []
+        with self.broker.condition:
+            try:
+                for exchange, routing_key, body, properties in messages:
+                    self.broker.publish(exchange, routing_key, body, properties)
+            except ChannelClosedByBroker as error:
+                raise self._fail(error)
+
+    def tx_rollback(self) -> None:
+        self._check_open()
+        if self.transaction is None:
+            raise self._fail(ChannelClosedByBroker(406, 'PRECONDITION_FAILED - channel is not transactional'))
+        self.transaction = []
+
+    def basic_get(self,
+                  queue: str,
+                  auto_ack: bool = False,
+                  ) -> Tuple[Optional[spec.Basic.GetOk], Optional[spec.BasicProperties], Optional[bytes]]:
+        self._check_open()
+        with self.broker.condition:
+            self.broker.expire(time.monotonic())
+            try:
+                existing = self.broker.queue(queue)
+            except ChannelClosedByBroker as error:
+                raise self._fail(error)
+            existing.last_used = time.monotonic()
+            if not existing.messages:
+                return None, None, None
+            message = existing.messages.popleft()
+            delivery_tag = next(self.delivery_tags)
+            if not auto_ack:
+                self.unacked[delivery_tag] = (None, existing, message)
+            method = spec.Basic.GetOk(
+                delivery_tag=delivery_tag,
+                redelivered=message.redelivered,
+                exchange=message.exchange,
+                routing_key=message.routing_key,
+                message_count=len(existing.messages))
+        return method, message.properties, message.body
+
+    def basic_consume(self,
+                      queue: str,
+                      on_message_callback: Callable,
+                      auto_ack: bool = False,
+                      exclusive: bool = False,
+                      consumer_tag: Optional[str] = None,
+                      arguments: Optional[Dict[str, Any]] = None,
+                      ) -> str:
+        self._check_open()
+        consumer_tag = consumer_tag or 'ctag{}.{}'.format(self.channel_number, uuid.uuid4().hex)
+        with self.broker.condition:
+            try:
+                existing = self.broker.queue(queue)
+            except ChannelClosedByBroker as error:
+                raise self._fail(error)
+            consumer = _Consumer(consumer_tag, existing, self, on_message_callback, auto_ack, self.prefetch_count)
+            existing.consumers.append(consumer)
+            self.consumers[consumer_tag] = consumer
+            self.broker.condition.notify_all()
+        return consumer_tag
+
+    def _cancel(self, consumer_tag: str) -> None:
+        # Called with the lock held
+        consumer = self.consumers.pop(consumer_tag, None)
+        if consumer is None:
+            return
+        consumer.active = False
+        queue = consumer.queue
+        queue.consumers.remove(consumer)
+        queue.last_used = time.monotonic()
+        if queue.auto_delete and not queue.consumers:
+            self.broker.delete_queue(queue.name)
+
+    def basic_cancel(self, consumer_tag: str) -> List[Any]:
+        self._check_open()
+        with self.broker.condition:
+            self._cancel(consumer_tag)
+        return []
+
+    def start_consuming(self) -> None:
+        """
+        Deliver messages to the consumers until all of them are cancelled.
+        """
+        while self.consumers and self.is_open and self.connection.is_open:
+            self.connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self, consumer_tag: Optional[str] = None) -> None:
+        self._check_open()
+        with self.broker.condition:
+            for tag in [consumer_tag] if consumer_tag else list(self.consumers):
+                self._cancel(tag)
+
+    def _buffer_delivery(self,
+                         channel: 'MemoryChannel',
+                         method: spec.Basic.Deliver,
+                         properties: spec.BasicProperties,
+                         body: bytes,
+                         ) -> None:
+        self.buffer.append((method, properties, body))
+
+    def consume(self,
+                queue: str,
+                auto_ack: bool = False,
+                exclusive: bool = False,
+                arguments: Optional[Dict[str, Any]] = None,
+                inactivity_timeout: Optional[float] = None,
+                ) -> Iterator[Tuple[Any, Any, Any]]:
+        """
+        Generator of ``(method, properties, body)`` like
+        ``BlockingChannel.consume``. Yields ``(None, None, None)`` after
+        ``inactivity_timeout`` seconds without messages.
+        """
+        if self.buffer_tag is None:
+            self.buffer_tag = self.basic_consume(
+                queue, self._buffer_delivery, auto_ack=auto_ack, exclusive=exclusive, arguments=arguments)
+        while self.buffer_tag is not None:
+            if self.buffer:
+                yield self.buffer.popleft()
+                continue
+            deadline = None if inactivity_timeout is None else time.monotonic() + inactivity_timeout
+            while not self.buffer and self.buffer_tag in self.consumers and self.connection.is_open:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.connection.process_data_events(time_limit=remaining)
+            if not self.buffer:
+                if self.buffer_tag not in self.consumers or not self.connection.is_open:
+                    return
+                yield None, None, None
+
+    def cancel(self) -> int:
+        """
+        Cancel the consumer of ``consume`` and requeue the messages it
+        received but didn't yield yet.
+        """
+        if self.buffer_tag is None:
+            return 0
+        pending = len(self.buffer)
+        with self.broker.condition:
+            self._cancel(self.buffer_tag)
+            self._requeue([method.delivery_tag for method, _, _ in self.buffer
+                           if method.delivery_tag in self.unacked])
+        self.buffer.clear()
+        self.buffer_tag = None
+        return pending
+
+
+_brokers: Dict[str, MemoryBroker] = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker(name: str = '') -> MemoryBroker:
+    """
+    Return the broker reached with ``memory://<name>``.
+    """
+    with _brokers_lock:
+        broker = _brokers.get(name)
+        if broker is None:
+            broker = _brokers[name] = MemoryBroker(name)
+        return broker
+
+
+def connect(url: str = SCHEME) -> MemoryConnection:
+    """
+    Open a connection to the in-memory broker given by a ``memory://`` URL.
+    """
+    return MemoryConnection(get_broker(urlparse(url).netloc))
+
+
+def reset(name: Optional[str] = None) -> None:
+    """
+    Drop the in-memory broker ``memory://<name>``, or all brokers, with their
+    exchanges and queues. Open connections, including those of publisher
+    pools, keep using the old brokers.
+    """
+    with _brokers_lock:
+        if name is None:
+            _brokers.clear()
+        else:
+            _brokers.pop(name, None)
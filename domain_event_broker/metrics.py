@@ -0,0 +1,239 @@
+"""
+Metrics for publishing and consuming domain events.
+
+Metrics are disabled by default; the hot paths then only check whether a
+sink is installed. Enable them by installing a sink once per process::
+
+    from domain_event_broker import metrics
+    metrics.set_sink(metrics.PrometheusSink())
+
+The following metrics are recorded. Histograms are in seconds.
+
+================================== ========= ===============================
+Name                               Type      Labels
+================================== ========= ===============================
+domain_event_published_total       counter   ``routing_key``
+domain_event_publish_seconds       histogram ``routing_key``
+domain_event_received_total        counter   ``handler``, ``routing_key``
+domain_event_decode_seconds        histogram ``handler``
+domain_event_decode_errors_total   counter   ``handler``
+domain_event_lag_seconds           histogram ``handler``, ``routing_key``
+domain_event_in_flight             gauge     ``handler``
+domain_event_handler_seconds       histogram ``handler``, ``routing_key``
+domain_event_handled_total         counter   ``handler``, ``routing_key``,
+                                             ``outcome``
+domain_event_retry_publish_seconds histogram ``handler``
+================================== ========= ===============================
+
+The ``outcome`` of a handled event is ``ack``, ``retry``, ``reject``
+(dead-lettered or discarded) or ``duplicate`` (skipped by de-duplication).
+The lag is the time between the creation of an event and its delivery to the
+subscriber, which relies on the clocks of publisher and subscriber being in
+sync.
+
+``PrometheusSink`` requires the ``prometheus_client`` package.
+``StatsdSink`` sends plain UDP packets and has no dependencies.
+"""
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+import logging
+import re
+import socket
+import threading
+
+try:
+    import prometheus_client  # type: ignore
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+log = logging.getLogger(__name__)
+
+
+# Metric types
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+GAUGE = 'gauge'
+
+PUBLISHED = 'domain_event_published_total'
+PUBLISH_SECONDS = 'domain_event_publish_seconds'
+RECEIVED = 'domain_event_received_total'
+DECODE_SECONDS = 'domain_event_decode_seconds'
+DECODE_ERRORS = 'domain_event_decode_errors_total'
+LAG_SECONDS = 'domain_event_lag_seconds'
+IN_FLIGHT = 'domain_event_in_flight'
+HANDLER_SECONDS = 'domain_event_handler_seconds'
+HANDLED = 'domain_event_handled_total'
+RETRY_SECONDS = 'domain_event_retry_publish_seconds'
+
+# Outcomes of handled events
+ACK = 'ack'
+RETRY = 'retry'
+REJECT = 'reject'
+DUPLICATE = 'duplicate'
+
+#: Type, description and label names of all metrics
+METRICS: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {
+    PUBLISHED: (COUNTER, 'Domain events published', ('routing_key',)),
+    PUBLISH_SECONDS: (HISTOGRAM, 'Time to send a domain event to the broker', ('routing_key',)),
+    RECEIVED: (COUNTER, 'Domain events received by a handler', ('handler', 'routing_key')),
+    DECODE_SECONDS: (HISTOGRAM, 'Time to decode a received message', ('handler',)),
+    DECODE_ERRORS: (COUNTER, 'Received messages that could not be decoded', ('handler',)),
+    LAG_SECONDS: (HISTOGRAM, 'Time from creating a domain event to receiving it', ('handler', 'routing_key')),
+    IN_FLIGHT: (GAUGE, 'Domain events received but not yet handled', ('handler',)),
+    HANDLER_SECONDS: (HISTOGRAM, 'Time spent in the event handler', ('handler', 'routing_key')),
+    HANDLED: (COUNTER, 'Domain events handled', ('handler', 'routing_key', 'outcome')),
+    RETRY_SECONDS: (HISTOGRAM, 'Time to publish a retry to the delay queue', ('handler',)),
+}
+
+
+class MetricsSink(object):
+    """
+    Receives the measurements of the publishers and subscribers. Subclass
+    this to send metrics to a monitoring system. Sinks are called from the
+    IO thread and the worker threads, so they must be threadsafe.
+    """
+
+    def increment(self, name: str, labels: Dict[str, str], value: float = 1.0) -> None:
+        """
+        Add ``value`` to a counter.
+        """
+        raise NotImplementedError
+
+    def observe(self, name: str, labels: Dict[str, str], value: float) -> None:
+        """
+        Record a value of a histogram.
+        """
+        raise NotImplementedError
+
+    def adjust(self, name: str, labels: Dict[str, str], delta: float) -> None:
+        """
+        Add ``delta``, which may be negative, to a gauge.
+        """
+        raise NotImplementedError
+
+
+class CallbackSink(MetricsSink):
+    """
+    Pass every measurement to ``callback(kind, name, labels, value)``, where
+    ``kind`` is ``COUNTER``, ``HISTOGRAM`` or ``GAUGE``. The value of a gauge
+    is the change, not the new value.
+    """
+
+    def __init__(self, callback: Callable[[str, str, Dict[str, str], float], Any]):
+        self.callback = callback
+
+    def increment(self, name: str, labels: Dict[str, str], value: float = 1.0) -> None:
+        self.callback(COUNTER, name, labels, value)
+
+    def observe(self, name: str, labels: Dict[str, str], value: float) -> None:
+        self.callback(HISTOGRAM, name, labels, value)
+
+    def adjust(self, name: str, labels: Dict[str, str], delta: float) -> None:
+        self.callback(GAUGE, name, labels, delta)
+
+
+class StatsdSink(MetricsSink):
+    """
+    Send metrics to a StatsD daemon over UDP. Histograms are sent as timers
+    in milliseconds. Plain StatsD has no labels, so label values are
+    appended to the metric name; with ``tags=True`` they are sent as
+    DogStatsD tags instead.
+
+    :param str host: Host of the StatsD daemon.
+    :param int port: UDP port of the StatsD daemon.
+    :param str prefix: Prepended to all metric names.
+    :param bool tags: Send labels as DogStatsD tags.
+    """
+
+    def __init__(self,
+                 host: str = 'localhost',
+                 port: int = 8125,
+                 prefix: str = '',
+                 tags: bool = False,
+                 ):
+        self.address = (host, port)
+        self.prefix = prefix + '.' if prefix else ''
+        self.tags = tags
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name: str, labels: Dict[str, str], value: str, kind: str) -> None:
+        if self.tags:
+            tags = ','.join('{}:{}'.format(key, label) for key, label in labels.items())
+            packet = '{}{}:{}|{}|#{}'.format(self.prefix, name, value, kind, tags)
+        else:
+            name = '.'.join([name] + [re.sub(r'[^\w\-]', '_', label) for label in labels.values()])
+            packet = '{}{}:{}|{}'.format(self.prefix, name, value, kind)
+        try:
+            self.socket.sendto(packet.encode('utf-8'), self.address)
+        except OSError:
+            # Metrics must never break publishing or consuming
+            log.debug("Cannot send metric to StatsD", exc_info=True)
+
+    def increment(self, name: str, labels: Dict[str, str], value: float = 1.0) -> None:
+        self._send(name, labels, '{:g}'.format(value), 'c')
+
+    def observe(self, name: str, labels: Dict[str, str], value: float) -> None:
+        self._send(name, labels, '{:.3f}'.format(value * 1000), 'ms')
+
+    def adjust(self, name: str, labels: Dict[str, str], delta: float) -> None:
+        self._send(name, labels, '{:+g}'.format(delta), 'g')
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Record metrics with ``prometheus_client``. Expose them with the HTTP
+    server or WSGI app of ``prometheus_client``, e.g.
+    ``prometheus_client.start_http_server(8000)``.
+
+    :param registry: Registry to register the metrics with. Defaults to the
+        global registry of ``prometheus_client``.
+    :param list buckets: Upper bounds of the histogram buckets in seconds.
+    """
+
+    def __init__(self, registry: Any = None, buckets: Optional[Sequence[float]] = None):
+        if prometheus_client is None:
+            raise ImportError("PrometheusSink requires the prometheus_client package")
+        self.registry = registry if registry is not None else prometheus_client.REGISTRY
+        self.buckets = tuple(buckets) if buckets else prometheus_client.Histogram.DEFAULT_BUCKETS
+        self.metrics: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def _metric(self, name: str) -> Any:
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    kind, documentation, labelnames = METRICS[name]
+                    if kind == COUNTER:
+                        metric = prometheus_client.Counter(
+                            name, documentation, labelnames, registry=self.registry)
+                    elif kind == HISTOGRAM:
+                        metric = prometheus_client.Histogram(
+                            name, documentation, labelnames, registry=self.registry, buckets=self.buckets)
+                    else:
+                        metric = prometheus_client.Gauge(
+                            name, documentation, labelnames, registry=self.registry)
+                    self.metrics[name] = metric
+        return metric
+
+    def increment(self, name: str, labels: Dict[str, str], value: float = 1.0) -> None:
+        self._metric(name).labels(**labels).inc(value)
+
+    def observe(self, name: str, labels: Dict[str, str], value: float) -> None:
+        self._metric(name).labels(**labels).observe(value)
+
+    def adjust(self, name: str, labels: Dict[str, str], delta: float) -> None:
+        self._metric(name).labels(**labels).inc(delta)
+
+
+#: The installed sink, ``None`` if metrics are disabled
+sink: Optional[MetricsSink] = None
+
+
+def set_sink(new_sink: Optional[MetricsSink]) -> None:
+    """
+    Install a sink for all publishers and subscribers of the process. Pass
+    ``None`` to disable metrics.
+    """
+    global sink
+    sink = new_sink
@@ -0,0 +1,58 @@
+"""
+Publishing of single domain events. This module has no dependency on pika,
+which is only imported once the first event is published.
+"""
+from typing import Any, Dict, Optional
+from .events import DomainEvent
+from . import serializers, settings
+
+
+def publish_domain_event(routing_key: str,
+                         data: Dict[str, Any],
+                         domain_object_id: Optional[str] = None,
+                         uuid_string: Optional[str] = None,
+                         timestamp: Optional[float] = None,
+                         connection_settings: Optional[str] = '',
+                         ) -> DomainEvent:
+    """
+    Send a domain event to the message broker. The broker will take care of
+    dispatching the event to registered subscribers.
+
+    :param str routing_key: The routing key is of the form
+        ``<DOMAIN>.<EVENT_TYPE>``.  The routing key should be a descriptive
+        name of the domain event such as ``user.registered``.
+    :param dict data: The actual event data. *Must* be json serializable.
+    :param str domain_object_id: Domain identifier of the event. This field
+        is optional. If used, it might make search in an event store easier.
+    :param str uuid_string: This UUID identifier of the event. If left
+        ``None``, a new one will be created.
+    :param float timestamp: Unix timestamp. If timestamp is None, a new
+        (UTC) timestamp will be created.
+    :param str connection_settings: Specify the broker with an AMQP URL. If not
+        given, the default broker will be used. If set to ``None``, the domain
+        event is not published to a broker.
+    :return: The domain event that was published.
+    :rtype: :py:class:`domain_event_broker.DomainEvent`
+
+    If ``settings.BACKGROUND`` is enabled, the event is handed to a
+    :py:class:`domain_event_broker.background.BackgroundPublisher` and this
+    function returns before the event is published.
+    """
+    event = DomainEvent(
+        routing_key=routing_key,
+        data=data,
+        domain_object_id=domain_object_id,
+        uuid_string=uuid_string,
+        timestamp=timestamp)
+    if settings.BACKGROUND:
+        # Imported here, the background module depends on this one.
+        from .background import get_background_publisher
+        get_background_publisher(connection_settings).publish(event)
+        return event
+    # Imported on first use, so that processes that only publish don't load
+    # pika and the subscriber machinery at import time.
+    from .transport import get_publisher_pool
+    body, content_type = serializers.dumps(event.event_data)
+    pool = get_publisher_pool(connection_settings)
+    pool.publish(body, event.routing_key, content_type=content_type)
+    return event
@@ -1,6 +1,13 @@
-from typing import Any, Callable, Optional
-from .transport import Transport
-from . import settings
+from fnmatch import fnmatchcase
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import logging
+import time
+from pika import BasicProperties, spec
+from .events import DomainEvent
+from .transport import HANDLER_HEADER, Publisher, Transport
+from . import compression, serializers, settings
+
+log = logging.getLogger(__name__)
 
 
 RETRY = 'retry'
@@ -12,6 +19,19 @@ def retry_event(body: bytes, **kwargs: Any) -> str:
     return RETRY
 
 
+def _retry_properties(properties: spec.BasicProperties) -> spec.BasicProperties:
+    # Dead-lettering headers are dropped; the body is published unchanged.
+    # Events of a shared queue are only replayed to their handler.
+    headers = None
+    if properties.headers and HANDLER_HEADER in properties.headers:
+        headers = {HANDLER_HEADER: properties.headers[HANDLER_HEADER]}
+    return BasicProperties(
+        delivery_mode=2,
+        content_type=properties.content_type,
+        content_encoding=properties.content_encoding,
+        headers=headers)
+
+
 def replay_event(queue_name: str,
                  message_callback: Callable = retry_event,
                  connection_settings: Optional[str] = '',
@@ -34,37 +54,445 @@ def replay_event(queue_name: str,
     retry_exchange = queue_name + '-retry'
     dead_letter_queue = queue_name + '-dl'
     transport = Transport(connection_settings)
-    transport.connect()
-    assert transport.channel is not None
-    frame, header, body = transport.channel.basic_get(dead_letter_queue)
-    if frame is None:
-        return 0
-    action = message_callback(frame=frame, header=header, body=body)
-    if action == RETRY:
-        transport.channel.basic_publish(exchange=retry_exchange,
-                                        routing_key=frame.routing_key,
-                                        body=body,
-                                        )
-        transport.channel.basic_ack(frame.delivery_tag)
-    elif action == DISCARD:
-        transport.channel.basic_ack(frame.delivery_tag)
-    elif action == LEAVE:
-        transport.channel.basic_reject(frame.delivery_tag, requeue=True)
+    try:
+        assert transport.channel is not None
+        frame, header, body = transport.channel.basic_get(dead_letter_queue)
+        if frame is None:
+            return 0
+        action = message_callback(frame=frame, header=header, body=body)
+        if action == RETRY:
+            transport.channel.basic_publish(exchange=retry_exchange,
+                                            routing_key=frame.routing_key,
+                                            body=body,
+                                            properties=_retry_properties(header),
+                                            )
+            transport.channel.basic_ack(frame.delivery_tag)
+        elif action == DISCARD:
+            transport.channel.basic_ack(frame.delivery_tag)
+        elif action == LEAVE:
+            transport.channel.basic_reject(frame.delivery_tag, requeue=True)
+        else:
+            transport.channel.basic_reject(frame.delivery_tag, requeue=True)
+            raise Exception("Invalid action '{}'".format(action))
+        return frame.message_count
+    finally:
+        transport.disconnect()
+
+
+class ReplayStats(object):
+    """
+    Progress of a replay started with :py:func:`replay_queue`.
+    """
+
+    def __init__(self, queue_name: str, total: int):
+        self.queue_name = queue_name
+        #: Number of messages in the dead-letter queue when the replay started
+        self.total = total
+        self.retried = 0
+        self.discarded = 0
+        self.left = 0
+        #: Messages that could not be moved and are still in the queue
+        self.failed = 0
+        #: Messages left in the dead-letter queue after the replay
+        self.remaining = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    @property
+    def processed(self) -> int:
+        return self.retried + self.discarded + self.left + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    @property
+    def rate(self) -> float:
+        """
+        Processed messages per second.
+        """
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self) -> str:
+        return ("ReplayStats('{0.queue_name}', processed={0.processed}/{0.total}, "
+                "retried={0.retried}, discarded={0.discarded}, left={0.left}, "
+                "failed={0.failed}, rate={0.rate:.1f}/s)".format(self))
+
+
+def replay_queue(queue_name: str,
+                 message_callback: Callable = retry_event,
+                 connection_settings: Optional[str] = '',
+                 prefetch_count: int = 100,
+                 batch_size: int = 100,
+                 limit: Optional[int] = None,
+                 progress: Optional[Callable[[ReplayStats], None]] = None,
+                 rate: Optional[float] = None,
+                 ) -> ReplayStats:
+    """
+    Replay the messages currently in the dead-letter queue of ``queue_name``
+    over a single connection.
+
+    Messages are consumed with a prefetch window instead of being fetched one
+    at a time. Replayed messages are published with publisher confirms, and
+    the dead-lettered messages are acknowledged once per batch after the
+    broker confirmed the batch. Messages the callback chooses to ``LEAVE`` are
+    moved to the end of the dead-letter queue so they are not delivered again
+    during the same replay.
+
+    :param str queue_name: Name of the subscriber queue.
+    :param function message_callback: A callable that receives the event and
+        returns either ``RETRY``, ``LEAVE`` or ``DISCARD``.
+    :param str connection_settings: Specify the broker with an AMQP URL.
+    :param int prefetch_count: Number of messages delivered in advance.
+    :param int batch_size: Number of messages per confirm and acknowledgement.
+    :param int limit: Replay at most this many messages.
+    :param function progress: Called with the ``ReplayStats`` after each batch.
+    :param float rate: Replay at most this many messages per second. The
+        limit is enforced between batches, so choose a ``batch_size`` that is
+        small compared to the rate for an even flow.
+    :rtype: :py:class:`domain_event_broker.ReplayStats`
+    """
+    if connection_settings is None:
+        return ReplayStats(queue_name, 0)
+    elif connection_settings == '':
+        connection_settings = settings.BROKER
+    dead_letter_queue = queue_name + '-dl'
+    publisher = Publisher(connection_settings)
+    try:
+        assert publisher.channel is not None
+        channel = publisher.channel
+        result = channel.queue_declare(dead_letter_queue, passive=True)
+        total = result.method.message_count
+        if limit is not None:
+            total = min(total, limit)
+        stats = ReplayStats(queue_name, total)
+        if total > 0:
+            channel.basic_qos(prefetch_count=prefetch_count)
+            _consume_batches(publisher, queue_name, message_callback, stats, batch_size, progress, rate)
+        stats.remaining = channel.queue_declare(dead_letter_queue, passive=True).method.message_count
+        stats.finished = time.monotonic()
+        log.info("Replayed {}".format(stats))
+        return stats
+    finally:
+        publisher.disconnect()
+
+
+def _consume_batches(publisher: Publisher,
+                     queue_name: str,
+                     message_callback: Callable,
+                     stats: ReplayStats,
+                     batch_size: int,
+                     progress: Optional[Callable[[ReplayStats], None]],
+                     rate: Optional[float],
+                     ) -> None:
+    assert publisher.channel is not None
+    channel = publisher.channel
+    batch: List[Tuple[spec.Basic.Deliver, spec.BasicProperties, bytes]] = []
+    messages = channel.consume(queue_name + '-dl', inactivity_timeout=1.0)
+    try:
+        for method, properties, body in messages:
+            if method is not None:
+                batch.append((method, properties, body))
+            if batch and (method is None or len(batch) >= batch_size or
+                          stats.processed + len(batch) >= stats.total):
+                pending, batch = batch, []
+                _replay_batch(publisher, queue_name, pending, message_callback, stats)
+                if progress is not None:
+                    progress(stats)
+                if rate:
+                    _throttle(publisher, stats, rate)
+            if method is None or stats.processed >= stats.total:
+                break
+    finally:
+        # Messages that were delivered but not processed are returned to the
+        # queue when the connection is closed.
+        channel.cancel()
+
+
+def _throttle(publisher: Publisher, stats: ReplayStats, rate: float) -> None:
+    assert publisher.connection is not None
+    delay = stats.processed / rate - stats.elapsed
+    if delay > 0:
+        # Keep servicing heartbeats while waiting
+        publisher.connection.sleep(delay)
+
+
+def _replay_batch(publisher: Publisher,
+                  queue_name: str,
+                  batch: List[Tuple[spec.Basic.Deliver, spec.BasicProperties, bytes]],
+                  message_callback: Callable,
+                  stats: ReplayStats,
+                  ) -> None:
+    assert publisher.channel is not None
+    channel = publisher.channel
+    confirm_channel = publisher.get_confirm_channel()
+    retry_exchange = queue_name + '-retry'
+    dead_letter_queue = queue_name + '-dl'
+    # Outcome per message: the action and whether the broker confirmed the
+    # publish (actions without publish are confirmed right away).
+    actions: List[str] = []
+    confirmed: List[Optional[bool]] = []
+
+    def on_confirm(index: int, success: bool) -> None:
+        confirmed[index] = success
+
+    invalid_action = None
+    for index, (method, properties, body) in enumerate(batch):
+        action = message_callback(frame=method, header=properties, body=body)
+        if action not in (RETRY, DISCARD, LEAVE):
+            # Keep the message and everything after it in the queue.
+            invalid_action = action
+            for method, _, _ in batch[index:]:
+                channel.basic_reject(method.delivery_tag, requeue=True)
+            batch = batch[:index]
+            break
+        actions.append(action)
+        confirmed.append(None)
+        if action == RETRY:
+            confirm_channel.publish(
+                exchange=retry_exchange,
+                routing_key=method.routing_key,
+                body=body,
+                properties=_retry_properties(properties),
+                on_confirm=lambda success, index=index: on_confirm(index, success))
+        elif action == LEAVE:
+            # Move to the end of the dead-letter queue via the default exchange
+            confirm_channel.publish(
+                exchange='',
+                routing_key=dead_letter_queue,
+                body=body,
+                properties=properties,
+                on_confirm=lambda success, index=index: on_confirm(index, success))
+        else:
+            confirmed[index] = True
+
+    confirm_channel.wait(lambda: None in confirmed)
+    if batch and all(confirmed):
+        channel.basic_ack(batch[-1][0].delivery_tag, multiple=True)
     else:
-        transport.channel.basic_reject(frame.delivery_tag, requeue=True)
-        raise Exception("Invalid action '{}'".format(action))
-    return frame.message_count
+        for (method, _, _), success in zip(batch, confirmed):
+            if success:
+                channel.basic_ack(method.delivery_tag)
+            else:
+                channel.basic_reject(method.delivery_tag, requeue=True)
+    for action, success in zip(actions, confirmed):
+        if not success:
+            stats.failed += 1
+        elif action == RETRY:
+            stats.retried += 1
+        elif action == DISCARD:
+            stats.discarded += 1
+        else:
+            stats.left += 1
+    if invalid_action is not None:
+        raise Exception("Invalid action '{}'".format(invalid_action))
 
 
 def replay_all(queue_name: str,
                message_callback: Callable = retry_event,
                connection_settings: Optional[str] = '',
+               **kwargs: Any,
                ) -> int:
     """
     Replay all messages currently in the dead-letter queue.
-    Return number of messages dead-lettered since starting the replay.
+    Return number of messages left in the dead-letter queue after the replay.
+    Additional keyword arguments are passed to :py:func:`replay_queue`.
+    """
+    stats = replay_queue(queue_name, message_callback,
+                         connection_settings=connection_settings, **kwargs)
+    return stats.remaining
+
+
+_MISSING = object()
+
+
+def _lookup(payload: Any, path: str) -> Any:
+    # Resolve a dotted path such as ``data.items.0.sku`` in decoded JSON.
+    for key in path.split('.'):
+        if isinstance(payload, list) and key.isdigit() and int(key) < len(payload):
+            payload = payload[int(key)]
+        elif isinstance(payload, dict) and key in payload:
+            payload = payload[key]
+        else:
+            return _MISSING
+    return payload
+
+
+class EventFilter(object):
+    """
+    Predicate for dead-lettered events used by :py:func:`scan`. All given
+    criteria must match.
+
+    :param str routing_key: Shell-style glob matched against the routing key,
+        e.g. ``user.*``. Checked before the message body is decoded.
+    :param str domain_object_id: Exact domain object id.
+    :param float since: Only events with a timestamp at or after this time.
+    :param float until: Only events with a timestamp before this time.
+    :param dict match: Map of dotted JSON paths to expected values, e.g.
+        ``{'data.user.country': 'DE'}``.
+    :param function predicate: Called with the ``DomainEvent`` for any
+        additional checks.
+    """
+
+    def __init__(self,
+                 routing_key: Optional[str] = None,
+                 domain_object_id: Optional[str] = None,
+                 since: Optional[float] = None,
+                 until: Optional[float] = None,
+                 match: Optional[Dict[str, Any]] = None,
+                 predicate: Optional[Callable[[DomainEvent], bool]] = None,
+                 ):
+        self.routing_key = routing_key
+        self.domain_object_id = domain_object_id
+        self.since = since
+        self.until = until
+        self.match = match or {}
+        self.predicate = predicate
+
+    def __call__(self,
+                 routing_key: str,
+                 body: bytes,
+                 properties: Optional[spec.BasicProperties] = None,
+                 ) -> Optional[DomainEvent]:
+        """
+        Return the decoded event if the message matches, otherwise ``None``.
+        Messages that cannot be decoded never match.
+        """
+        if self.routing_key is not None and not fnmatchcase(routing_key, self.routing_key):
+            return None
+        content_type = properties.content_type if properties is not None else None
+        content_encoding = properties.content_encoding if properties is not None else None
+        try:
+            payload = serializers.loads(compression.decompress(body, content_encoding), content_type)
+            event = DomainEvent(**payload)
+        except Exception:
+            return None
+        if self.domain_object_id is not None and event.domain_object_id != self.domain_object_id:
+            return None
+        timestamp = event.timestamp or 0.0
+        if self.since is not None and timestamp < self.since:
+            return None
+        if self.until is not None and timestamp >= self.until:
+            return None
+        for path, value in self.match.items():
+            if _lookup(payload, path) != value:
+                return None
+        if self.predicate is not None and not self.predicate(event):
+            return None
+        return event
+
+
+def scan(queue_name: str,
+         event_filter: Optional[EventFilter] = None,
+         action: str = LEAVE,
+         connection_settings: Optional[str] = '',
+         prefetch_count: int = 100,
+         limit: Optional[int] = None,
+         **criteria: Any,
+         ) -> Iterator[DomainEvent]:
     """
-    remainder = replay_event(queue_name, message_callback, connection_settings=connection_settings)
-    for _ in range(remainder):
-        remainder = replay_event(queue_name, message_callback, connection_settings=connection_settings)
-    return remainder
+    Stream through the dead-letter queue of ``queue_name`` and yield the
+    events that match the filter. The filter criteria can be given as an
+    ``EventFilter`` or as keyword arguments of ``EventFilter``::
+
+        for event in scan('user-mail', routing_key='user.*', action=RETRY):
+            print(event)
+
+    Matching events are retried, discarded or left in the queue according to
+    ``action``. All other events are held while scanning and requeued
+    together at the end, so they keep their position in the queue. Routing
+    keys are matched without decoding the message.
+
+    :param str queue_name: Name of the subscriber queue.
+    :param str action: ``RETRY``, ``DISCARD`` or ``LEAVE``.
+    :param int prefetch_count: Number of messages examined per window.
+    :param int limit: Examine at most this many messages.
+    """
+    if action not in (RETRY, DISCARD, LEAVE):
+        raise Exception("Invalid action '{}'".format(action))
+    if event_filter is None:
+        event_filter = EventFilter(**criteria)
+    if connection_settings is None:
+        return
+    elif connection_settings == '':
+        connection_settings = settings.BROKER
+    dead_letter_queue = queue_name + '-dl'
+    publisher = Publisher(connection_settings)
+    try:
+        assert publisher.channel is not None
+        channel = publisher.channel
+        total = channel.queue_declare(dead_letter_queue, passive=True).method.message_count
+        if limit is not None:
+            total = min(total, limit)
+        if total == 0:
+            return
+        # The channel-wide limit can be raised while consuming. It grows with
+        # the number of held messages so that the window of messages still to
+        # be examined stays at ``prefetch_count``.
+        channel.basic_qos(prefetch_count=prefetch_count, global_qos=True)
+        scanned = 0
+        held = 0
+        window: List[Tuple[spec.Basic.Deliver, spec.BasicProperties, bytes, DomainEvent]] = []
+        try:
+            for method, properties, body in channel.consume(dead_letter_queue, inactivity_timeout=1.0):
+                if method is not None:
+                    scanned += 1
+                    event = event_filter(method.routing_key, body, properties)
+                    if event is None:
+                        held += 1
+                    else:
+                        window.append((method, properties, body, event))
+                end_of_window = method is None or scanned >= total or scanned % prefetch_count == 0
+                if end_of_window and window:
+                    held += _apply_action(publisher, queue_name, window, action)
+                    matches = [event for _, _, _, event in window]
+                    window = []
+                    yield from matches
+                if method is None or scanned >= total:
+                    break
+                if end_of_window and held:
+                    channel.basic_qos(prefetch_count=prefetch_count + held, global_qos=True)
+        finally:
+            channel.cancel()
+            if channel.is_open:
+                # Requeue all messages that are still unacknowledged at once
+                channel.basic_nack(delivery_tag=0, multiple=True, requeue=True)
+    finally:
+        publisher.disconnect()
+
+
+def _apply_action(publisher: Publisher,
+                  queue_name: str,
+                  window: List[Tuple[spec.Basic.Deliver, spec.BasicProperties, bytes, DomainEvent]],
+                  action: str,
+                  ) -> int:
+    # Apply the action to matching messages and return the number of messages
+    # that remain unacknowledged.
+    assert publisher.channel is not None
+    if action == LEAVE:
+        return len(window)
+    confirmed: List[Optional[bool]] = [True] * len(window)
+    if action == RETRY:
+        confirm_channel = publisher.get_confirm_channel()
+
+        def on_confirm(index: int, success: bool) -> None:
+            confirmed[index] = success
+
+        for index, (method, properties, body, _) in enumerate(window):
+            confirmed[index] = None
+            confirm_channel.publish(
+                exchange=queue_name + '-retry',
+                routing_key=method.routing_key,
+                body=body,
+                properties=_retry_properties(properties),
+                on_confirm=lambda success, index=index: on_confirm(index, success))
+        confirm_channel.wait(lambda: None in confirmed)
+    unacknowledged = 0
+    for (method, _, _, _), success in zip(window, confirmed):
+        if success:
+            publisher.channel.basic_ack(method.delivery_tag)
+        else:
+            unacknowledged += 1
+    return unacknowledged
@@ -0,0 +1,80 @@
+"""
+Matching of routing keys against topic binding keys on the client side.
+"""
+from typing import Any, Dict, List, Set, Tuple
+
+
+class _Node(object):
+    __slots__ = ('children', 'values')
+
+    def __init__(self) -> None:
+        self.children: Dict[str, '_Node'] = {}
+        self.values: List[Tuple[int, Any]] = []
+
+
+class RoutingTrie(object):
+    """
+    Index of topic binding keys. Binding keys are split into dot-separated
+    words and stored in a trie, so a lookup only follows the words of the
+    routing key and the ``*`` and ``#`` wildcards instead of testing every
+    binding key. Results are cached per routing key.
+
+    :param int cache_size: Maximum number of cached routing keys.
+    """
+
+    def __init__(self, cache_size: int = 1024):
+        self.root = _Node()
+        self.cache_size = cache_size
+        self.cache: Dict[str, List[Any]] = {}
+        self.count = 0
+
+    def add(self, binding_key: str, value: Any) -> None:
+        """
+        Add ``value`` for routing keys matching ``binding_key``.
+        """
+        node = self.root
+        for word in binding_key.split('.'):
+            node = node.children.setdefault(word, _Node())
+        node.values.append((self.count, value))
+        self.count += 1
+        self.cache.clear()
+
+    def match(self, routing_key: str) -> List[Any]:
+        """
+        Values of all binding keys matching ``routing_key``, in the order
+        they were added. A value added for several matching binding keys is
+        returned once.
+        """
+        values = self.cache.get(routing_key)
+        if values is None:
+            values = self._match(routing_key.split('.'))
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[routing_key] = values
+        return values
+
+    def _match(self, words: List[str]) -> List[Any]:
+        found: List[Tuple[int, Any]] = []
+        visited: Set[Tuple[int, int]] = set()
+        pending = [(self.root, 0)]
+        while pending:
+            node, index = pending.pop()
+            if (id(node), index) in visited:
+                continue
+            visited.add((id(node), index))
+            hash_node = node.children.get('#')
+            if hash_node is not None:
+                # '#' matches zero or more words
+                pending.extend((hash_node, rest) for rest in range(index, len(words) + 1))
+            if index == len(words):
+                found.extend(node.values)
+                continue
+            for word in (words[index], '*'):
+                child = node.children.get(word)
+                if child is not None:
+                    pending.append((child, index + 1))
+        values: List[Any] = []
+        for _, value in sorted(found, key=lambda item: item[0]):
+            if not any(value is other for other in values):
+                values.append(value)
+        return values
@@ -0,0 +1,152 @@
+"""
+Serializers for the payload of domain events.
+
+The serializer used for publishing is selected with ``settings.SERIALIZER``
+(``DOMAIN_EVENT_BROKER_SERIALIZER`` in Django). Published messages carry the
+``content_type`` of their serializer, and subscribers pick the decoder from
+the message properties. This allows publishers and subscribers to switch
+serializers one at a time. Messages without a ``content_type`` are JSON.
+
+Besides the default ``json`` serializer, ``orjson`` and ``msgpack`` are
+available if the respective package is installed.
+"""
+from typing import Any, Dict, Optional, Tuple, Union
+import json
+from . import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+try:
+    import msgpack  # type: ignore
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+
+class Serializer(object):
+    """
+    Encode and decode the ``event_data`` of domain events. Subclass this and
+    call :py:func:`register_serializer` to add a serializer.
+    """
+
+    #: Name used to select the serializer in ``settings.SERIALIZER``
+    name = ''
+    #: MIME type stamped on published messages
+    content_type = ''
+
+    def dumps(self, data: Dict[str, Any]) -> Union[bytes, str]:
+        raise NotImplementedError
+
+    def loads(self, body: Union[bytes, str]) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    name = 'json'
+    content_type = JSON
+
+    def dumps(self, data: Dict[str, Any]) -> Union[bytes, str]:
+        return json.dumps(data)
+
+    def loads(self, body: Union[bytes, str]) -> Dict[str, Any]:
+        return json.loads(body)
+
+
+class OrjsonSerializer(Serializer):
+    """
+    JSON serializer based on `orjson <https://github.com/ijl/orjson>`_. The
+    output is compatible with the ``json`` serializer.
+    """
+    name = 'orjson'
+    content_type = JSON
+
+    def dumps(self, data: Dict[str, Any]) -> Union[bytes, str]:
+        return orjson.dumps(data)
+
+    def loads(self, body: Union[bytes, str]) -> Dict[str, Any]:
+        return orjson.loads(body)
+
+
+class MsgpackSerializer(Serializer):
+    """
+    Binary serializer based on `msgpack <https://msgpack.org/>`_.
+    """
+    name = 'msgpack'
+    content_type = MSGPACK
+
+    def dumps(self, data: Dict[str, Any]) -> Union[bytes, str]:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, body: Union[bytes, str]) -> Dict[str, Any]:
+        return msgpack.unpackb(body, raw=False)
+
+
+_serializers: Dict[str, Serializer] = {}
+
+
+def register_serializer(serializer: Serializer) -> None:
+    """
+    Make a serializer available for publishing and decoding. A serializer
+    registered under an existing name replaces the previous one.
+    """
+    _serializers[serializer.name] = serializer
+
+
+def get_serializer(name: Optional[str] = None) -> Serializer:
+    """
+    Return the serializer registered as ``name``, by default the one
+    configured in ``settings.SERIALIZER``.
+    """
+    if name is None:
+        name = settings.SERIALIZER
+    try:
+        return _serializers[name]
+    except KeyError:
+        raise ValueError("Unknown serializer '{}'".format(name))
+
+
+def get_decoder(content_type: Optional[str] = None) -> Serializer:
+    """
+    Return a serializer that can decode messages of the given content type.
+    The configured serializer is preferred if it handles the content type,
+    e.g. ``orjson`` decodes all JSON messages if it is configured.
+    """
+    if not content_type:
+        content_type = JSON
+    serializer = get_serializer()
+    if serializer.content_type == content_type:
+        return serializer
+    for serializer in _serializers.values():
+        if serializer.content_type == content_type:
+            return serializer
+    raise ValueError("No serializer for content type '{}'".format(content_type))
+
+
+def dumps(data: Dict[str, Any], name: Optional[str] = None) -> Tuple[Union[bytes, str], str]:
+    """
+    Serialize ``data``.
+
+    :return: The message body and its content type.
+    :rtype: tuple
+    """
+    serializer = get_serializer(name)
+    return serializer.dumps(data), serializer.content_type
+
+
+def loads(body: Union[bytes, str], content_type: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Deserialize a message body of the given content type.
+    """
+    return get_decoder(content_type).loads(body)
+
+
+register_serializer(JSONSerializer())
+if orjson is not None:
+    register_serializer(OrjsonSerializer())
+if msgpack is not None:
+    register_serializer(MsgpackSerializer())
@@ -0,0 +1,295 @@
+"""
+Run event handlers in several worker processes. Handlers are CPU bound more
+often than not, and the GIL keeps a single process from using more than one
+core.
+
+Each worker process creates its own ``Subscriber`` and passes it to a setup
+function that registers the handlers::
+
+    def setup(subscriber):
+        subscriber.register(send_welcome_mail, 'welcome-mail', ['user.registered'])
+
+    Supervisor(setup, processes=4).run()
+
+The same can be started from the command line::
+
+    python -m domain_event_broker.supervisor myapp.events:setup --processes 4
+
+The supervisor restarts workers that exit and forwards ``SIGTERM`` and
+``SIGINT`` to the workers, which then drain and exit. Optionally,
+the number of workers is scaled with the number of messages waiting in the
+handlers' queues.
+"""
+from argparse import ArgumentParser
+from functools import partial
+from importlib import import_module
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, List, Optional
+import logging
+import math
+import multiprocessing
+import signal
+import time
+from .transport import CONNECTION_ERRORS, Subscriber, Transport
+from . import settings
+
+log = logging.getLogger(__name__)
+
+
+# Seconds the supervisor waits for a worker to disconnect after draining
+STOP_MARGIN = 5.0
+
+
+def _run_worker(setup: Callable[[Subscriber], Any],
+                subscriber_kwargs: Dict[str, Any],
+                drain_timeout: float,
+                ) -> None:
+    # Entry point of a worker process. The supervisor sends SIGTERM to stop
+    # the worker; SIGINT from the terminal is handled by the supervisor.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    subscriber = Subscriber(**subscriber_kwargs)
+
+    def stop(signum: int, frame: Any) -> None:
+        if subscriber.connection is not None:
+            subscriber.connection.add_callback_threadsafe(partial(subscriber.drain, drain_timeout))
+
+    signal.signal(signal.SIGTERM, stop)
+    setup(subscriber)
+    subscriber.start_consuming()
+
+
+class Supervisor(object):
+    """
+    Start worker processes that consume domain events, restart workers that
+    exited, and stop all workers gracefully on ``SIGTERM`` or ``SIGINT``.
+
+    :param function setup: Called in every worker process with a new
+        ``Subscriber`` to register the event handlers. If workers are started
+        with the ``spawn`` method, it must be importable.
+    :param int processes: Number of worker processes.
+    :param int max_processes: Scale up to this many workers while messages
+        pile up in ``queues``. Autoscaling is off if not given.
+    :param list queues: Names of the queues polled for autoscaling.
+    :param int messages_per_process: Number of waiting messages that justify
+        one more worker.
+    :param float poll_interval: Seconds between queue depth polls.
+    :param float restart_delay: Seconds to wait before restarting a worker
+        that exited.
+    :param float stop_timeout: Seconds workers wait for events in flight
+        after ``SIGTERM``. Workers that didn't exit shortly after are killed.
+    :param dict subscriber_kwargs: Keyword arguments for ``Subscriber``, e.g.
+        ``max_workers``.
+    :param str connection_settings: Specify the broker with an AMQP URL.
+    """
+
+    def __init__(self,
+                 setup: Callable[[Subscriber], Any],
+                 processes: int = 2,
+                 max_processes: Optional[int] = None,
+                 queues: Optional[List[str]] = None,
+                 messages_per_process: int = 1000,
+                 poll_interval: float = 10.0,
+                 restart_delay: float = 1.0,
+                 stop_timeout: float = 30.0,
+                 subscriber_kwargs: Optional[Dict[str, Any]] = None,
+                 connection_settings: Optional[str] = '',
+                 ):
+        if connection_settings == '':
+            connection_settings = settings.BROKER
+        self.setup = setup
+        self.processes = processes
+        self.max_processes = max_processes
+        self.queues = queues or []
+        self.messages_per_process = messages_per_process
+        self.poll_interval = poll_interval
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.subscriber_kwargs = dict(subscriber_kwargs or {})
+        self.subscriber_kwargs.setdefault('connection_settings', connection_settings)
+        self.connection_settings = connection_settings
+        self.target = processes
+        self.workers: List[multiprocessing.Process] = []
+        self.retiring: List[multiprocessing.Process] = []
+        self.stopping = False
+        self.transport: Optional[Transport] = None
+        #: Number of workers that exited with an error or were killed by a
+        #: signal
+        self.crashes = 0
+
+    @property
+    def autoscale(self) -> bool:
+        return self.max_processes is not None and bool(self.queues)
+
+    def _start_worker(self) -> None:
+        worker = multiprocessing.Process(
+            target=_run_worker,
+            args=(self.setup, self.subscriber_kwargs, self.stop_timeout),
+            name='domain-event-worker')
+        worker.start()
+        log.info("Started worker {}".format(worker.pid))
+        self.workers.append(worker)
+
+    def _reap(self) -> int:
+        # Remove exited workers and return their number. Workers exit cleanly
+        # with code 0, e.g. after draining; other exit codes and signals
+        # count as crashes.
+        exited = 0
+        for worker in [worker for worker in self.workers if not worker.is_alive()]:
+            worker.join()
+            self.workers.remove(worker)
+            if worker.exitcode == 0:
+                log.info("Worker {} exited".format(worker.pid))
+            else:
+                log.error("Worker {} exited with code {}".format(worker.pid, worker.exitcode))
+                self.crashes += 1
+            exited += 1
+        for worker in [worker for worker in self.retiring if not worker.is_alive()]:
+            worker.join()
+            self.retiring.remove(worker)
+        return exited
+
+    def queue_depth(self) -> int:
+        """
+        Number of messages waiting in the polled queues. The queues are
+        checked with a passive declaration that doesn't create them.
+        """
+        total = 0
+        if self.connection_settings is None:
+            return total
+        try:
+            if self.transport is None or not self.transport.is_connected:
+                self.transport = Transport(self.connection_settings)
+            for queue in self.queues:
+                assert self.transport.channel is not None
+                result = self.transport.channel.queue_declare(queue, passive=True)
+                total += result.method.message_count
+        except CONNECTION_ERRORS:
+            # A missing queue closes the channel as well.
+            log.warning("Cannot poll queue depth", exc_info=True)
+            self.transport = None
+        return total
+
+    def _scale(self) -> None:
+        assert self.max_processes is not None
+        wanted = math.ceil(self.queue_depth() / self.messages_per_process)
+        wanted = min(max(wanted, self.processes), self.max_processes)
+        # Scale up at once, but retire one worker at a time.
+        if wanted > self.target:
+            log.info("Scaling up to {} workers".format(wanted))
+            self.target = wanted
+        elif wanted < self.target:
+            self.target -= 1
+            log.info("Scaling down to {} workers".format(self.target))
+
+    def _retire_surplus(self) -> None:
+        while len(self.workers) > self.target:
+            worker = self.workers.pop()
+            worker.terminate()
+            self.retiring.append(worker)
+
+    def _on_signal(self, signum: int, frame: Any) -> None:
+        self.stopping = True
+
+    def run(self) -> None:
+        """
+        Start the workers and supervise them until ``SIGTERM`` or ``SIGINT``
+        is received.
+        """
+        previous = {signum: signal.signal(signum, self._on_signal)
+                    for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            self._supervise()
+        finally:
+            self.stop()
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def _supervise(self) -> None:
+        next_poll = time.monotonic()
+        next_start = time.monotonic()
+        while not self.stopping:
+            if self._reap():
+                next_start = time.monotonic() + self.restart_delay
+            if self.autoscale and time.monotonic() >= next_poll:
+                self._scale()
+                next_poll = time.monotonic() + self.poll_interval
+            self._retire_surplus()
+            while len(self.workers) < self.target and time.monotonic() >= next_start:
+                self._start_worker()
+            # Wake up as soon as a worker exits
+            sentinels = [worker.sentinel for worker in self.workers + self.retiring]
+            if sentinels:
+                wait(sentinels, timeout=1.0)
+            else:
+                time.sleep(1.0)
+
+    def stop(self) -> None:
+        """
+        Send ``SIGTERM`` to all workers and wait for them to exit. Workers
+        still running after ``stop_timeout`` are killed.
+        """
+        self.stopping = True
+        workers = self.workers + self.retiring
+        self.workers, self.retiring = [], []
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        deadline = time.monotonic() + self.stop_timeout + STOP_MARGIN
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                log.error("Worker {} did not stop in time, killing it".format(worker.pid))
+                worker.kill()
+                worker.join()
+        if self.transport is not None:
+            try:
+                self.transport.disconnect()
+            except CONNECTION_ERRORS:
+                pass
+            self.transport = None
+
+
+def import_setup(path: str) -> Callable[[Subscriber], Any]:
+    """
+    Import a setup function given as ``module:function`` or
+    ``module.function``.
+    """
+    if ':' in path:
+        module_name, name = path.split(':', 1)
+    else:
+        module_name, _, name = path.rpartition('.')
+    return getattr(import_module(module_name), name)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = ArgumentParser(
+        prog='python -m domain_event_broker.supervisor',
+        description='Consume domain events in several worker processes.')
+    parser.add_argument(
+        'setup',
+        help='Function that registers handlers on a Subscriber, e.g. myapp.events:setup')
+    parser.add_argument('--processes', type=int, default=2, help='Number of worker processes.')
+    parser.add_argument('--max-processes', type=int, help='Maximum number of workers when autoscaling.')
+    parser.add_argument(
+        '--queue', action='append', dest='queues', default=[],
+        help='Queue polled for autoscaling. Can be given several times.')
+    parser.add_argument(
+        '--messages-per-process', type=int, default=1000,
+        help='Waiting messages that justify one more worker.')
+    parser.add_argument('--max-workers', type=int, default=1, help='Threads per worker process.')
+    parser.add_argument('--broker', default='', help='AMQP URL of the broker.')
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    Supervisor(
+        import_setup(options.setup),
+        processes=options.processes,
+        max_processes=options.max_processes,
+        queues=options.queues,
+        messages_per_process=options.messages_per_process,
+        subscriber_kwargs={'max_workers': options.max_workers},
+        connection_settings=options.broker,
+    ).run()
+
+
+if __name__ == '__main__':
+    main()
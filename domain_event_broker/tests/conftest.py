@@ -1,6 +1,7 @@
 
-from domain_event_broker import publish_domain_event, Subscriber
+from domain_event_broker import publish_domain_event, settings as broker_settings, Subscriber
 from .helpers import delete_queue
+import os
 import pytest
 import uuid
 
@@ -28,6 +29,8 @@ def dead_letter_message():
 
 
 def pytest_configure():
+    # TEST_BROKER=memory:// runs the tests without RabbitMQ
+    broker_settings.BROKER = os.environ.get('TEST_BROKER', broker_settings.BROKER)
     from django.conf import settings
     settings.configure(
         SECRET_KEY='test',
@@ -0,0 +1,90 @@
+import json
+import pytest
+from unittest.mock import patch
+from django.core.management import call_command
+from django.db import transaction
+
+from domain_event_broker.django import publish_on_commit
+from domain_event_broker.django.models import OutboxEvent
+from domain_event_broker.django.outbox import relay_outbox
+from ..helpers import delete_queue, get_message_from_queue
+from domain_event_broker import Subscriber, memory
+
+
+class RollbackError(Exception):
+    pass
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('domain_event_broker.django.transaction.publish_domain_event')
+def test_outbox_on_commit(publish_mock, settings):
+    settings.DOMAIN_EVENT_BROKER_OUTBOX = True
+    with transaction.atomic():
+        publish_on_commit('test.outbox', {'message': 'hello'}, domain_object_id='1')
+    assert not publish_mock.called
+    event = OutboxEvent.objects.get()
+    assert event.routing_key == 'test.outbox'
+    data = json.loads(event.body)
+    assert data['data'] == {'message': 'hello'}
+    assert data['domain_object_id'] == '1'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_outbox_rollback(settings):
+    settings.DOMAIN_EVENT_BROKER_OUTBOX = True
+    try:
+        with transaction.atomic():
+            publish_on_commit('test.outbox', {})
+            raise RollbackError('Rollback transaction')
+    except RollbackError:
+        pass
+    assert not OutboxEvent.objects.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_relay_outbox(settings):
+    settings.DOMAIN_EVENT_BROKER_OUTBOX = True
+    name = 'test-outbox-relay'
+    delete_queue(name)
+    subscriber = Subscriber()
+    subscriber.register(lambda event: None, name, ['test.outbox-relay'])
+    with transaction.atomic():
+        for index in range(3):
+            publish_on_commit('test.outbox-relay', {'index': index})
+    assert relay_outbox(batch_size=2) == 2
+    call_command('relay_domain_events', '--once')
+    assert not OutboxEvent.objects.exists()
+    header, event = get_message_from_queue(name)
+    assert event.data == {'index': 0}
+    delete_queue(name)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_outbox_connection_settings(settings):
+    settings.DOMAIN_EVENT_BROKER_OUTBOX = True
+    broker = 'memory://test-outbox'
+    memory.reset('test-outbox')
+    subscriber = Subscriber(broker)
+    subscriber.register(lambda event: None, 'test-outbox-broker', ['test.outbox-broker'])
+    subscriber.disconnect()
+    with transaction.atomic():
+        publish_on_commit('test.outbox-broker', {'index': 0}, connection_settings=broker)
+        publish_on_commit('test.outbox-broker', {'index': 1}, None, None, None, broker)
+        # Dummy mode doesn't store the event
+        publish_on_commit('test.outbox-broker', {'index': 2}, connection_settings=None)
+    assert list(OutboxEvent.objects.values_list('connection_settings', flat=True)) == [broker, broker]
+    assert relay_outbox() == 2
+    queue = memory.get_broker('test-outbox').queues['test-outbox-broker']
+    assert len(queue.messages) == 2
+    memory.reset('test-outbox')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_relay_outbox_timeout(settings):
+    settings.DOMAIN_EVENT_BROKER_OUTBOX = True
+    with transaction.atomic():
+        publish_on_commit('test.outbox-timeout', {})
+    # Events that were not confirmed in time stay in the outbox
+    assert relay_outbox(confirm_timeout=0) == 0
+    assert OutboxEvent.objects.count() == 1
+    assert relay_outbox() == 1
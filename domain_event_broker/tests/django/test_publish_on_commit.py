@@ -1,5 +1,5 @@
 import pytest
-from unittest.mock import patch
+from unittest.mock import call, patch
 from django.db import transaction
 
 from domain_event_broker.django import publish_on_commit
@@ -39,3 +39,112 @@ def test_discard_on_rollback(publish_mock):
     with transaction.atomic():
         pass
     assert not publish_mock.called
+
+
+def published_events(pool_mock):
+    publisher = pool_mock.return_value.acquire.return_value.__enter__.return_value
+    return [
+        [(event.routing_key, event.data) for event in call[0][0]]
+        for call in publisher.publish_many.call_args_list]
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('domain_event_broker.django.transaction.get_publisher_pool')
+def test_batch_on_commit(pool_mock):
+    with transaction.atomic():
+        publish_on_commit('test.one', {})
+        with transaction.atomic():
+            publish_on_commit('test.two', {})
+        publish_on_commit('test.three', {})
+        assert not pool_mock.called
+    assert published_events(pool_mock) == [
+        [('test.one', {}), ('test.two', {}), ('test.three', {})],
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('domain_event_broker.django.transaction.get_publisher_pool')
+def test_batch_savepoint_rollback(pool_mock):
+    with transaction.atomic():
+        publish_on_commit('test.one', {})
+        try:
+            with transaction.atomic():
+                publish_on_commit('test.rollback', {})
+                raise RollbackError('Rollback savepoint')
+        except RollbackError:
+            pass
+        publish_on_commit('test.two', {})
+    assert published_events(pool_mock) == [[('test.one', {}), ('test.two', {})]]
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('domain_event_broker.django.transaction.get_publisher_pool')
+def test_batch_first_event_in_savepoint(pool_mock):
+    # The batch must be flushed even if the savepoint in which it was created
+    # is rolled back.
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                publish_on_commit('test.rollback', {})
+                raise RollbackError('Rollback savepoint')
+        except RollbackError:
+            pass
+        publish_on_commit('test.one', {})
+        publish_on_commit('test.two', {})
+    assert published_events(pool_mock) == [[('test.one', {}), ('test.two', {})]]
+    # A new transaction starts a new batch
+    with transaction.atomic():
+        publish_on_commit('test.three', {})
+        publish_on_commit('test.four', {})
+    assert published_events(pool_mock)[1] == [('test.three', {}), ('test.four', {})]
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('domain_event_broker.django.transaction.publish_domain_event')
+@patch('domain_event_broker.django.transaction.get_publisher_pool')
+def test_batch_nested_savepoints(pool_mock, publish_mock):
+    # Events in savepoints that may still be rolled back end a batch, but
+    # every committed event is published exactly once.
+    with transaction.atomic():
+        publish_on_commit('test.one', {})
+        with transaction.atomic():
+            publish_on_commit('test.two', {})
+            publish_on_commit('test.three', {})
+            try:
+                with transaction.atomic():
+                    publish_on_commit('test.rollback', {})
+                    raise RollbackError('Rollback savepoint')
+            except RollbackError:
+                pass
+        with transaction.atomic():
+            publish_on_commit('test.four', {})
+    assert publish_mock.call_args_list == [call('test.one', {}), call('test.four', {})]
+    assert published_events(pool_mock) == [[('test.two', {}), ('test.three', {})]]
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('domain_event_broker.django.transaction.get_publisher_pool')
+def test_batch_connection_settings(pool_mock):
+    with transaction.atomic():
+        publish_on_commit('test.one', {}, None, None, None, 'amqp://other')
+        publish_on_commit('test.two', {}, connection_settings='amqp://other')
+    pool_mock.assert_called_once_with('amqp://other')
+    publisher = pool_mock.return_value.acquire.return_value.__enter__.return_value
+    (events,), _ = publisher.publish_many.call_args
+    assert [event.routing_key for event in events] == ['test.one', 'test.two']
+    assert events[0].retries == 0
+
+
+@pytest.mark.django_db(transaction=True)
+@patch('domain_event_broker.django.transaction.publish_domain_event')
+@patch('domain_event_broker.django.transaction.get_publisher_pool')
+def test_batch_not_confirmed(pool_mock, publish_mock):
+    publisher = pool_mock.return_value.acquire.return_value.__enter__.return_value
+    publisher.publish_many.return_value = [True, False]
+    with transaction.atomic():
+        publish_on_commit('test.one', {})
+        publish_on_commit('test.two', {'a': 1})
+    assert publish_mock.call_count == 1
+    args, kwargs = publish_mock.call_args
+    assert args == ('test.two', {'a': 1})
+    assert kwargs['connection_settings'] == ''
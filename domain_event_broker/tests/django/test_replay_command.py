@@ -1,6 +1,8 @@
 from io import StringIO
 from time import sleep
+import pytest
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from ..helpers import get_message_from_queue, get_queue_size
 
 
@@ -65,3 +67,33 @@ def test_interactive_replay_timeout(dead_letter_message, monkeypatch):
     sleep(.6)
     assert get_queue_size('test-replay-dl') == 1
     assert get_queue_size('test-replay') == 0
+
+
+def test_replay_all_parallel(dead_letter_message):
+    output = StringIO()
+    call_command('replay_domain_event', 'test-replay', '--all', '--parallel', '2',
+                 '--rate', '100', '--batch-size', '10', stdout=output)
+    assert get_queue_size('test-replay-dl') == 0
+    header, event = get_message_from_queue('test-replay')
+    assert event.data == dead_letter_message
+    assert "0 dead-lettered events remaining for test-replay" in output.getvalue()
+
+
+def test_parallel_interactive_replay():
+    with pytest.raises(CommandError):
+        call_command('replay_domain_event', 'test-replay', '--all', '--parallel', '2',
+                     '--interactive')
+
+
+def test_parallel_requires_all():
+    with pytest.raises(CommandError, match='requires --all'):
+        call_command('replay_domain_event', 'test-replay', '--parallel', '2')
+
+
+def test_scan_filter(dead_letter_message):
+    output = StringIO()
+    call_command('replay_domain_event', 'test-replay', '--routing-key', 'test.*',
+                 '--match', 'data.message="{}"'.format(dead_letter_message['message']),
+                 stdout=output)
+    assert "1 matching events in test-replay (leave)" in output.getvalue()
+    assert get_queue_size('test-replay-dl') == 1
@@ -1,9 +1,14 @@
 import pika
-from domain_event_broker import DomainEvent
+from domain_event_broker import DomainEvent, compression, serializers, settings
+from domain_event_broker.transport import _connect
+
+
+def connect():
+    return _connect(settings.BROKER)
 
 
 def get_queue_size(name, **kwargs):
-    connection = pika.BlockingConnection()
+    connection = connect()
     channel = connection.channel()
     q = channel.queue_declare(name, passive=True, **kwargs)
     count = q.method.message_count
@@ -12,7 +17,7 @@ def get_queue_size(name, **kwargs):
 
 
 def check_queue_exists(name, **kwargs):
-    connection = pika.BlockingConnection()
+    connection = connect()
     channel = connection.channel()
     try:
         channel.queue_declare(name, passive=True, **kwargs)
@@ -25,19 +30,20 @@ def check_queue_exists(name, **kwargs):
 
 
 def get_message_from_queue(name, **kwargs):
-    connection = pika.BlockingConnection()
+    connection = connect()
     channel = connection.channel()
     method_frame, header, body = channel.basic_get(name)
     if method_frame:
         channel.basic_ack(method_frame.delivery_tag)
-        event = DomainEvent.from_json(body)
+        body = compression.decompress(body, header.content_encoding)
+        event = DomainEvent(**serializers.loads(body, header.content_type))
         return header, event
     else:
         return None, None
 
 
 def delete_queue(name):
-    connection = pika.BlockingConnection()
+    connection = connect()
     channel = connection.channel()
     channel.queue_delete(queue=name)
     channel.close()
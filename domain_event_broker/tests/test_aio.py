@@ -0,0 +1,86 @@
+import asyncio
+import pytest
+import uuid
+
+from domain_event_broker import DomainEvent, Retry, memory, settings
+from domain_event_broker.aio import AsyncPublisher, AsyncSubscriber
+from .helpers import delete_queue, get_queue_size
+
+requires_rabbitmq = pytest.mark.skipif(
+    settings.BROKER.startswith(memory.SCHEME),
+    reason="The in-memory broker doesn't support asyncio")
+
+
+@requires_rabbitmq
+def test_async_publish():
+    async def handle_event(event):
+        handle_event.messages.append(event.data['message'])
+    handle_event.messages = []
+
+    async def run():
+        name = 'test-async-publish'
+        subscriber = AsyncSubscriber()
+        await subscriber.register(handle_event, name, ['test.async-publish'])
+        async with AsyncPublisher() as publisher:
+            await publisher.publish_event(DomainEvent('test.async-publish', data))
+        await subscriber.start_consuming(timeout=1.0)
+
+    data = dict(message=str(uuid.uuid4())[:4])
+    asyncio.run(run())
+    assert handle_event.messages == [data['message']]
+    assert get_queue_size('test-async-publish') == 0
+
+
+@requires_rabbitmq
+def test_async_concurrency():
+    async def slow_handler(event):
+        slow_handler.running += 1
+        slow_handler.max_running = max(slow_handler.running, slow_handler.max_running)
+        await asyncio.sleep(0.2)
+        slow_handler.running -= 1
+    slow_handler.running = 0
+    slow_handler.max_running = 0
+
+    async def run():
+        name = 'test-async-concurrency'
+        subscriber = AsyncSubscriber(concurrency=5)
+        await subscriber.register(slow_handler, name, ['test.async-concurrency'])
+        async with AsyncPublisher() as publisher:
+            events = [DomainEvent('test.async-concurrency', {}) for _ in range(10)]
+            assert await publisher.publish_many(events) == [True] * 10
+        await subscriber.start_consuming(timeout=1.0)
+
+    delete_queue('test-async-concurrency')
+    asyncio.run(run())
+    assert slow_handler.max_running == 5
+    assert get_queue_size('test-async-concurrency') == 0
+
+
+@requires_rabbitmq
+def test_async_retry():
+    async def raise_retry(event):
+        raise_retry.received += 1
+        raise Retry(0.1)
+    raise_retry.received = 0
+
+    async def run():
+        name = 'test-async-retry'
+        subscriber = AsyncSubscriber()
+        await subscriber.register(raise_retry, name, ['test.async-retry'], max_retries=3)
+        async with AsyncPublisher() as publisher:
+            await publisher.publish_event(DomainEvent('test.async-retry', {}))
+        await subscriber.start_consuming(timeout=1.0)
+
+    delete_queue('test-async-retry')
+    asyncio.run(run())
+    assert raise_retry.received == 4
+    assert get_queue_size('test-async-retry') == 0
+
+
+def test_async_dummy_mode():
+    async def run():
+        publisher = AsyncPublisher(connection_settings=None)
+        await publisher.publish('{}', 'test.async-dummy')
+        assert await publisher.publish_many([DomainEvent('test.async-dummy')]) == [True]
+
+    asyncio.run(run())
@@ -0,0 +1,88 @@
+import pytest
+from unittest.mock import MagicMock
+
+from domain_event_broker import DomainEvent, Subscriber, publish_domain_event, settings
+from domain_event_broker.background import (
+    BackgroundPublisher, BufferFull, DROP_OLDEST, RAISE, get_background_publisher,
+    )
+from domain_event_broker import background
+from .helpers import delete_queue, get_queue_size
+
+
+def test_background_publish():
+    publisher = BackgroundPublisher(connection_settings=None, batch_size=10)
+    for index in range(25):
+        publisher.publish(DomainEvent('test.background', {'index': index}))
+    assert publisher.flush(timeout=5.0)
+    assert publisher.stats()['published'] == 25
+    assert publisher.stats()['queue_depth'] == 0
+    assert publisher.stop(timeout=1.0)
+    assert not publisher.thread.is_alive()
+
+
+def test_drop_oldest(monkeypatch):
+    publisher = BackgroundPublisher(connection_settings=None, max_size=2, overflow=DROP_OLDEST)
+    # Don't start the IO thread so that the buffer fills up
+    monkeypatch.setattr(publisher, '_ensure_thread', lambda: None)
+    for index in range(3):
+        publisher.publish(DomainEvent('test.background', {'index': index}))
+    assert [event.data['index'] for event in publisher.buffer] == [1, 2]
+    assert publisher.stats()['dropped'] == 1
+
+
+def test_raise_on_overflow(monkeypatch):
+    publisher = BackgroundPublisher(connection_settings=None, max_size=1, overflow=RAISE)
+    monkeypatch.setattr(publisher, '_ensure_thread', lambda: None)
+    publisher.publish(DomainEvent('test.background'))
+    with pytest.raises(BufferFull):
+        publisher.publish(DomainEvent('test.background'))
+
+
+def test_background_mode(monkeypatch):
+    name = 'test-background-mode'
+    delete_queue(name)
+    subscriber = Subscriber()
+    subscriber.register(lambda event: None, name, ['test.background-mode'])
+    monkeypatch.setattr(settings, 'BACKGROUND', True)
+    for _ in range(5):
+        publish_domain_event('test.background-mode', {})
+    assert get_background_publisher().flush(timeout=5.0)
+    assert get_queue_size(name) == 5
+    delete_queue(name)
+
+
+def test_retry_not_confirmed(monkeypatch):
+    # The broker nacks the first attempt of every event
+    attempts = []
+
+    def publish_batch():
+        batch = MagicMock()
+        batch.__enter__.return_value = batch
+        batch.results = [len(attempts) > 0] * 2
+        attempts.append(batch)
+        return batch
+
+    publisher_mock = MagicMock()
+    publisher_mock.return_value.publish_batch.side_effect = publish_batch
+    monkeypatch.setattr(background, 'Publisher', publisher_mock)
+    publisher = BackgroundPublisher(connection_settings=None, retry_delay=0.0)
+    publisher.publish(DomainEvent('test.background'))
+    publisher.publish(DomainEvent('test.background'))
+    assert publisher.stop(timeout=5.0)
+    assert publisher.stats()['published'] == 2
+    assert publisher.stats()['failed'] == 0
+    assert not publisher.attempts
+
+
+def test_reset_after_fork():
+    publisher = BackgroundPublisher(connection_settings=None)
+    publisher.buffer.append(DomainEvent('test.background'))
+    publisher.condition.acquire()
+    background._publishers_lock.acquire()
+    # A thread of the parent held the locks while forking
+    background._reset_background_publishers()
+    assert not background._publishers_lock.locked()
+    assert not publisher.buffer
+    publisher.publish(DomainEvent('test.background'))
+    assert publisher.stop(timeout=5.0)
+    assert publisher.stats()['published'] == 1
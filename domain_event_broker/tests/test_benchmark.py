@@ -0,0 +1,35 @@
+from domain_event_broker import DomainEvent, Publisher, benchmark, settings
+from .helpers import delete_queue, get_queue_size
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+    assert benchmark.percentile(values, 0.5) == 50.0
+    assert benchmark.percentile(values, 0.99) == 99.0
+    assert benchmark.percentile(values, 1.0) == 100.0
+    assert benchmark.percentile([], 0.5) is None
+
+
+def test_run():
+    report = benchmark.run('memory://test-benchmark', events=20)
+    names = {entry['name'] for entry in report['results']}
+    assert names == {'decode', 'publish', 'publish_domain_event', 'publish_batch', 'consume', 'retry', 'replay'}
+    for entry in report['results']:
+        assert entry['events'] > 0
+        assert entry['events_per_second'] > 0
+    consume = [entry for entry in report['results'] if entry['name'] == 'consume']
+    assert all(entry['p99_ms'] >= entry['p50_ms'] for entry in consume)
+
+
+def test_subscriber_drains():
+    # All events are acknowledged when consuming stops
+    name = 'test-benchmark-drain'
+    delete_queue(name)
+    subscriber = benchmark._subscriber(settings.BROKER, name, 5, lambda event: True, max_workers=4)
+    publisher = Publisher(settings.BROKER)
+    publisher.publish_many([DomainEvent(benchmark.ROUTING_KEY, {}) for _ in range(5)])
+    publisher.disconnect()
+    subscriber.start_consuming(timeout=5.0)
+    assert subscriber.in_flight == 0
+    assert get_queue_size(name) == 0
+    delete_queue(name)
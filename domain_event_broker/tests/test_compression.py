@@ -0,0 +1,63 @@
+from unittest.mock import patch
+import json
+import pytest
+
+from domain_event_broker import DomainEvent, compression, serializers
+from domain_event_broker.replay import EventFilter
+from domain_event_broker.transport import _load_event, _message
+
+
+@pytest.fixture
+def event():
+    return DomainEvent('test.compression', {'lines': ['line {}'.format(i) for i in range(5000)]})
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'deflate', 'zstd', 'lz4'])
+def test_round_trip(codec):
+    if codec not in compression._codecs:
+        pytest.skip("{} is not installed".format(codec))
+    body = json.dumps({'data': 'x' * 10000})
+    compressed, content_encoding = compression.compress(body, codec, threshold=1000)
+    assert content_encoding == codec
+    assert len(compressed) < len(body)
+    assert compression.decompress(compressed, content_encoding) == body.encode('utf-8')
+
+
+def test_threshold():
+    body = b'x' * 1000
+    assert compression.compress(body, 'gzip', threshold=1001) == (body, None)
+    assert compression.compress(body, 'gzip', threshold=1000)[1] == 'gzip'
+
+
+def test_disabled_by_default():
+    body = b'x' * 100000
+    assert compression.compress(body) == (body, None)
+
+
+def test_incompressible_body():
+    body = bytes(range(256))
+    assert compression.compress(body, 'gzip', threshold=0) == (body, None)
+
+
+def test_unknown_encoding():
+    assert compression.decompress(b'{}', 'utf-8') == b'{}'
+    assert compression.decompress(b'{}', None) == b'{}'
+    with pytest.raises(ValueError):
+        compression.compress(b'x' * 100, 'rar', threshold=0)
+
+
+@patch('domain_event_broker.settings.COMPRESSION', 'gzip')
+def test_compressed_message(event):
+    body, content_type = serializers.dumps(event.event_data)
+    compressed, properties = _message(body, content_type)
+    assert properties.content_encoding == 'gzip'
+    assert properties.delivery_mode == 2
+    properties.headers = None
+    assert _load_event(properties, compressed) == event
+    assert EventFilter(routing_key='test.*')('test.compression', compressed, properties) == event
+
+
+@patch('domain_event_broker.settings.COMPRESSION', 'gzip')
+def test_small_message_is_not_compressed():
+    _, properties = _message('{}', serializers.JSON)
+    assert properties.content_encoding is None
@@ -0,0 +1,103 @@
+import time
+import pytest
+
+from domain_event_broker import DomainEvent
+from domain_event_broker.deduplication import Deduplicator, MemoryBackend, RedisBackend, SQLiteBackend
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.values = {}
+
+    def exists(self, key):
+        return int(key in self.values)
+
+    def set(self, key, value, px=None):
+        self.values[key] = (value, px)
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_size=2)
+    backend.add('a', None)
+    backend.add('b', None)
+    assert backend.contains('a')
+    backend.add('c', None)
+    assert len(backend) == 2
+    assert backend.contains('a') and backend.contains('c')
+    assert not backend.contains('b')
+
+
+def test_memory_backend_expires_keys():
+    backend = MemoryBackend()
+    backend.add('a', 0.01)
+    assert backend.contains('a')
+    time.sleep(0.02)
+    assert not backend.contains('a')
+    assert len(backend) == 0
+
+
+def test_sqlite_backend(tmp_path):
+    path = str(tmp_path / 'events.db')
+    backend = SQLiteBackend(path, cleanup_interval=2)
+    backend.add('a', None)
+    backend.add('b', -1.0)
+    assert not backend.contains('b')
+    backend.close()
+    # Keys are shared with other processes through the file
+    backend = SQLiteBackend(path)
+    assert backend.contains('a')
+    assert not backend.contains('c')
+    # Expired keys were deleted on cleanup
+    assert backend.connection.execute('SELECT COUNT(*) FROM domain_event_keys').fetchone() == (1,)
+    backend.close()
+
+
+def test_redis_backend():
+    client = FakeRedis()
+    backend = RedisBackend(client)
+    backend.add('a', 1.5)
+    assert client.values == {'domain-event:a': (1, 1500)}
+    assert backend.contains('a')
+    assert not backend.contains('b')
+
+
+def test_deduplicator():
+    backend = MemoryBackend()
+    deduplicator = Deduplicator(backend, max_size=10)
+    event = DomainEvent('test.deduplicate', {})
+    assert not deduplicator.is_duplicate('handler', event)
+    deduplicator.remember('handler', event)
+    assert deduplicator.is_duplicate('handler', event)
+    # Events are kept apart per handler
+    assert not deduplicator.is_duplicate('other', event)
+    assert (deduplicator.hits, deduplicator.misses) == (1, 2)
+    # Events handled by other processes are found in the shared backend
+    other = Deduplicator(backend)
+    assert other.is_duplicate('handler', event)
+    assert len(other.cache) == 1
+
+
+def test_deduplicator_backend_failure():
+    class BrokenBackend(MemoryBackend):
+        def contains(self, key):
+            raise ConnectionError()
+
+        def add(self, key, ttl):
+            raise ConnectionError()
+
+    deduplicator = Deduplicator(BrokenBackend())
+    event = DomainEvent('test.deduplicate', {})
+    assert not deduplicator.is_duplicate('handler', event)
+    deduplicator.remember('handler', event)
+    # The in-process cache still works
+    assert deduplicator.is_duplicate('handler', event)
+
+
+@pytest.mark.parametrize('ttl', [None, 60.0])
+def test_deduplicator_ttl(ttl):
+    deduplicator = Deduplicator(ttl=ttl)
+    event = DomainEvent('test.deduplicate', {})
+    deduplicator.remember('handler', event)
+    expires = deduplicator.cache.keys[Deduplicator.key('handler', event)]
+    assert (expires is None) is (ttl is None)
@@ -23,3 +23,17 @@ class TestEvent(object):
         json_data, routing_key = mock.call_args[0]
         new_event = DomainEvent.from_json(json_data)
         assert new_event == event
+
+
+def test_event_data():
+    event = DomainEvent('test.test', {'a': 1}, domain_object_id='42', retries=3)
+    assert not hasattr(event, '__dict__')
+    assert event.event_data == {
+        'routing_key': 'test.test',
+        'data': {'a': 1},
+        'domain_object_id': '42',
+        'uuid_string': event.uuid_string,
+        'timestamp': event.timestamp,
+    }
+    assert event.event_data is event.event_data
+    assert DomainEvent(**event.event_data) == event
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import pytest
+
+import domain_event_broker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules that a process publishing events shouldn't load at import time
+HEAVY_MODULES = ['pika', 'concurrent.futures', 'domain_event_broker.transport', 'domain_event_broker.replay']
+
+
+def run(code):
+    return subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+def loaded_modules(code):
+    return set(run(code + '\nimport sys\nprint(" ".join(sys.modules))').stdout.split())
+
+
+@pytest.mark.parametrize('code', [
+    'import domain_event_broker',
+    'from domain_event_broker import DomainEvent, publish_domain_event',
+])
+def test_lazy_import(code):
+    modules = loaded_modules(code)
+    assert not modules.intersection(HEAVY_MODULES)
+
+
+def test_public_api():
+    for name in domain_event_broker.__all__:
+        assert getattr(domain_event_broker, name) is not None
+    assert 'Subscriber' in dir(domain_event_broker)
+    with pytest.raises(AttributeError):
+        domain_event_broker.missing
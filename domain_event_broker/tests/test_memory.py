@@ -0,0 +1,145 @@
+from pika import BasicProperties
+from pika.exceptions import ChannelClosedByBroker
+import pytest
+import time
+
+from domain_event_broker import Publisher, Retry, Subscriber, memory
+from domain_event_broker.memory import topic_matches
+
+BROKER = 'test-memory'
+URL = memory.SCHEME + BROKER
+
+
+@pytest.fixture
+def channel():
+    memory.reset(BROKER)
+    connection = memory.connect(URL)
+    yield connection.channel()
+    if connection.is_open:
+        connection.close()
+    memory.reset(BROKER)
+
+
+@pytest.mark.parametrize('binding_key, routing_key, matches', [
+    ('user.registered', 'user.registered', True),
+    ('user.*', 'user.registered', True),
+    ('user.*', 'user', False),
+    ('user.*', 'user.registered.email', False),
+    ('*.registered', 'user.registered', True),
+    ('user.#', 'user', True),
+    ('user.#', 'user.registered.email', True),
+    ('#.email', 'user.registered.email', True),
+    ('#', 'user.registered', True),
+    ('user.#.email', 'user.email', True),
+    ('user.#.email', 'user.registered.email', True),
+    ('user.#.email', 'user.registered.sms', False),
+    ('#.*.email', 'email', False),
+    ('order.*', 'user.registered', False),
+])
+def test_topic_matches(binding_key, routing_key, matches):
+    assert topic_matches(binding_key, routing_key) is matches
+
+
+def test_topic_routing(channel):
+    channel.exchange_declare('events', exchange_type='topic')
+    channel.queue_declare('users')
+    channel.queue_declare('all')
+    channel.queue_bind('users', 'events', routing_key='user.*')
+    channel.queue_bind('all', 'events', routing_key='#')
+    channel.queue_bind('all', 'events', routing_key='user.#')
+    channel.basic_publish('events', 'user.registered', b'1')
+    channel.basic_publish('events', 'order.placed', b'2')
+    assert channel.queue_declare('users', passive=True).method.message_count == 1
+    # Matching several bindings routes a message to a queue once
+    assert channel.queue_declare('all', passive=True).method.message_count == 2
+
+
+def test_missing_queue_closes_channel(channel):
+    with pytest.raises(ChannelClosedByBroker) as error:
+        channel.queue_declare('missing', passive=True)
+    assert error.value.args[0] == 404
+    assert channel.is_closed
+
+
+def test_exclusive_queue(channel):
+    channel.queue_declare('private', exclusive=True)
+    other = memory.connect(URL)
+    with pytest.raises(ChannelClosedByBroker) as error:
+        other.channel().queue_declare('private', exclusive=True)
+    assert error.value.args[0] == 405
+    channel.connection.close()
+    # Exclusive queues are deleted with their connection
+    assert 'private' not in memory.get_broker(BROKER).queues
+    other.close()
+
+
+def test_message_ttl_dead_letters(channel):
+    channel.exchange_declare('retry', exchange_type='topic')
+    channel.queue_declare('work')
+    channel.queue_bind('work', 'retry', routing_key='#')
+    channel.queue_declare('delay', arguments={'x-message-ttl': 10, 'x-dead-letter-exchange': 'retry'})
+    for _ in range(2):
+        channel.basic_publish('', 'delay', b'data', BasicProperties(headers={'id': 1}))
+        time.sleep(0.02)
+        method, properties, body = channel.basic_get('work')
+        channel.basic_ack(method.delivery_tag)
+    assert body == b'data'
+    assert method.routing_key == 'delay'
+    assert properties.headers['id'] == 1
+    death = properties.headers['x-death'][0]
+    assert (death['queue'], death['reason'], death['count']) == ('delay', 'expired', 1)
+
+
+def test_reject_and_requeue(channel):
+    channel.queue_declare('dl')
+    channel.queue_declare('work', arguments={'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': 'dl'})
+    channel.basic_publish('', 'work', b'1')
+    channel.basic_publish('', 'work', b'2')
+    first, _, _ = channel.basic_get('work')
+    second, _, _ = channel.basic_get('work')
+    channel.basic_nack(0, multiple=True, requeue=True)
+    method, _, body = channel.basic_get('work')
+    assert body == b'1' and method.redelivered
+    channel.basic_reject(method.delivery_tag, requeue=False)
+    _, properties, body = channel.basic_get('dl')
+    assert body == b'1'
+    assert properties.headers['x-death'][0]['reason'] == 'rejected'
+    with pytest.raises(ChannelClosedByBroker):
+        channel.basic_ack(first.delivery_tag)
+    # Closing the channel requeued the second message
+    assert channel.connection.channel().queue_declare('work', passive=True).method.message_count == 1
+
+
+def test_prefetch(channel):
+    channel.queue_declare('work')
+    for index in range(5):
+        channel.basic_publish('', 'work', str(index))
+    received = []
+    channel.basic_qos(prefetch_count=2)
+    channel.basic_consume('work', lambda channel, method, properties, body: received.append(method))
+    channel.connection.process_data_events()
+    assert len(received) == 2
+    channel.basic_ack(received[-1].delivery_tag, multiple=True)
+    channel.connection.process_data_events()
+    assert len(received) == 4
+
+
+def test_subscriber_retry():
+    memory.reset(BROKER)
+    handled = []
+
+    def handle(event):
+        handled.append(event.retries)
+        if event.retries < 2:
+            raise Retry(0.01)
+
+    subscriber = Subscriber(URL)
+    subscriber.register(handle, 'test-memory-retry', ['test.memory'], max_retries=3)
+    publisher = Publisher(URL)
+    with publisher.publish_batch() as batch:
+        batch.publish('{"routing_key": "test.memory", "data": {}}', 'test.memory')
+    assert batch.results == [True]
+    publisher.disconnect()
+    subscriber.start_consuming(timeout=0.3)
+    assert handled == [0, 1, 2]
+    memory.reset(BROKER)
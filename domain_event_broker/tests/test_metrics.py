@@ -0,0 +1,101 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+import json
+import socket
+import pytest
+
+from domain_event_broker import DomainEvent, Retry, metrics
+from domain_event_broker.deduplication import Deduplicator
+from domain_event_broker.transport import receive_callback
+
+
+@pytest.fixture
+def recorded():
+    recorded = []
+    metrics.set_sink(metrics.CallbackSink(lambda *args: recorded.append(args)))
+    yield recorded
+    metrics.set_sink(None)
+
+
+def receive(handler, body, deduplicator=None):
+    channel = Mock()
+    channel.connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+    transport = Mock(unsettled=0)
+    workers = ThreadPoolExecutor(max_workers=1)
+    receive_callback(transport, handler, 'test-metrics', 'test-metrics-retry', 3, channel,
+                     Mock(delivery_tag=1, routing_key='test.metrics'),
+                     Mock(headers=None, content_type=None, content_encoding=None),
+                     body, workers=workers, deduplicator=deduplicator)
+    workers.shutdown()
+
+
+def names(recorded):
+    return [name for _, name, _, _ in recorded]
+
+
+def test_consume_metrics(recorded):
+    receive(lambda event: None, json.dumps(DomainEvent('test.metrics', {}).event_data))
+    assert names(recorded) == [
+        metrics.RECEIVED, metrics.DECODE_SECONDS, metrics.LAG_SECONDS, metrics.IN_FLIGHT,
+        metrics.HANDLER_SECONDS, metrics.HANDLED, metrics.IN_FLIGHT]
+    assert recorded[0] == (metrics.COUNTER, metrics.RECEIVED,
+                           {'handler': 'test-metrics', 'routing_key': 'test.metrics'}, 1.0)
+    assert recorded[5][2]['outcome'] == metrics.ACK
+    assert sum(value for kind, _, _, value in recorded if kind == metrics.GAUGE) == 0
+
+
+def test_retry_outcome(recorded):
+    def handle(event):
+        raise Retry(0.1)
+    receive(handle, json.dumps(DomainEvent('test.metrics', {}).event_data))
+    handled = [labels for _, name, labels, _ in recorded if name == metrics.HANDLED]
+    assert handled[0]['outcome'] == metrics.RETRY
+    assert metrics.RETRY_SECONDS in names(recorded)
+
+
+def test_duplicate_outcome(recorded):
+    deduplicator = Deduplicator()
+    body = json.dumps(DomainEvent('test.metrics', {}).event_data)
+    for _ in range(2):
+        receive(lambda event: None, body, deduplicator)
+    handled = [labels['outcome'] for _, name, labels, _ in recorded if name == metrics.HANDLED]
+    assert handled == [metrics.ACK, metrics.DUPLICATE]
+    assert sum(value for kind, _, _, value in recorded if kind == metrics.GAUGE) == 0
+
+
+def test_decode_error(recorded):
+    receive(lambda event: None, b'invalid')
+    assert recorded == [(metrics.COUNTER, metrics.DECODE_ERRORS, {'handler': 'test-metrics'}, 1.0)]
+
+
+def test_disabled():
+    handled = []
+    receive(handled.append, json.dumps(DomainEvent('test.metrics', {}).event_data))
+    assert metrics.sink is None
+    assert len(handled) == 1
+
+
+def test_statsd_sink():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(1.0)
+    sink = metrics.StatsdSink('127.0.0.1', server.getsockname()[1], prefix='app')
+    sink.increment(metrics.PUBLISHED, {'routing_key': 'user.registered'})
+    assert server.recv(1024) == b'app.domain_event_published_total.user_registered:1|c'
+    sink.tags = True
+    sink.observe(metrics.PUBLISH_SECONDS, {'routing_key': 'user.registered'}, 0.0125)
+    assert server.recv(1024) == b'app.domain_event_publish_seconds:12.500|ms|#routing_key:user.registered'
+    sink.adjust(metrics.IN_FLIGHT, {'handler': 'mail'}, -1)
+    assert server.recv(1024) == b'app.domain_event_in_flight:-1|g|#handler:mail'
+    server.close()
+
+
+def test_prometheus_sink():
+    prometheus_client = pytest.importorskip('prometheus_client')
+    registry = prometheus_client.CollectorRegistry()
+    sink = metrics.PrometheusSink(registry)
+    sink.increment(metrics.PUBLISHED, {'routing_key': 'user.registered'})
+    sink.observe(metrics.PUBLISH_SECONDS, {'routing_key': 'user.registered'}, 0.01)
+    labels = {'routing_key': 'user.registered'}
+    assert registry.get_sample_value('domain_event_published_total', labels) == 1.0
+    assert registry.get_sample_value('domain_event_publish_seconds_count', labels) == 1.0
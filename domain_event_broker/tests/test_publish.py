@@ -1,8 +1,19 @@
-from domain_event_broker import publish_domain_event, Subscriber
-from .helpers import check_queue_exists, get_queue_size
+from domain_event_broker import (
+    DomainEvent, Publisher, PublisherPool, Subscriber, get_publisher_pool, publish_domain_event,
+    )
+from domain_event_broker import transport
+from domain_event_broker.serializers import JSON
+from .helpers import check_queue_exists, delete_queue, get_message_from_queue, get_queue_size
+from unittest.mock import Mock, patch
+from pika.exceptions import ChannelClosedByBroker
+import pytest
 import uuid
 
 
+def nop(event):
+    pass
+
+
 def test_publish():
     def handle_event(event):
         handle_event.message = event.data['message']
@@ -27,3 +38,132 @@ def test_dummy_mode():
     publish_domain_event('test.publish-dummy', {}, connection_settings=None)
     subscriber.start_consuming(timeout=1.0)
     assert not check_queue_exists(name)
+
+
+def test_pooled_connection_is_reused():
+    pool = get_publisher_pool()
+    with pool.acquire() as publisher:
+        connection = publisher.connection
+    publish_domain_event('test.pool', {})
+    with pool.acquire() as publisher:
+        assert publisher.connection is connection
+
+
+def test_pool_reconnects_lost_connection():
+    pool = get_publisher_pool()
+    with pool.acquire() as publisher:
+        publisher.connection.close()
+    name = 'test-pool-reconnect'
+    subscriber = Subscriber()
+    subscriber.register(nop, name, ['test.pool-reconnect'])
+    publish_domain_event('test.pool-reconnect', {})
+    assert get_queue_size(name) == 1
+    delete_queue(name)
+
+
+def test_publish_many():
+    name = 'test-publish-many'
+    delete_queue(name)
+    subscriber = Subscriber()
+    subscriber.register(nop, name, ['test.publish-many'])
+    events = [DomainEvent('test.publish-many', {'index': index}) for index in range(10)]
+    publisher = Publisher()
+    assert publisher.publish_many(events) == [True] * 10
+    publisher.disconnect()
+    assert get_queue_size(name) == 10
+    delete_queue(name)
+
+
+def test_publish_batch_timeout():
+    publisher = Publisher()
+    with publisher.publish_batch(timeout=0) as batch:
+        batch.publish('{}', 'test.publish-timeout')
+    # Messages are not published once the batch timed out
+    assert batch.results == [False]
+    publisher.disconnect()
+
+
+def test_confirm_channel_commit_failed():
+    connection = Mock()
+    channel = connection.channel.return_value
+    channel.tx_commit.side_effect = ChannelClosedByBroker(406, 'PRECONDITION_FAILED')
+    confirm_channel = transport._ConfirmChannel(connection)
+    channel.tx_select.assert_called_once_with()
+    results = []
+    confirm_channel.publish('domain-events', 'test.nack', b'{}', None, results.append)
+    with pytest.raises(ChannelClosedByBroker):
+        confirm_channel.wait(lambda: True)
+    assert results == [False]
+
+
+def test_publish_batch_single_wait():
+    # Messages of a batch are sent without waiting and confirmed at once
+    publisher = Publisher()
+    confirm_channel = publisher.get_confirm_channel()
+    channel = confirm_channel.channel = Mock(wraps=confirm_channel.channel)
+    with publisher.publish_batch() as batch:
+        for index in range(3):
+            batch.publish('{}', 'test.single-wait')
+        assert channel.basic_publish.call_count == 3
+        assert not channel.tx_commit.called
+    assert channel.tx_commit.call_count == 1
+    assert batch.results == [True] * 3
+    publisher.disconnect()
+
+
+def test_publish_content_type():
+    pytest.importorskip('orjson')
+    name = 'test-publish-content-type'
+    delete_queue(name)
+    subscriber = Subscriber()
+    subscriber.register(nop, name, ['test.content-type'])
+    with patch('domain_event_broker.settings.SERIALIZER', 'orjson'):
+        event = publish_domain_event('test.content-type', {'message': 'hello'})
+    header, received = get_message_from_queue(name)
+    assert header.content_type == JSON
+    assert received == event
+    delete_queue(name)
+
+
+@patch('domain_event_broker.settings.COMPRESSION', 'gzip')
+def test_publish_compressed():
+    def handle_event(event):
+        handle_event.data = event.data
+    handle_event.data = None
+    name = 'test-publish-compressed'
+    subscriber = Subscriber()
+    subscriber.register(handle_event, name, ['test.publish-compressed'])
+    data = {'text': 'domain event ' * 10000}
+    publish_domain_event('test.publish-compressed', data)
+    subscriber.start_consuming(timeout=1.0)
+    assert handle_event.data == data
+
+
+def test_publish_batch_dummy_mode():
+    publisher = Publisher(connection_settings=None)
+    with publisher.publish_batch() as batch:
+        batch.publish('{}', 'test.publish-dummy')
+    assert batch.results == [True]
+
+
+def test_reset_pools_after_fork():
+    pool = PublisherPool(None)
+    pool.lock.acquire()
+    transport._pools_lock.acquire()
+    # A thread of the parent held the locks while forking
+    transport._reset_publisher_pools()
+    assert not transport._pools_lock.locked()
+    assert not pool.lock.locked()
+    with pool.acquire() as publisher:
+        assert publisher.connection is None
+
+
+def test_blocked_connection_timeout(monkeypatch):
+    # Only publishers give up on connections blocked by the broker
+    connection_mock = Mock()
+    monkeypatch.setattr(transport, 'BlockingConnection', connection_mock)
+    transport._connect('amqp://localhost', transport.CONFIRM_TIMEOUT)
+    assert connection_mock.call_args[0][0].blocked_connection_timeout == transport.CONFIRM_TIMEOUT
+    transport._connect('amqp://localhost')
+    assert connection_mock.call_args[0][0].blocked_connection_timeout is None
+    assert Subscriber.blocked_connection_timeout is None
@@ -1,5 +1,13 @@
-from domain_event_broker import replay_event, Subscriber, DISCARD, LEAVE
-from .helpers import get_message_from_queue, get_queue_size
+import json
+from domain_event_broker import (
+    replay_all, replay_event, replay_queue, publish_domain_event, scan, DomainEvent, EventFilter,
+    Subscriber, DISCARD, LEAVE, RETRY,
+    )
+from .helpers import delete_queue, get_message_from_queue, get_queue_size
+
+
+def raise_error(event):
+    raise ValueError("Unexpected error")
 
 
 def test_replay(dead_letter_message):
@@ -40,3 +48,67 @@ def test_empty_queue():
     subscriber = Subscriber()
     subscriber.register(nop, name, ['test.empty'], dead_letter=True)
     assert replay_event('test-empty-queue') == 0
+
+
+def test_replay_queue():
+    name = 'test-replay-queue'
+    delete_queue(name)
+    delete_queue(name + '-dl')
+    subscriber = Subscriber()
+    subscriber.register(raise_error, name, ['test.replay-queue'], dead_letter=True)
+    for index in range(25):
+        publish_domain_event('test.replay-queue', {'index': index})
+    subscriber.start_consuming(timeout=1.0)
+    assert get_queue_size(name + '-dl') == 25
+
+    progress = []
+    stats = replay_queue(name, batch_size=10, progress=progress.append)
+    assert stats.retried == 25
+    assert stats.remaining == 0
+    assert len(progress) == 3
+    assert get_queue_size(name + '-dl') == 0
+    assert get_queue_size(name) == 25
+    delete_queue(name)
+    delete_queue(name + '-dl')
+
+
+def test_replay_all_leave(dead_letter_message):
+    assert replay_all('test-replay', message_callback=leave) == 1
+    assert get_queue_size('test-replay') == 0
+
+
+def test_event_filter():
+    event = DomainEvent('user.registered', {'user': {'country': 'DE'}, 'tags': ['a']},
+                        domain_object_id='42', timestamp=1000.0)
+    body = json.dumps(event.event_data)
+    assert EventFilter()('user.registered', body) == event
+    assert EventFilter(routing_key='user.*')('user.registered', body) == event
+    assert EventFilter(routing_key='order.*')('user.registered', body) is None
+    assert EventFilter(domain_object_id='43')('user.registered', body) is None
+    assert EventFilter(since=1000.0, until=1001.0)('user.registered', body) == event
+    assert EventFilter(until=1000.0)('user.registered', body) is None
+    assert EventFilter(match={'data.user.country': 'DE', 'data.tags.0': 'a'})('user.registered', body) == event
+    assert EventFilter(match={'data.user.missing': None})('user.registered', body) is None
+    assert EventFilter()('user.registered', 'iamnotvalidjson[]') is None
+
+
+def test_scan():
+    name = 'test-scan'
+    delete_queue(name)
+    delete_queue(name + '-dl')
+    subscriber = Subscriber()
+    subscriber.register(raise_error, name, ['test.scan.*'], dead_letter=True)
+    for index in range(10):
+        publish_domain_event('test.scan.even' if index % 2 == 0 else 'test.scan.odd', {'index': index})
+    subscriber.start_consuming(timeout=1.0)
+
+    events = list(scan(name, routing_key='test.scan.even', prefetch_count=3))
+    assert [event.data['index'] for event in events] == [0, 2, 4, 6, 8]
+    assert get_queue_size(name + '-dl') == 10
+
+    events = list(scan(name, match={'data.index': 3}, action=RETRY))
+    assert len(events) == 1
+    assert get_queue_size(name + '-dl') == 9
+    assert get_queue_size(name) == 1
+    delete_queue(name)
+    delete_queue(name + '-dl')
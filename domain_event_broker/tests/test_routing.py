@@ -0,0 +1,47 @@
+import pytest
+
+from domain_event_broker.routing import RoutingTrie
+
+
+@pytest.mark.parametrize('binding_key, routing_key, matches', [
+    ('user.registered', 'user.registered', True),
+    ('user.*', 'user.registered', True),
+    ('user.*', 'user', False),
+    ('user.*', 'user.registered.email', False),
+    ('*.registered', 'user.registered', True),
+    ('user.#', 'user', True),
+    ('user.#', 'user.registered.email', True),
+    ('#.email', 'user.registered.email', True),
+    ('#', 'user.registered', True),
+    ('user.#.email', 'user.email', True),
+    ('user.#.email', 'user.registered.sms', False),
+    ('#.*.email', 'email', False),
+    ('order.*', 'user.registered', False),
+])
+def test_match(binding_key, routing_key, matches):
+    routes = RoutingTrie()
+    routes.add(binding_key, 'handler')
+    assert routes.match(routing_key) == (['handler'] if matches else [])
+
+
+def test_match_order_and_duplicates():
+    routes = RoutingTrie()
+    routes.add('#', 'audit')
+    routes.add('user.registered', 'mail')
+    routes.add('user.*', 'mail')
+    routes.add('user.#', 'stats')
+    assert routes.match('user.registered') == ['audit', 'mail', 'stats']
+    assert routes.match('user.deleted.hard') == ['audit', 'stats']
+
+
+def test_cache():
+    routes = RoutingTrie(cache_size=2)
+    routes.add('user.*', 'mail')
+    assert routes.match('user.registered') == ['mail']
+    assert 'user.registered' in routes.cache
+    # Adding a binding key invalidates the cached lookups
+    routes.add('user.registered', 'stats')
+    assert routes.match('user.registered') == ['mail', 'stats']
+    for routing_key in ('user.a', 'user.b', 'user.c'):
+        routes.match(routing_key)
+    assert len(routes.cache) <= 2
@@ -0,0 +1,55 @@
+from unittest.mock import Mock, patch
+import pytest
+
+from domain_event_broker import DomainEvent, serializers
+from domain_event_broker.replay import EventFilter
+from domain_event_broker.transport import _load_event
+
+
+@pytest.fixture
+def event():
+    return DomainEvent('test.serializer', {'message': 'hello', 'count': 1}, domain_object_id='42')
+
+
+def test_default_serializer(event):
+    body, content_type = serializers.dumps(event.event_data)
+    assert content_type == serializers.JSON
+    assert serializers.loads(body, content_type) == event.event_data
+
+
+def test_messages_without_content_type_are_json(event):
+    body, _ = serializers.dumps(event.event_data)
+    assert serializers.loads(body) == event.event_data
+    assert serializers.loads(body, '') == event.event_data
+
+
+@pytest.mark.parametrize('name', ['orjson', 'msgpack'])
+def test_optional_serializer(event, name):
+    pytest.importorskip(name)
+    with patch('domain_event_broker.settings.SERIALIZER', name):
+        body, content_type = serializers.dumps(event.event_data)
+    # Subscribers configured with the default serializer decode it as well
+    assert serializers.loads(body, content_type) == event.event_data
+
+
+def test_configured_serializer_decodes_json(event):
+    pytest.importorskip('orjson')
+    body, content_type = serializers.dumps(event.event_data)
+    with patch('domain_event_broker.settings.SERIALIZER', 'orjson'):
+        assert serializers.get_decoder(content_type).name == 'orjson'
+        assert serializers.loads(body, content_type) == event.event_data
+
+
+def test_unknown_serializer():
+    with pytest.raises(ValueError):
+        serializers.get_serializer('pickle')
+    with pytest.raises(ValueError):
+        serializers.get_decoder('application/x-pickle')
+
+
+def test_load_event_uses_content_type(event):
+    pytest.importorskip('orjson')
+    body, content_type = serializers.dumps(event.event_data, 'orjson')
+    properties = Mock(content_type=content_type, headers=None)
+    assert _load_event(properties, body) == event
+    assert EventFilter(domain_object_id='42')('test.serializer', body, properties) == event
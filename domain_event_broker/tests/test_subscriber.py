@@ -1,5 +1,16 @@
+from functools import partial
 from time import sleep
-from domain_event_broker import Publisher, Subscriber, Retry, publish_domain_event
+import time
+import json
+import pytest
+from unittest.mock import Mock
+from pika.exceptions import AMQPConnectionError, ChannelClosedByBroker, ConnectionWrongStateError
+from domain_event_broker import (
+    BatchError, DomainEvent, Publisher, Subscriber, Retry, publish_domain_event, replay_queue,
+    )
+from domain_event_broker import transport
+from domain_event_broker.deduplication import Deduplicator
+from domain_event_broker.transport import OrderedExecutor
 from .helpers import (
     check_queue_exists, delete_queue, get_message_from_queue, get_queue_size,
     )
@@ -136,3 +147,354 @@ def test_long_running_consumer():
     subscriber.start_consuming(timeout=5.0)
     assert get_queue_size(name) == 0
     assert slow_nop.finished == 1
+
+
+def test_parallel_workers():
+    # Five slow events finish within the timeout only if they are processed
+    # in parallel.
+    name = 'test-parallel-workers'
+    delete_queue(name)
+
+    def slow_nop(event):
+        sleep(0.5)
+        slow_nop.finished += 1
+
+    slow_nop.finished = 0
+    subscriber = Subscriber(max_workers=5)
+    subscriber.register(slow_nop, name, ['test.parallel'])
+    for _ in range(5):
+        publish_domain_event('test.parallel', {})
+    subscriber.start_consuming(timeout=1.0)
+    assert slow_nop.finished == 5
+    assert get_queue_size(name) == 0
+
+
+def test_handler_concurrency():
+    name = 'test-handler-concurrency'
+    delete_queue(name)
+
+    def slow_nop(event):
+        sleep(0.5)
+        slow_nop.finished += 1
+
+    slow_nop.finished = 0
+    subscriber = Subscriber()
+    subscriber.register(slow_nop, name, ['test.concurrency'], concurrency=5)
+    for _ in range(5):
+        publish_domain_event('test.concurrency', {})
+    subscriber.start_consuming(timeout=1.0)
+    assert slow_nop.finished == 5
+    assert get_queue_size(name) == 0
+
+
+def test_ordered_executor():
+    executor = OrderedExecutor(4)
+    handled = []
+
+    def handle(event):
+        sleep(0.01 if event.data['index'] % 2 else 0)
+        handled.append((event.domain_object_id, event.data['index']))
+
+    for index in range(20):
+        event = DomainEvent('test.ordered', {'index': index}, domain_object_id=str(index % 3))
+        executor.submit_event(event, partial(handle, event))
+    executor.shutdown()
+    for key in ('0', '1', '2'):
+        indices = [index for object_id, index in handled if object_id == key]
+        assert indices == sorted(indices)
+    assert len(handled) == 20
+
+
+def test_ordered_dispatch():
+    name = 'test-ordered-dispatch'
+    delete_queue(name)
+
+    def handle(event):
+        sleep(0.05)
+        handle.received.append((event.domain_object_id, event.data['index']))
+    handle.received = []
+
+    subscriber = Subscriber(max_workers=4)
+    subscriber.register(handle, name, ['test.ordered'], ordered=True)
+    for index in range(12):
+        publish_domain_event('test.ordered', {'index': index}, domain_object_id=str(index % 4))
+    subscriber.start_consuming(timeout=1.0)
+    assert len(handle.received) == 12
+    for key in ('0', '1', '2', '3'):
+        indices = [index for object_id, index in handle.received if object_id == key]
+        assert indices == sorted(indices)
+
+
+def test_ordered_subscriber_handler_concurrency():
+    # Handlers with workers of their own inherit the ordering of the subscriber
+    name = 'test-ordered-concurrency'
+    delete_queue(name)
+
+    def handle(event):
+        sleep(0.05 if event.data['index'] % 2 else 0)
+        handle.received.append((event.domain_object_id, event.data['index']))
+    handle.received = []
+
+    subscriber = Subscriber(max_workers=1, ordered=True)
+    subscriber._create_workers = Mock(wraps=subscriber._create_workers)
+    subscriber.register(handle, name, ['test.ordered-concurrency'], concurrency=4)
+    subscriber._create_workers.assert_called_once_with(4, True)
+    for index in range(12):
+        publish_domain_event('test.ordered-concurrency', {'index': index}, domain_object_id=str(index % 3))
+    subscriber.start_consuming(timeout=1.0)
+    assert len(handle.received) == 12
+    for key in ('0', '1', '2'):
+        indices = [index for object_id, index in handle.received if object_id == key]
+        assert indices == sorted(indices)
+
+
+def test_retry_declares_delay_queue_once():
+    calls = Mock()
+    calls.queue_declare.return_value.method.queue = 'test-cache-delay-100'
+    method = Mock(routing_key='test.cache')
+    for _ in range(3):
+        transport._retry_message('test-cache', 'test-cache-retry', calls, method, None, '{}', 0.1)
+    assert calls.queue_declare.call_count == 1
+    assert calls.basic_publish.call_count == 3
+    # The declaration is renewed before the queue can expire
+    transport._delay_queues[calls]['test-cache-delay-100'] = 0.0
+    transport._retry_message('test-cache', 'test-cache-retry', calls, method, None, '{}', 0.1)
+    assert calls.queue_declare.call_count == 2
+
+
+def test_batch_collector_settles_with_multiple_ack():
+    channel = Mock()
+    channel.connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+    channel.queue_declare.return_value.method.queue = 'test-batch-delay-100'
+
+    def handle(events):
+        return {1: Retry(0.1), 2: ConsumerError()}
+
+    collector = transport._BatchCollector(handle, 'test-batch', 'test-batch-retry', 3, 4, 1.0)
+    collector.attach(channel)
+    for tag in range(1, 5):
+        event = DomainEvent('test.batch', {'index': tag})
+        properties = Mock(headers=None, content_type=None, content_encoding=None)
+        collector.receive(channel, Mock(delivery_tag=tag, routing_key='test.batch'), properties,
+                          json.dumps(event.event_data))
+    collector.workers.shutdown()
+    assert collector.unsettled == 0
+    channel.basic_reject.assert_called_once_with(delivery_tag=3, requeue=False)
+    channel.basic_ack.assert_called_once_with(delivery_tag=4, multiple=True)
+    assert channel.basic_publish.call_count == 1
+
+
+def test_resubscribe_after_connection_loss(monkeypatch):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAY', 0.01)
+    subscriber = Subscriber(connection_settings=None, reconnect=True)
+    subscriber.reconnect = Mock(side_effect=[AMQPConnectionError(), None])
+    subscribe = Mock()
+    subscriber.registrations.append(subscribe)
+    subscriber.unsettled = 2
+    subscriber._resubscribe()
+    assert subscriber.reconnect.call_count == 2
+    subscribe.assert_called_once_with()
+    assert subscriber.failed_reconnects == 1
+    assert subscriber.reconnects == 1
+    # Deliveries of the lost connection are redelivered by the broker
+    assert subscriber.unsettled == 0
+
+
+def test_resubscribe_gives_up(monkeypatch):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAY', 0.01)
+    subscriber = Subscriber(connection_settings=None, reconnect=True)
+    subscriber.reconnect = Mock(side_effect=AMQPConnectionError())
+    # The deadline of ``start_consuming`` bounds the attempts
+    assert not subscriber._resubscribe(deadline=time.monotonic() + 0.1)
+    assert subscriber.reconnect.call_count >= 1
+    # A stopped subscriber doesn't reconnect at all
+    subscriber.reconnect.reset_mock()
+    subscriber.stopping.set()
+    assert not subscriber._resubscribe()
+    assert not subscriber.reconnect.called
+
+
+def test_resubscribe_permanent_error(monkeypatch):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAY', 0.01)
+    subscriber = Subscriber(connection_settings=None, reconnect=True)
+    subscriber.reconnect = Mock()
+    subscribe = Mock(side_effect=ChannelClosedByBroker(406, 'PRECONDITION_FAILED - inequivalent arg'))
+    subscriber.registrations.append(subscribe)
+    # A queue declared with different arguments fails the same way every time
+    with pytest.raises(ChannelClosedByBroker):
+        subscriber._resubscribe(deadline=time.monotonic() + 5.0)
+    assert subscriber.reconnect.call_count == 1
+    assert subscriber.failed_reconnects == 0
+
+
+def test_callback_on_closed_connection():
+    # Workers of a lost connection can't settle their events anymore
+    connection = Mock()
+    connection.add_callback_threadsafe.side_effect = ConnectionWrongStateError()
+    acknowledge = Mock()
+    transport._call_event_handler(nop, DomainEvent('test.closed'), connection, acknowledge, Mock(), Mock(), 0)
+    assert not acknowledge.called
+
+
+def test_register_batch():
+    name = 'test-register-batch'
+    delete_queue(name)
+
+    def handle(events):
+        handle.batches.append(len(events))
+        if any(event.data['index'] == 3 for event in events):
+            raise BatchError({index: ConsumerError() for index, event in enumerate(events)
+                              if event.data['index'] == 3})
+    handle.batches = []
+
+    subscriber = Subscriber()
+    subscriber.register_batch(handle, name, ['test.register-batch'],
+                              max_batch_size=5, max_wait=0.1, dead_letter=True)
+    publisher = Publisher()
+    publisher.publish_many([DomainEvent('test.register-batch', {'index': index}) for index in range(7)])
+    publisher.disconnect()
+    subscriber.start_consuming(timeout=1.0)
+    assert handle.batches == [5, 2]
+    assert get_queue_size(name) == 0
+    assert get_queue_size(name + '-dl') == 1
+    delete_queue(name)
+    delete_queue(name + '-dl')
+
+
+def test_drain():
+    name = 'test-drain'
+    delete_queue(name)
+
+    def handle(event):
+        sleep(0.5)
+        handle.handled += 1
+    handle.handled = 0
+
+    subscriber = Subscriber(max_workers=2)
+    subscriber.register(handle, name, ['test.drain'])
+    for _ in range(2):
+        publish_domain_event('test.drain', {})
+
+    def drain():
+        drain.in_flight = subscriber.in_flight
+        subscriber.drain(timeout=5.0)
+
+    subscriber.connection.call_later(0.2, drain)
+    subscriber.start_consuming()
+    assert drain.in_flight == 2
+    assert handle.handled == 2
+    assert subscriber.in_flight == 0
+    assert subscriber.connection is None
+    # Both events were acknowledged before disconnecting
+    assert get_queue_size(name) == 0
+    delete_queue(name)
+
+
+def test_shared_queue():
+    name = 'test-shared'
+    for queue in (name, name + '-dl'):
+        delete_queue(queue)
+    received = []
+
+    def handler(key):
+        def handle(event):
+            received.append((key, event.routing_key, event.retries))
+            if key == 'retry' and event.retries < 1:
+                raise Retry(0.1)
+            if key == 'error':
+                raise ConsumerError("Unexpected error")
+        return handle
+
+    subscriber = Subscriber(max_workers=2)
+    subscriber.register(handler('all'), 'test-shared-all', ['test.shared.#'], shared_queue=name)
+    subscriber.register(handler('retry'), 'test-shared-retry', ['test.shared.retry'], max_retries=1,
+                        shared_queue=name)
+    subscriber.register(handler('error'), 'test-shared-error', ['test.shared.error'], dead_letter=True,
+                        shared_queue=name)
+    publish_domain_event('test.shared.retry', {})
+    publish_domain_event('test.shared.error', {})
+    publish_domain_event('test.shared.other', {})
+    subscriber.start_consuming(timeout=0.5)
+    # Every matching handler is called once, retries only call the handler
+    # that raised Retry.
+    assert sorted(received) == [
+        ('all', 'test.shared.error', 0),
+        ('all', 'test.shared.other', 0),
+        ('all', 'test.shared.retry', 0),
+        ('error', 'test.shared.error', 0),
+        ('retry', 'test.shared.retry', 0),
+        ('retry', 'test.shared.retry', 1),
+    ]
+    assert get_queue_size(name) == 0
+    assert get_queue_size(name + '-dl') == 1
+    # Replayed events are only handled by the handler that failed
+    del received[:]
+    replay_queue(name)
+    subscriber = Subscriber()
+    subscriber.register(handler('all'), 'test-shared-all', ['test.shared.#'], shared_queue=name)
+    subscriber.register(handler('error'), 'test-shared-error', ['test.shared.error'], dead_letter=True,
+                        shared_queue=name)
+    subscriber.start_consuming(timeout=0.2)
+    assert received == [('error', 'test.shared.error', 0)]
+    header, event = get_message_from_queue(name + '-dl')
+    assert event.routing_key == 'test.shared.error'
+    assert header.headers[transport.HANDLER_HEADER] == 'test-shared-error'
+    for queue in (name, name + '-dl', name + '-delay-100'):
+        delete_queue(queue)
+
+
+def test_shared_queue_invalid_json():
+    # Messages that can't be decoded are dead-lettered like on queues of
+    # single handlers
+    name = 'test-shared-invalid'
+    for queue in (name, name + '-dl'):
+        delete_queue(queue)
+    subscriber = Subscriber()
+    subscriber.register(nop, 'test-shared-invalid-a', ['test.shared.invalid'], shared_queue=name)
+    subscriber.register(nop, 'test-shared-invalid-b', ['test.shared.#'], dead_letter=True, shared_queue=name)
+    publisher = Publisher(settings.BROKER)
+    publisher.publish('iamnotvalidjson[]', 'test.shared.invalid')
+    publisher.disconnect()
+    subscriber.start_consuming(timeout=0.2)
+    assert get_queue_size(name) == 0
+    assert get_queue_size(name + '-dl') == 1
+    for queue in (name, name + '-dl'):
+        delete_queue(queue)
+
+
+def test_shared_queue_options():
+    name = 'test-shared-options'
+    delete_queue(name)
+    subscriber = Subscriber()
+    subscriber.register(nop, 'test-shared-a', ['test.shared'], shared_queue=name)
+    with pytest.raises(ValueError):
+        subscriber.register(nop, 'test-shared-a', ['test.shared'], shared_queue=name)
+    with pytest.raises(ValueError):
+        subscriber.register(nop, 'test-shared-b', ['test.shared'], durable=False, shared_queue=name)
+    subscriber.disconnect()
+    delete_queue(name)
+
+
+def test_deduplicate():
+    name = 'test-deduplicate'
+    delete_queue(name)
+
+    def handle(event):
+        handle.received.append(event.uuid_string)
+        if event.data.get('retry') and event.retries < 1:
+            raise Retry(0.1)
+    handle.received = []
+
+    deduplicator = Deduplicator()
+    subscriber = Subscriber()
+    subscriber.register(handle, name, ['test.deduplicate'], max_retries=1, deduplicate=deduplicator)
+    event = publish_domain_event('test.deduplicate', {})
+    publish_domain_event('test.deduplicate', {}, uuid_string=event.uuid_string)
+    # Retries of an event are not duplicates
+    retried = publish_domain_event('test.deduplicate', {'retry': True})
+    subscriber.start_consuming(timeout=0.5)
+    assert handle.received == [event.uuid_string, retried.uuid_string, retried.uuid_string]
+    assert deduplicator.hits == 1
+    assert get_queue_size(name) == 0
+    delete_queue(name)
+    delete_queue(name + '-delay-100')
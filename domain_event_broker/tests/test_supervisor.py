@@ -0,0 +1,57 @@
+from unittest.mock import Mock, patch
+import threading
+
+from domain_event_broker.supervisor import Supervisor, import_setup
+
+
+def setup(subscriber):
+    pass
+
+
+def test_import_setup():
+    assert import_setup('domain_event_broker.tests.test_supervisor:setup') is setup
+    assert import_setup('domain_event_broker.tests.test_supervisor.setup') is setup
+
+
+def test_restart_exited_workers():
+    # Without a broker, workers exit right away and are restarted.
+    supervisor = Supervisor(setup, processes=2, restart_delay=0.1, connection_settings=None)
+    started = []
+    start_worker = supervisor._start_worker
+
+    def count_start():
+        started.append(1)
+        start_worker()
+
+    supervisor._start_worker = count_start
+    threading.Timer(1.5, setattr, (supervisor, 'stopping', True)).start()
+    supervisor._supervise()
+    supervisor.stop()
+    assert len(started) > 2
+    assert not supervisor.workers
+
+
+def test_clean_exit_is_no_crash():
+    supervisor = Supervisor(setup, connection_settings=None)
+    supervisor.workers = [
+        Mock(pid=1, exitcode=0, **{'is_alive.return_value': False}),
+        Mock(pid=2, exitcode=1, **{'is_alive.return_value': False}),
+        Mock(pid=3, exitcode=-9, **{'is_alive.return_value': False}),
+    ]
+    assert supervisor._reap() == 3
+    assert supervisor.crashes == 2
+    assert not supervisor.workers
+
+
+def test_autoscale():
+    supervisor = Supervisor(setup, processes=1, max_processes=4, queues=['test-autoscale'],
+                            messages_per_process=100, connection_settings=None)
+    with patch.object(supervisor, 'queue_depth', return_value=1000):
+        supervisor._scale()
+    assert supervisor.target == 4
+    with patch.object(supervisor, 'queue_depth', return_value=0):
+        supervisor._scale()
+        assert supervisor.target == 3
+        for _ in range(5):
+            supervisor._scale()
+    assert supervisor.target == 1
@@ -1,60 +1,35 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import copy
+import inspect
+import itertools
 import logging
-import json
+import os
+import random
+import threading
+import time
+import weakref
+import zlib
 from pika import (
     BasicProperties,
     BlockingConnection,
     URLParameters,
     )
 from pika import channel, frame, spec
+from pika.exceptions import AMQPChannelError, AMQPConnectionError, ChannelClosedByBroker
+from .deduplication import Deduplicator
 from .events import DomainEvent
-from . import settings
+from .publish import publish_domain_event  # noqa: F401
+from .routing import RoutingTrie
+from . import compression, metrics, serializers, settings
 
 log = logging.getLogger(__name__)
 
-
-def publish_domain_event(routing_key: str,
-                         data: Dict[str, Any],
-                         domain_object_id: Optional[str] = None,
-                         uuid_string: Optional[str] = None,
-                         timestamp: Optional[float] = None,
-                         connection_settings: Optional[str] = '',
-                         ) -> DomainEvent:
-    """
-    Send a domain event to the message broker. The broker will take care of
-    dispatching the event to registered subscribers.
-
-    :param str routing_key: The routing key is of the form
-        ``<DOMAIN>.<EVENT_TYPE>``.  The routing key should be a descriptive
-        name of the domain event such as ``user.registered``.
-    :param dict data: The actual event data. *Must* be json serializable.
-    :param str domain_object_id: Domain identifier of the event. This field
-        is optional. If used, it might make search in an event store easier.
-    :param str uuid_string: This UUID identifier of the event. If left
-        ``None``, a new one will be created.
-    :param float timestamp: Unix timestamp. If timestamp is None, a new
-        (UTC) timestamp will be created.
-    :param str connection_settings: Specify the broker with an AMQP URL. If not
-        given, the default broker will be used. If set to ``None``, the domain
-        event is not published to a broker.
-    :return: The domain event that was published.
-    :rtype: :py:class:`domain_event_broker.DomainEvent`
-    """
-    event = DomainEvent(
-        routing_key=routing_key,
-        data=data,
-        domain_object_id=domain_object_id,
-        uuid_string=uuid_string,
-        timestamp=timestamp)
-    json_data = json.dumps(event.event_data)
-    if connection_settings == '':
-        connection_settings = settings.BROKER
-    publisher = Publisher(connection_settings)
-    publisher.publish(json_data, event.routing_key)
-    publisher.disconnect()
-    return event
+# Seconds to wait for the broker to confirm published messages. Publisher
+# connections blocked by the broker for longer are closed.
+CONFIRM_TIMEOUT = 30.0
 
 
 class Retry(Exception):
@@ -73,44 +48,128 @@ class Retry(Exception):
         self.delay = delay
 
 
+class BatchError(Exception):
+    """
+    Raise this exception in a batch handler if only some events of the batch
+    failed. All other events of the batch count as handled successfully.
+
+    :param dict errors: Maps the index of each failed event in the batch to
+        the exception for that event. ``Retry`` schedules a delayed retry of
+        the event, any other exception dead-letters or discards it.
+    """
+    def __init__(self, errors: Dict[int, BaseException]):
+        super(BatchError, self).__init__("{} events of the batch failed".format(len(errors)))
+        self.errors = errors
+
+
+def _delay_queue(name: str, retry_exchange: str, delay: float) -> Tuple[str, Dict[str, Any]]:
+    # Name and arguments of the wait queue for retries of handler ``name``
+    # with the given delay in seconds.
+    delay_ms = int(delay * 1000)
+    delay_name = '{}-delay-{}'.format(name, delay_ms)
+    arguments = {
+        'x-dead-letter-exchange': retry_exchange,
+        'x-message-ttl': delay_ms,
+        'x-expires': delay_ms + 10000,
+        }
+    return delay_name, arguments
+
+
+# Delay queues declared per channel, mapped to the time until which the
+# declaration can be trusted. Channels are only used from their IO thread.
+_delay_queues: 'weakref.WeakKeyDictionary[Any, Dict[str, float]]' = weakref.WeakKeyDictionary()
+
+# Seconds a cached delay queue declaration is considered stale before the
+# queue would actually expire.
+DELAY_QUEUE_EXPIRY_MARGIN = 1.0
+
+
+def _is_delay_queue_declared(channel: Any, delay_name: str) -> bool:
+    declared = _delay_queues.get(channel, {})
+    return declared.get(delay_name, 0.0) > time.monotonic()
+
+
+def _remember_delay_queue(channel: Any, delay_name: str, arguments: Dict[str, Any]) -> None:
+    # Publishing does not reset 'x-expires', only declaring does. A message
+    # published at the end of the cached period must still expire from the
+    # queue before the queue itself expires.
+    valid_for = (arguments['x-expires'] - arguments['x-message-ttl']) / 1000.0
+    deadline = time.monotonic() + valid_for - DELAY_QUEUE_EXPIRY_MARGIN
+    _delay_queues.setdefault(channel, {})[delay_name] = deadline
+
+
 def _retry_message(name: str,
                    retry_exchange: str,
                    channel: channel.Channel,
                    method: frame.Method,
                    properties: spec.BasicProperties,
-                   body: str,
+                   body: bytes,
                    delay: float,
                    ) -> None:
-    delay = int(delay * 1000)
+    sink = metrics.sink
+    if sink is not None:
+        start = time.perf_counter()
     # Create queue that should be automatically deleted shortly after
-    # the last message expires. The queue is re-declared for each retry
-    # which resets the queue expiry.
-    delay_name = '{}-delay-{}'.format(name, delay)
-    result = channel.queue_declare(
-        queue=delay_name,
-        durable=True,
-        arguments={
-            'x-dead-letter-exchange': retry_exchange,
-            'x-message-ttl': delay,
-            'x-expires': delay + 10000,
-            },
-        )
-    queue_name = result.method.queue
-    # Bind the wait queue to the delay exchange before publishing
-    channel.exchange_declare(
-        exchange=delay_name,
-        durable=True,
-        auto_delete=True,  # Delete exchange when queue is deleted
-        exchange_type='topic')
-    channel.queue_bind(
-        exchange=delay_name,
-        routing_key='#',
-        queue=queue_name)
+    # the last message expires. Declaring the queue resets the queue expiry,
+    # so it is re-declared once the cached declaration gets too old.
+    delay_name, arguments = _delay_queue(name, retry_exchange, delay)
+    if not _is_delay_queue_declared(channel, delay_name):
+        result = channel.queue_declare(
+            queue=delay_name,
+            durable=True,
+            arguments=arguments,
+            )
+        queue_name = result.method.queue
+        # Bind the wait queue to the delay exchange before publishing
+        channel.exchange_declare(
+            exchange=delay_name,
+            durable=True,
+            auto_delete=True,  # Delete exchange when queue is deleted
+            exchange_type='topic')
+        channel.queue_bind(
+            exchange=delay_name,
+            routing_key='#',
+            queue=queue_name)
+        _remember_delay_queue(channel, delay_name, arguments)
     channel.basic_publish(
         exchange=delay_name,
         routing_key=method.routing_key,
         body=body,
         properties=properties)
+    if sink is not None:
+        sink.observe(metrics.RETRY_SECONDS, {'handler': name}, time.perf_counter() - start)
+
+
+def _record_received(sink: metrics.MetricsSink, name: str, event: DomainEvent, decode_seconds: float) -> None:
+    labels = {'handler': name, 'routing_key': event.routing_key}
+    sink.increment(metrics.RECEIVED, labels)
+    sink.observe(metrics.DECODE_SECONDS, {'handler': name}, decode_seconds)
+    # Clocks of publisher and subscriber may be slightly off
+    sink.observe(metrics.LAG_SECONDS, labels, max(0.0, time.time() - event.timestamp))
+    sink.adjust(metrics.IN_FLIGHT, {'handler': name}, 1)
+
+
+def _record_handled(sink: metrics.MetricsSink,
+                    name: str,
+                    event: DomainEvent,
+                    outcome: str,
+                    seconds: Optional[float] = None,
+                    ) -> None:
+    labels = {'handler': name, 'routing_key': event.routing_key}
+    if seconds is not None:
+        sink.observe(metrics.HANDLER_SECONDS, labels, seconds)
+    sink.increment(metrics.HANDLED, dict(labels, outcome=outcome))
+    sink.adjust(metrics.IN_FLIGHT, {'handler': name}, -1)
+
+
+def _add_callback(connection: BlockingConnection, callback: Callable) -> None:
+    # Schedule ``callback`` in the IO thread from a worker thread. If the
+    # connection was lost meanwhile, the callback is dropped: the subscriber
+    # resubscribed on a new connection and the broker delivers the event again.
+    try:
+        connection.add_callback_threadsafe(callback)
+    except AMQPConnectionError:
+        log.debug("Dropping callback for closed connection {}".format(connection))
 
 
 def _call_event_handler(handler: Callable,
@@ -120,14 +179,27 @@ def _call_event_handler(handler: Callable,
                         retry: Callable,
                         reject: Callable,
                         max_retries: int,
+                        name: str = '',
+                        deduplicator: Optional[Deduplicator] = None,
                         ) -> None:
     # The handler is executed in a separate worker thread. Handle any errors
     # and trigger retries, dead-lettering or acknowledgement via threadsafe
     # callback on the connection.
+    sink = metrics.sink
+    if deduplicator is not None and deduplicator.is_duplicate(name, event):
+        log.info("Skipping duplicate event {}".format(event))
+        _add_callback(connection, acknowledge)
+        if sink is not None:
+            _record_handled(sink, name, event, metrics.DUPLICATE)
+        return
+    if sink is not None:
+        start = time.perf_counter()
+    outcome = metrics.ACK
     try:
         handler(event)
     except Retry as error:
         if event.retries < max_retries:
+            outcome = metrics.RETRY
             # Publish manually to the delay exchange with a per-message TTL
             msg = "Retry ({retries}) consuming event {event} in {delay:.1f}s"
             log.info(msg.format(
@@ -135,23 +207,63 @@ def _call_event_handler(handler: Callable,
                 retries=event.retries,
                 delay=error.delay))
             delayed_retry = partial(retry, delay=error.delay)
-            connection.add_callback_threadsafe(acknowledge)
-            connection.add_callback_threadsafe(delayed_retry)
+            # Publish the retry before the acknowledgement settles the event
+            _add_callback(connection, delayed_retry)
+            _add_callback(connection, acknowledge)
         else:
             # Reject puts the message into the dead-letter queue if there is
             # one, otherwise the message is discarded.
             msg = "Exceeded max retries ({}) for {} event".format(
                 max_retries, event.routing_key)
             log.error(msg, exc_info=True, extra=event.event_data)
-            connection.add_callback_threadsafe(reject)
+            outcome = metrics.REJECT
+            _add_callback(connection, reject)
     except:  # noqa: E722
         # Note: If we want immediate requeueing, add a `RequeueError`
         # that a consumer can raise to trigger requeuing. Dead-letter
         # queues are a better choice in most cases.
-        connection.add_callback_threadsafe(reject)
+        outcome = metrics.REJECT
+        _add_callback(connection, reject)
         log.exception("Event has been dead-lettered or discarded")
     else:
-        connection.add_callback_threadsafe(acknowledge)
+        if deduplicator is not None:
+            deduplicator.remember(name, event)
+        _add_callback(connection, acknowledge)
+    if sink is not None:
+        _record_handled(sink, name, event, outcome, time.perf_counter() - start)
+
+
+def _message(body: Union[bytes, str],
+             content_type: Optional[str] = None,
+             ) -> Tuple[Union[bytes, str], spec.BasicProperties]:
+    # Body and properties of a persistent message, compressed if it is large.
+    body, content_encoding = compression.compress(body)
+    properties = BasicProperties(
+        delivery_mode=2,
+        content_type=content_type,
+        content_encoding=content_encoding)
+    return body, properties
+
+
+def _record_published(sink: metrics.MetricsSink, routing_key: Optional[str], seconds: float) -> None:
+    labels = {'routing_key': routing_key or ''}
+    sink.observe(metrics.PUBLISH_SECONDS, labels, seconds)
+    sink.increment(metrics.PUBLISHED, labels)
+
+
+def _load_event(properties: spec.BasicProperties, body: bytes) -> DomainEvent:
+    body = compression.decompress(body, properties.content_encoding)
+    event = DomainEvent(**serializers.loads(body, properties.content_type))
+    if properties.headers and 'x-death' in properties.headers:
+        # Older RabbitMQ versions (< 3.5) keep adding x-death entries, new
+        # versions only keep the most recent entry and increment 'count',
+        # see: https://github.com/rabbitmq/rabbitmq-server/issues/78
+        expiry_info = properties.headers['x-death'][0]
+        if 'count' in expiry_info:
+            event.retries = expiry_info['count']
+        else:
+            event.retries = len(properties.headers['x-death'])
+    return event
 
 
 def receive_callback(transport: 'Subscriber',
@@ -162,35 +274,34 @@ def receive_callback(transport: 'Subscriber',
                      channel: channel.Channel,
                      method: frame.Method,
                      properties: spec.BasicProperties,
-                     body: str,
+                     body: bytes,
+                     workers: Optional[Executor] = None,
+                     deduplicator: Optional[Deduplicator] = None,
                      ) -> None:
+    sink = metrics.sink
+    if sink is not None:
+        start = time.perf_counter()
     try:
-        event = DomainEvent.from_json(body)
+        event = _load_event(properties, body)
     except Exception:
         # We cannot parse the message; requeuing would not help.
         channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
         log.exception("Failed to load message: %s", body)
+        if sink is not None:
+            sink.increment(metrics.DECODE_ERRORS, {'handler': name})
     else:
-        if properties.headers and 'x-death' in properties.headers:
-            # Older RabbitMQ versions (< 3.5) keep adding x-death entries, new
-            # versions only keep the most recent entry and increment 'count',
-            # see: https://github.com/rabbitmq/rabbitmq-server/issues/78
-            expiry_info = properties.headers['x-death'][0]
-            if 'count' in expiry_info:
-                event.retries = expiry_info['count']
-            else:
-                event.retries = len(properties.headers['x-death'])
         log.debug("Received {}:{}".format(method.routing_key, event))
+        if sink is not None:
+            _record_received(sink, name, event, time.perf_counter() - start)
 
         # The channel and connection objects are not threadsafe. Only call any
         # of those function from the main thread via a threadsafe callback.
         acknowledge = partial(
-            channel.basic_ack,
-            delivery_tag=method.delivery_tag)
+            transport._settle,
+            partial(channel.basic_ack, delivery_tag=method.delivery_tag))
         reject = partial(
-            channel.basic_reject,
-            delivery_tag=method.delivery_tag,
-            requeue=False)
+            transport._settle,
+            partial(channel.basic_reject, delivery_tag=method.delivery_tag, requeue=False))
         retry = partial(
             _retry_message,
             name=name,
@@ -207,8 +318,398 @@ def receive_callback(transport: 'Subscriber',
             acknowledge=acknowledge,
             retry=retry,
             reject=reject,
-            max_retries=max_retries)
-        transport.workers.submit(event_handler)
+            max_retries=max_retries,
+            name=name,
+            deduplicator=deduplicator)
+        if workers is None:
+            workers = transport.workers
+        transport.unsettled += 1
+        if isinstance(workers, OrderedExecutor):
+            workers.submit_event(event, event_handler)
+        else:
+            workers.submit(event_handler)
+
+
+# Header of retried and dead-lettered events of a shared queue, naming the
+# handler they are meant for.
+HANDLER_HEADER = 'x-domain-event-handler'
+
+
+class _SharedHandler(object):
+    # A handler registered on a shared queue
+
+    def __init__(self,
+                 handler: Callable,
+                 name: str,
+                 max_retries: int,
+                 dead_letter: bool,
+                 workers: Optional[Executor],
+                 prefetch_count: int,
+                 deduplicator: Optional[Deduplicator] = None,
+                 ):
+        self.handler = handler
+        self.name = name
+        self.max_retries = max_retries
+        self.dead_letter = dead_letter
+        self.workers = workers
+        self.prefetch_count = prefetch_count
+        self.deduplicator = deduplicator
+
+
+class _SharedQueue(object):
+    """
+    A queue consumed for several handlers. The queue is bound to the union of
+    their binding keys and each delivery is dispatched to the handlers whose
+    binding keys match its routing key. The delivery is acknowledged once all
+    of them are done. Retries and dead-lettered events are tagged with the
+    handler they are meant for, so that they are not handled twice by the
+    other handlers.
+    """
+
+    def __init__(self, name: str, durable: bool, exclusive: bool, auto_delete: bool):
+        self.name = name
+        self.retry_exchange = name + '-retry'
+        self.dead_letter_exchange = name + '-dlx'
+        self.options = (durable, exclusive, auto_delete)
+        self.binding_keys: List[str] = []
+        self.handlers: Dict[str, _SharedHandler] = {}
+        self.routes = RoutingTrie()
+
+    @property
+    def dead_letter(self) -> bool:
+        return any(entry.dead_letter for entry in self.handlers.values())
+
+    @property
+    def prefetch_count(self) -> int:
+        return max(entry.prefetch_count for entry in self.handlers.values())
+
+    def add(self, entry: _SharedHandler, binding_keys: Union[List[str], Tuple[str]]) -> None:
+        if entry.name in self.handlers:
+            raise ValueError("Handler {} is already registered on queue {}".format(entry.name, self.name))
+        self.handlers[entry.name] = entry
+        for binding_key in binding_keys:
+            self.routes.add(binding_key, entry)
+            if binding_key not in self.binding_keys:
+                self.binding_keys.append(binding_key)
+
+    def route(self, method: frame.Method, properties: spec.BasicProperties) -> List[_SharedHandler]:
+        target = (properties.headers or {}).get(HANDLER_HEADER)
+        if target is None:
+            return self.routes.match(method.routing_key)
+        if isinstance(target, bytes):
+            target = target.decode('utf-8')
+        entry = self.handlers.get(target)
+        return [] if entry is None else [entry]
+
+
+def _tagged_properties(properties: spec.BasicProperties, name: str) -> spec.BasicProperties:
+    tagged = copy.copy(properties)
+    tagged.headers = dict(properties.headers or {}, **{HANDLER_HEADER: name})
+    return tagged
+
+
+def _reject_shared(shared: _SharedQueue,
+                   entry: _SharedHandler,
+                   channel: channel.Channel,
+                   method: frame.Method,
+                   properties: spec.BasicProperties,
+                   body: bytes,
+                   done: Callable[[], None],
+                   ) -> None:
+    # The delivery may still be handled by other handlers, so the failed
+    # event is published to the dead-letter exchange instead of rejecting it.
+    if entry.dead_letter:
+        channel.basic_publish(
+            exchange=shared.dead_letter_exchange,
+            routing_key=method.routing_key,
+            body=body,
+            properties=properties)
+    done()
+
+
+def shared_receive_callback(transport: 'Subscriber',
+                            shared: _SharedQueue,
+                            channel: channel.Channel,
+                            method: frame.Method,
+                            properties: spec.BasicProperties,
+                            body: bytes,
+                            ) -> None:
+    sink = metrics.sink
+    if sink is not None:
+        start = time.perf_counter()
+    try:
+        event = _load_event(properties, body)
+    except Exception:
+        if shared.dead_letter:
+            # The queue doesn't dead-letter rejected messages, see
+            # ``Subscriber._declare_shared``.
+            channel.basic_publish(
+                exchange=shared.dead_letter_exchange,
+                routing_key=method.routing_key,
+                body=body,
+                properties=properties)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+        else:
+            channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+        log.exception("Failed to load message: %s", body)
+        if sink is not None:
+            sink.increment(metrics.DECODE_ERRORS, {'handler': shared.name})
+        return
+    handlers = shared.route(method, properties)
+    if not handlers:
+        log.warning("No handler on queue {} for {}:{}".format(shared.name, method.routing_key, event))
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        return
+    log.debug("Received {}:{} for {} handlers".format(method.routing_key, event, len(handlers)))
+    if sink is not None:
+        decode_seconds = time.perf_counter() - start
+
+    # Called in the IO thread when a handler is done with the event
+    remaining = [len(handlers)]
+
+    def done() -> None:
+        remaining[0] -= 1
+        if not remaining[0]:
+            transport._settle(partial(channel.basic_ack, delivery_tag=method.delivery_tag))
+
+    transport.unsettled += 1
+    for entry in handlers:
+        if sink is not None:
+            _record_received(sink, entry.name, event, decode_seconds)
+        tagged = _tagged_properties(properties, entry.name)
+        retry = partial(
+            _retry_message,
+            name=shared.name,
+            retry_exchange=shared.retry_exchange,
+            channel=channel,
+            method=method,
+            properties=tagged,
+            body=body)
+        reject = partial(_reject_shared, shared, entry, channel, method, tagged, body, done)
+        event_handler = partial(
+            _call_event_handler,
+            handler=entry.handler,
+            event=event,
+            connection=channel.connection,
+            acknowledge=done,
+            retry=retry,
+            reject=reject,
+            max_retries=entry.max_retries,
+            name=entry.name,
+            deduplicator=entry.deduplicator)
+        workers = entry.workers or transport.workers
+        if isinstance(workers, OrderedExecutor):
+            workers.submit_event(event, event_handler)
+        else:
+            workers.submit(event_handler)
+
+
+# Outcomes of events handled in a batch
+ACK = 'ack'
+REJECT = 'reject'
+
+
+def _batch_outcomes(events: List[DomainEvent],
+                    errors: Dict[int, BaseException],
+                    max_retries: int,
+                    ) -> List[Tuple[str, Optional[float]]]:
+    # Map per-event errors to an action and retry delay, like
+    # ``_call_event_handler`` does for single events.
+    outcomes: List[Tuple[str, Optional[float]]] = []
+    for index, event in enumerate(events):
+        error = errors.get(index)
+        if error is None:
+            outcomes.append((ACK, None))
+        elif isinstance(error, Retry) and event.retries < max_retries:
+            log.info("Retry ({}) consuming event {} in {:.1f}s".format(
+                event.retries, event, error.delay))
+            outcomes.append((ACK, error.delay))
+        else:
+            if isinstance(error, Retry):
+                log.error("Exceeded max retries ({}) for {} event".format(
+                    max_retries, event.routing_key), extra=event.event_data)
+            else:
+                log.error("Event has been dead-lettered or discarded: {}".format(error),
+                          exc_info=error, extra=event.event_data)
+            outcomes.append((REJECT, None))
+    return outcomes
+
+
+class _BatchCollector(object):
+    """
+    Collect deliveries for a batch handler until ``max_batch_size`` events
+    arrived or ``max_wait`` seconds passed since the first one, then hand
+    the batch to the worker thread.
+
+    Batches of a handler are processed one at a time and messages are
+    acknowledged with a single ``multiple`` ack. The handler has a channel
+    of its own so that the ack never covers messages of other handlers.
+    """
+
+    def __init__(self,
+                 handler: Callable[[List[DomainEvent]], Any],
+                 name: str,
+                 retry_exchange: str,
+                 max_retries: int,
+                 max_batch_size: int,
+                 max_wait: float,
+                 ):
+        self.handler = handler
+        self.name = name
+        self.retry_exchange = retry_exchange
+        self.max_retries = max_retries
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.workers = ThreadPoolExecutor(max_workers=1)
+        self.channel: Any = None
+        self.connection: Any = None
+        self.deliveries: List[Tuple[frame.Method, spec.BasicProperties, bytes, DomainEvent]] = []
+        self.timer: Any = None
+        # Received events that are not yet acknowledged or rejected
+        self.unsettled = 0
+
+    def attach(self, channel: Any) -> None:
+        """
+        Consume on ``channel`` from now on. Deliveries received on a previous
+        channel can't be acknowledged anymore; the broker delivers them again.
+        """
+        self.channel = channel
+        self.connection = channel.connection
+        self.deliveries = []
+        self.timer = None
+        self.unsettled = 0
+
+    def receive(self,
+                channel: channel.Channel,
+                method: frame.Method,
+                properties: spec.BasicProperties,
+                body: bytes,
+                ) -> None:
+        sink = metrics.sink
+        if sink is not None:
+            start = time.perf_counter()
+        try:
+            event = _load_event(properties, body)
+        except Exception:
+            # We cannot parse the message; requeuing would not help.
+            channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+            log.exception("Failed to load message: %s", body)
+            if sink is not None:
+                sink.increment(metrics.DECODE_ERRORS, {'handler': self.name})
+            return
+        if sink is not None:
+            _record_received(sink, self.name, event, time.perf_counter() - start)
+        self.deliveries.append((method, properties, body, event))
+        self.unsettled += 1
+        if len(self.deliveries) >= self.max_batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.connection.call_later(self.max_wait, self._on_timeout)
+
+    def _on_timeout(self) -> None:
+        self.timer = None
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        Hand the events collected so far to the worker thread.
+        """
+        if self.timer is not None:
+            self.connection.remove_timeout(self.timer)
+            self.timer = None
+        if not self.deliveries:
+            return
+        deliveries, self.deliveries = self.deliveries, []
+        self.workers.submit(self._handle, self.channel, deliveries)
+
+    def _handle(self,
+                channel: Any,
+                deliveries: List[Tuple[frame.Method, spec.BasicProperties, bytes, DomainEvent]],
+                ) -> None:
+        # Runs in the worker thread. Deliveries are settled on the channel
+        # they were received on.
+        events = [event for _, _, _, event in deliveries]
+        try:
+            errors = self.handler(events) or {}
+        except BatchError as error:
+            errors = error.errors
+        except Exception as error:
+            log.exception("Batch of {} events failed".format(len(events)))
+            errors = {index: error for index in range(len(events))}
+        outcomes = _batch_outcomes(events, errors, self.max_retries)
+        sink = metrics.sink
+        if sink is not None:
+            # The handler time of a batch can't be attributed to single events
+            for event, (action, delay) in zip(events, outcomes):
+                outcome = metrics.REJECT if action == REJECT else metrics.ACK if delay is None else metrics.RETRY
+                _record_handled(sink, self.name, event, outcome)
+        _add_callback(channel.connection, partial(self._settle, channel, deliveries, outcomes))
+
+    def _settle(self,
+                channel: Any,
+                deliveries: List[Tuple[frame.Method, spec.BasicProperties, bytes, DomainEvent]],
+                outcomes: List[Tuple[str, Optional[float]]],
+                ) -> None:
+        # Runs in the IO thread. Failed events are settled one by one, then a
+        # single ack covers all other events of the batch.
+        if channel is not self.channel:
+            return
+        self.unsettled -= len(deliveries)
+        last_ack = None
+        for (method, properties, body, _), (action, delay) in zip(deliveries, outcomes):
+            if action == REJECT:
+                channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+                continue
+            if delay is not None:
+                _retry_message(self.name, self.retry_exchange, channel,
+                               method, properties, body, delay)
+            last_ack = method.delivery_tag
+        if last_ack is not None:
+            channel.basic_ack(delivery_tag=last_ack, multiple=True)
+
+
+def domain_object_key(event: DomainEvent) -> Optional[str]:
+    return event.domain_object_id
+
+
+class OrderedExecutor(Executor):
+    """
+    Execute event handlers on a fixed number of single-threaded lanes. Events
+    are assigned to a lane by hashing their ordering key, so events with the
+    same key are handled strictly one after another in the order they were
+    received, while events with different keys are handled in parallel.
+    Events without a key (``None``) are distributed round-robin.
+
+    :param int lanes: Number of worker threads.
+    :param function key: Returns the ordering key of a ``DomainEvent``. By
+        default, events are ordered per ``domain_object_id``.
+    """
+
+    def __init__(self,
+                 lanes: int,
+                 key: Callable[[DomainEvent], Any] = domain_object_key,
+                 ):
+        self.lanes = [ThreadPoolExecutor(max_workers=1) for _ in range(lanes)]
+        self.key = key
+        self.round_robin = itertools.count()
+
+    def lane(self, key: Any) -> ThreadPoolExecutor:
+        if key is None:
+            index = next(self.round_robin)
+        else:
+            # Python's string hash differs between processes; crc32 doesn't.
+            index = zlib.crc32(str(key).encode('utf-8'))
+        return self.lanes[index % len(self.lanes)]
+
+    def submit_event(self, event: DomainEvent, fn: Callable[[], Any]) -> Future:
+        return self.lane(self.key(event)).submit(fn)
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future:
+        return self.lane(None).submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, **kwargs: Any) -> None:
+        for lane in self.lanes:
+            lane.shutdown(wait=wait, **kwargs)
 
 
 def requires_broker(method: Callable) -> Callable:
@@ -217,18 +718,44 @@ def requires_broker(method: Callable) -> Callable:
     perform the action and log the call instead. This is used for environments
     where no broker is available, e.g. development and testing.
     """
-    def wrapper(transport: 'Transport', *args: Any, **kwargs: Any) -> Any:
+    def deactivated(transport: Any) -> bool:
         if transport.connection_settings is None:
             log.debug("No broker configured: {}.{}() is deactivated.".format(
                 transport.__class__.__name__,
                 method.__name__))
-        else:
+            return True
+        return False
+
+    if inspect.iscoroutinefunction(method):
+        async def async_wrapper(transport: Any, *args: Any, **kwargs: Any) -> Any:
+            if not deactivated(transport):
+                return await method(transport, *args, **kwargs)
+        return async_wrapper
+
+    def wrapper(transport: 'Transport', *args: Any, **kwargs: Any) -> Any:
+        if not deactivated(transport):
             return method(transport, *args, **kwargs)
     return wrapper
 
 
+def _connect(connection_settings: str, blocked_connection_timeout: Optional[float] = None) -> Any:
+    # ``memory://`` URLs connect to the in-process broker of
+    # :py:mod:`domain_event_broker.memory` instead of RabbitMQ.
+    if connection_settings.startswith('memory://'):
+        from . import memory
+        return memory.connect(connection_settings)
+    parameters = URLParameters(connection_settings)
+    if parameters.blocked_connection_timeout is None:
+        parameters.blocked_connection_timeout = blocked_connection_timeout
+    return BlockingConnection(parameters)
+
+
 class Transport(object):
 
+    #: Default seconds the broker may block the connection, e.g. because of a
+    #: resource alarm, before it is dropped. ``None`` waits forever.
+    blocked_connection_timeout: Optional[float] = None
+
     def __init__(self,
                  connection_settings: Optional[str] = '',
                  exchange: str = "domain-events",
@@ -251,8 +778,8 @@ class Transport(object):
         message is added to the queue. We might switch to asynch connections
         should this incur noticable latencies.
         """
-        params = URLParameters(self.connection_settings)
-        connection = BlockingConnection(params)
+        assert self.connection_settings is not None
+        connection = _connect(self.connection_settings, self.blocked_connection_timeout)
         channel = connection.channel()
 
         # set up the Exchange (if it does not exist)
@@ -280,23 +807,443 @@ class Transport(object):
         self.channel = None
         self.connection = None
 
+    @property
+    def is_connected(self) -> bool:
+        """
+        Whether both the connection and the channel are still open. A broken
+        TCP connection is only noticed by pika after the next IO operation.
+        """
+        return (self.connection is not None and self.connection.is_open and
+                self.channel is not None and self.channel.is_open)
+
+    @requires_broker
+    def reconnect(self) -> None:
+        """
+        Drop the current connection (if any) and connect again.
+        """
+        try:
+            self.disconnect()
+        except (AMQPConnectionError, AMQPChannelError):
+            # The connection is already gone, there is nothing left to close.
+            self.channel = None
+            self.connection = None
+        self.connect()
+
+
+class _ConfirmChannel(object):
+    """
+    A dedicated channel in transaction mode for publishing batches.
+
+    Messages are sent without waiting. ``wait`` commits the transaction, so
+    the broker confirms all messages published since the last ``wait`` with
+    a single round trip. If the commit fails, none of the messages count as
+    published. Waiting for the commit is bounded by the heartbeat and the
+    ``blocked_connection_timeout`` of the publisher's connection.
+    """
+
+    def __init__(self, connection: BlockingConnection):
+        self.connection = connection
+        self.channel = connection.channel()
+        self.channel.tx_select()
+        # Confirmation callbacks of the messages in the open transaction
+        self.unconfirmed: List[Callable[[bool], None]] = []
+
+    @property
+    def is_open(self) -> bool:
+        return bool(self.channel.is_open)
+
+    def _settle(self, success: bool) -> None:
+        unconfirmed, self.unconfirmed = self.unconfirmed, []
+        for on_confirm in unconfirmed:
+            on_confirm(success)
+
+    def publish(self,
+                exchange: str,
+                routing_key: Optional[str],
+                body: Union[bytes, str],
+                properties: spec.BasicProperties,
+                on_confirm: Callable[[bool], None],
+                ) -> None:
+        try:
+            self.channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                body=body,
+                properties=properties)
+        except CONNECTION_ERRORS:
+            on_confirm(False)
+            self._settle(False)
+            raise
+        self.unconfirmed.append(on_confirm)
+
+    def wait(self, pending: Callable[[], bool], timeout: Optional[float] = CONFIRM_TIMEOUT) -> None:
+        # Commit the messages published so far. Messages are rolled back
+        # without waiting if the time for the batch already ran out.
+        if not self.unconfirmed or not pending():
+            return
+        try:
+            if timeout is not None and timeout <= 0:
+                log.warning("Batch timed out: {} messages are rolled back".format(len(self.unconfirmed)))
+                self.channel.tx_rollback()
+                self._settle(False)
+            else:
+                self.channel.tx_commit()
+                self._settle(True)
+        except CONNECTION_ERRORS:
+            self._settle(False)
+            raise
+
+
+class PublishBatch(object):
+    """
+    A batch of messages published on a dedicated channel of the publisher.
+    Messages are sent without waiting, and the broker confirms all of them at
+    once when the batch is flushed. Use :py:meth:`Publisher.publish_batch` to
+    create a batch.
+
+    After the batch has been flushed, ``results`` contains ``True`` for every
+    message the broker confirmed and ``False`` for messages it did not accept
+    or that were not published because the batch exceeded its timeout.
+    """
+
+    def __init__(self, publisher: 'Publisher', timeout: Optional[float] = CONFIRM_TIMEOUT):
+        self.publisher = publisher
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.results: List[bool] = []
+        self.pending = 0
+
+    def _confirmed(self, index: int, success: bool) -> None:
+        self.results[index] = success
+        self.pending -= 1
+
+    def publish(self,
+                message: Union[bytes, str],
+                routing_key: Optional[str] = None,
+                content_type: Optional[str] = None,
+                ) -> int:
+        """
+        Send a persistent message as part of the batch.
+
+        :return: Index of the message in ``results``.
+        :rtype: int
+        """
+        index = len(self.results)
+        if self.publisher.connection_settings is None:
+            log.debug("No broker configured: message to {} is not published.".format(routing_key))
+            self.results.append(True)
+            return index
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            log.warning("Batch timed out: message to {} is not published.".format(routing_key))
+            self.results.append(False)
+            return index
+        sink = metrics.sink
+        if sink is not None:
+            start = time.perf_counter()
+        confirm_channel = self.publisher.get_confirm_channel()
+        body, properties = _message(message, content_type)
+        self.results.append(False)
+        self.pending += 1
+        confirm_channel.publish(
+            exchange=self.publisher.exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=properties,
+            on_confirm=partial(self._confirmed, index))
+        if sink is not None:
+            _record_published(sink, routing_key, time.perf_counter() - start)
+        return index
+
+    def flush(self) -> List[bool]:
+        """
+        Wait until the broker confirmed all messages published so far.
+        """
+        if self.pending:
+            confirm_channel = self.publisher.get_confirm_channel()
+            timeout = None if self.deadline is None else self.deadline - time.monotonic()
+            confirm_channel.wait(lambda: self.pending > 0, timeout=timeout)
+            if self.pending:
+                log.warning("{} published messages were not confirmed".format(self.pending))
+        return self.results
+
 
 class Publisher(Transport):
 
+    # Don't wait forever for confirmations while the broker blocks publishers
+    blocked_connection_timeout: Optional[float] = CONFIRM_TIMEOUT
+    confirm_channel: Optional[_ConfirmChannel] = None
+
     @requires_broker
-    def publish(self, message: bytes, routing_key: Optional[str] = None) -> None:
+    def publish(self,
+                message: Union[bytes, str],
+                routing_key: Optional[str] = None,
+                content_type: Optional[str] = None,
+                ) -> None:
         """
         Send as persistent message.
+
+        :param str content_type: MIME type of the message body, see
+            :py:mod:`domain_event_broker.serializers`.
+
+        Large messages are compressed according to ``settings.COMPRESSION``,
+        see :py:mod:`domain_event_broker.compression`.
         """
         if self.channel is None:
             raise Exception('Not connected to broker.')
 
+        sink = metrics.sink
+        if sink is not None:
+            start = time.perf_counter()
+        body, properties = _message(message, content_type)
         self.channel.basic_publish(
             exchange=self.exchange,
             routing_key=routing_key,
-            body=message,
-            properties=BasicProperties(delivery_mode=2),
+            body=body,
+            properties=properties,
             )
+        if sink is not None:
+            _record_published(sink, routing_key, time.perf_counter() - start)
+
+    def get_confirm_channel(self) -> _ConfirmChannel:
+        """
+        Return the channel in transaction mode used for batches. It is
+        opened on first use and kept for the lifetime of the connection.
+        """
+        if self.connection is None:
+            raise Exception('Not connected to broker.')
+        confirm_channel = self.confirm_channel
+        if (confirm_channel is None or not confirm_channel.is_open or
+                confirm_channel.connection is not self.connection):
+            confirm_channel = _ConfirmChannel(self.connection)
+            self.confirm_channel = confirm_channel
+        return confirm_channel
+
+    @contextmanager
+    def publish_batch(self, timeout: Optional[float] = CONFIRM_TIMEOUT) -> Iterator[PublishBatch]:
+        """
+        Publish several messages without waiting for each of them. Leaving
+        the context commits the batch, so the broker confirms all messages
+        with one round trip::
+
+            with publisher.publish_batch() as batch:
+                for message, routing_key in messages:
+                    batch.publish(message, routing_key)
+            failed = [index for index, ok in enumerate(batch.results) if not ok]
+
+        :param float timeout: Maximum number of seconds for publishing the
+            batch. Messages not published in time count as failed. ``None``
+            doesn't limit the batch.
+        """
+        batch = PublishBatch(self, timeout=timeout)
+        yield batch
+        batch.flush()
+
+    def publish_many(self,
+                     events: Iterable[DomainEvent],
+                     timeout: Optional[float] = CONFIRM_TIMEOUT,
+                     ) -> List[bool]:
+        """
+        Publish domain events in one batch, confirmed by the broker at once.
+
+        :param events: The ``DomainEvent`` objects to publish.
+        :param float timeout: Maximum number of seconds for publishing the
+            events, see ``publish_batch``.
+        :return: One entry per event, ``True`` if the broker confirmed the
+            event and ``False`` otherwise.
+        :rtype: list
+        """
+        with self.publish_batch(timeout=timeout) as batch:
+            for event in events:
+                body, content_type = serializers.dumps(event.event_data)
+                batch.publish(body, event.routing_key, content_type=content_type)
+        return batch.results
+
+
+# Errors that indicate that a pooled connection is no longer usable.
+CONNECTION_ERRORS = (AMQPConnectionError, AMQPChannelError)
+
+# Seconds before the first attempt to reconnect a subscriber
+RECONNECT_DELAY = 1.0
+
+# Reply codes of channel errors that reconnecting doesn't resolve:
+# ACCESS_REFUSED, NOT_FOUND and PRECONDITION_FAILED, e.g. for a queue that
+# exists with different arguments.
+PERMANENT_REPLY_CODES = (403, 404, 406)
+
+
+class PublisherPool(object):
+    """
+    Thread-safe pool of long-lived publisher connections to one broker.
+
+    Pika connections must not be shared between threads, so each thread checks
+    out a publisher exclusively and returns it after use. Connections are only
+    opened on demand, and the exchange is declared once per connection rather
+    than once per message. A connection that was lost while idle is replaced
+    lazily the next time it is checked out.
+
+    The pool is fork-aware: a child process never reuses the sockets inherited
+    from its parent but opens its own connections.
+
+    :param str connection_settings: Specify the broker with an AMQP URL.
+    :param int max_idle: Number of idle connections kept open. Additional
+        connections opened under contention are closed after use.
+    """
+
+    def __init__(self,
+                 connection_settings: Optional[str],
+                 exchange: str = "domain-events",
+                 exchange_type: str = "topic",
+                 max_idle: int = 4,
+                 ):
+        self.connection_settings = connection_settings
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle: List['Publisher'] = []
+        self.pid = os.getpid()
+        _pool_instances.add(self)
+
+    def _checkout(self) -> 'Publisher':
+        with self.lock:
+            if self.pid != os.getpid():
+                # Connections inherited from the parent process must not be
+                # used (or closed) in the child.
+                self.idle = []
+                self.pid = os.getpid()
+            publisher = self.idle.pop() if self.idle else None
+        if publisher is None:
+            return Publisher(
+                self.connection_settings,
+                exchange=self.exchange,
+                exchange_type=self.exchange_type)
+        if publisher.connection is not None:
+            try:
+                # Process pending heartbeats and notice a lost connection
+                # without waiting for a round trip.
+                publisher.connection.process_data_events(time_limit=0)
+            except CONNECTION_ERRORS:
+                log.info("Pooled broker connection was lost, reconnecting")
+            if not publisher.is_connected:
+                publisher.reconnect()
+        return publisher
+
+    def _checkin(self, publisher: 'Publisher') -> None:
+        with self.lock:
+            if self.pid == os.getpid() and len(self.idle) < self.max_idle:
+                self.idle.append(publisher)
+                return
+        self._discard(publisher)
+
+    def _discard(self, publisher: 'Publisher') -> None:
+        try:
+            publisher.disconnect()
+        except CONNECTION_ERRORS:
+            pass
+
+    @contextmanager
+    def acquire(self) -> Iterator['Publisher']:
+        """
+        Check out a connected publisher for exclusive use by the calling thread::
+
+            with pool.acquire() as publisher:
+                publisher.publish(message, routing_key)
+        """
+        publisher = self._checkout()
+        try:
+            yield publisher
+        except BaseException:
+            if publisher.connection is None or publisher.is_connected:
+                self._checkin(publisher)
+            else:
+                self._discard(publisher)
+            raise
+        else:
+            self._checkin(publisher)
+
+    def publish(self,
+                message: Union[bytes, str],
+                routing_key: Optional[str] = None,
+                content_type: Optional[str] = None,
+                ) -> None:
+        """
+        Publish a message on a pooled connection. If the connection turns out
+        to be broken, the message is published once more on a new connection.
+        """
+        with self.acquire() as publisher:
+            try:
+                publisher.publish(message, routing_key, content_type=content_type)
+            except CONNECTION_ERRORS:
+                log.warning("Publishing failed, retrying on new connection", exc_info=True)
+                publisher.reconnect()
+                publisher.publish(message, routing_key, content_type=content_type)
+
+    def close(self) -> None:
+        """
+        Close all idle connections.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for publisher in idle:
+            self._discard(publisher)
+
+
+_pools: Dict[Tuple[Optional[str], str, str], PublisherPool] = {}
+_pools_lock = threading.Lock()
+# All pools of the process, including pools not created by
+# ``get_publisher_pool``, so that their locks can be replaced after a fork.
+_pool_instances: 'weakref.WeakSet[PublisherPool]' = weakref.WeakSet()
+
+
+def get_publisher_pool(connection_settings: Optional[str] = '',
+                       exchange: str = "domain-events",
+                       exchange_type: str = "topic",
+                       ) -> PublisherPool:
+    """
+    Return the process-wide publisher pool for the given broker. Pools are
+    created on first use and shared by all threads.
+
+    :param str connection_settings: Specify the broker with an AMQP URL. If not
+        given, the default broker will be used.
+    :rtype: :py:class:`domain_event_broker.PublisherPool`
+    """
+    if connection_settings == '':
+        connection_settings = settings.BROKER
+    key = (connection_settings, exchange, exchange_type)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = PublisherPool(connection_settings, exchange=exchange, exchange_type=exchange_type)
+            _pools[key] = pool
+    return pool
+
+
+def close_publisher_pools() -> None:
+    """
+    Close all pooled publisher connections of this process.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _reset_publisher_pools() -> None:
+    # Runs in a freshly forked child. The locks might have been held by other
+    # threads of the parent at fork time, so they are replaced rather than
+    # reused.
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    _pools.clear()
+    for pool in list(_pool_instances):
+        pool.lock = threading.Lock()
+        pool.idle = []
+        pool.pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_publisher_pools)
 
 
 class Subscriber(Transport):
@@ -307,14 +1254,85 @@ class Subscriber(Transport):
 
     .. note::
 
-        The subscriber only uses one thread for processing events. Even if
-        multiple handlers are registered, only one event is processed at a
-        time.
+        By default the subscriber only uses one thread for processing events.
+        Even if multiple handlers are registered, only one event is processed
+        at a time. Raise ``max_workers`` to process events in parallel; events
+        of one handler may then be handled out of order.
+
+    :param int max_workers: Number of threads shared by all handlers that
+        don't specify their own ``concurrency``.
+    :param int prefetch_count: Number of unacknowledged events the broker
+        delivers to each handler in advance. Defaults to ``max_workers`` so
+        that every worker thread has an event to process.
+    :param bool|function ordered: Preserve the order of events per domain
+        object while processing events in parallel. See ``register``.
+    :param bool reconnect: Reconnect if the connection to the broker is lost
+        while consuming, declare the queues of all registered handlers again
+        and resume consuming. Otherwise ``start_consuming`` raises.
+    :param float max_reconnect_delay: Reconnection attempts are delayed
+        exponentially, up to this number of seconds.
     """
 
-    def __init__(self, *args: Any, **kwargs: Any):
+    def __init__(self,
+                 *args: Any,
+                 max_workers: int = 1,
+                 prefetch_count: Optional[int] = None,
+                 ordered: Union[bool, Callable[[DomainEvent], Any]] = False,
+                 reconnect: bool = False,
+                 max_reconnect_delay: float = 30.0,
+                 **kwargs: Any):
         super().__init__(*args, **kwargs)
-        self.workers = ThreadPoolExecutor(max_workers=1)
+        self.auto_reconnect = reconnect
+        self.max_reconnect_delay = max_reconnect_delay
+        # Subscribe functions of all handlers, called again after reconnecting
+        self.registrations: List[Callable[[], None]] = []
+        #: Number of times the connection was re-established
+        self.reconnects = 0
+        #: Number of failed attempts to re-establish the connection
+        self.failed_reconnects = 0
+        self.max_workers = max_workers
+        self.prefetch_count = prefetch_count or max_workers
+        self.ordered = ordered
+        self.workers = self._create_workers(max_workers, ordered)
+        self.batch_collectors: List[_BatchCollector] = []
+        self.shared_queues: Dict[str, _SharedQueue] = {}
+        # Events handed to worker threads and not yet acknowledged or
+        # rejected. Only changed in the IO thread.
+        self.unsettled = 0
+        self.consuming = False
+        self.drain_deadline: Optional[float] = None
+        # Set by ``stop_consuming``, ends attempts to reconnect
+        self.stopping = threading.Event()
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Number of received events that are not yet acknowledged or rejected,
+        e.g. for readiness probes.
+        """
+        return self.unsettled + sum(collector.unsettled for collector in self.batch_collectors)
+
+    @property
+    def draining(self) -> bool:
+        """
+        Whether ``drain`` was called. A draining subscriber doesn't accept new
+        events anymore.
+        """
+        return self.drain_deadline is not None
+
+    def _settle(self, settle: Callable[[], Any]) -> None:
+        self.unsettled -= 1
+        settle()
+
+    def _create_workers(self,
+                        max_workers: int,
+                        ordered: Union[bool, Callable[[DomainEvent], Any]],
+                        ) -> Executor:
+        if ordered is True:
+            return OrderedExecutor(max_workers)
+        elif ordered:
+            return OrderedExecutor(max_workers, key=ordered)
+        return ThreadPoolExecutor(max_workers=max_workers)
 
     @requires_broker
     def bind_routing_keys(self,
@@ -341,6 +1359,10 @@ class Subscriber(Transport):
                  exclusive: bool = False,
                  auto_delete: bool = False,
                  max_retries: int = 0,
+                 concurrency: Optional[int] = None,
+                 ordered: Union[None, bool, Callable[[DomainEvent], Any]] = None,
+                 shared_queue: Optional[str] = None,
+                 deduplicate: Union[bool, Deduplicator] = False,
                  ) -> None:
         """
         Register a handler for one or more types of domain events.
@@ -359,10 +1381,196 @@ class Subscriber(Transport):
             to indicate the event processing should be retried later. This
             parameter controls how often an event is rescheduled before it is
             dead-lettered or discarded.
+        :param int concurrency: Process up to this many events of this handler
+            in parallel in dedicated worker threads. If not given, the handler
+            shares the subscriber's worker threads.
+        :param bool|function ordered: Handle events of the same domain object
+            strictly in order, even if events are processed in parallel.
+            Events are assigned to worker threads by ``domain_object_id``;
+            pass a function to derive a different key from a ``DomainEvent``.
+            Defaults to the ``ordered`` setting of the subscriber.
+        :param str shared_queue: Consume from this queue, shared with the
+            other handlers registered with the same ``shared_queue``, instead
+            of a queue of its own. The queue is bound to the binding keys of
+            all its handlers and events are dispatched to the matching
+            handlers by the subscriber. ``durable``, ``exclusive`` and
+            ``auto_delete`` must be the same for all of them. Retries and
+            dead-lettered events of the handler are tagged with its ``name``
+            and go through the retry exchange and dead-letter queue of the
+            shared queue.
+        :param bool|Deduplicator deduplicate: Skip events the handler already
+            handled, identified by their ``uuid_string``. Duplicates are
+            acknowledged without calling the handler. Pass a
+            ``domain_event_broker.deduplication.Deduplicator`` to configure
+            the cache or share handled events between processes; ``True``
+            uses an in-process cache.
         """
         if self.channel is None:
             raise Exception('Not connected to broker.')
 
+        retry_exchange = name + '-retry'
+        workers = None
+        prefetch_count = self.prefetch_count
+        if ordered is None:
+            ordered = self.ordered
+        if concurrency is not None or ordered is not self.ordered:
+            concurrency = concurrency or self.max_workers
+            workers = self._create_workers(concurrency, ordered)
+            prefetch_count = max(prefetch_count, concurrency)
+        deduplicator = Deduplicator() if deduplicate is True else deduplicate or None
+        if shared_queue is not None:
+            entry = _SharedHandler(
+                handler, name, max_retries, dead_letter, workers, prefetch_count, deduplicator)
+            self._register_shared(shared_queue, entry, binding_keys, durable, exclusive, auto_delete)
+            return
+        callback = partial(
+            receive_callback,
+            self,
+            handler,
+            name,
+            retry_exchange,
+            max_retries,
+            workers=workers,
+            deduplicator=deduplicator)
+        subscribe = partial(
+            self._subscribe, name, binding_keys, dead_letter, durable,
+            exclusive, auto_delete, prefetch_count, callback)
+        subscribe()
+        self.registrations.append(subscribe)
+
+    def _subscribe(self,
+                   name: str,
+                   binding_keys: Union[List[str], Tuple[str]],
+                   dead_letter: bool,
+                   durable: bool,
+                   exclusive: bool,
+                   auto_delete: bool,
+                   prefetch_count: int,
+                   callback: Callable,
+                   ) -> None:
+        assert self.channel is not None
+        self._declare_queues(name, binding_keys, dead_letter, durable, exclusive, auto_delete)
+        # The prefetch limit applies to each consumer created afterwards.
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+        self.channel.basic_consume(queue=name, on_message_callback=callback)
+
+    def _register_shared(self,
+                         queue: str,
+                         entry: _SharedHandler,
+                         binding_keys: Union[List[str], Tuple[str]],
+                         durable: bool,
+                         exclusive: bool,
+                         auto_delete: bool,
+                         ) -> None:
+        shared = self.shared_queues.get(queue)
+        if shared is None:
+            shared = _SharedQueue(queue, durable, exclusive, auto_delete)
+            shared.add(entry, binding_keys)
+            subscribe = partial(self._subscribe_shared, shared)
+            subscribe()
+            self.shared_queues[queue] = shared
+            self.registrations.append(subscribe)
+        else:
+            if shared.options != (durable, exclusive, auto_delete):
+                raise ValueError("Handlers of shared queue {} must use the same queue options".format(queue))
+            shared.add(entry, binding_keys)
+            # Bind the queue to the new binding keys
+            self._declare_shared(shared)
+
+    def _subscribe_shared(self, shared: _SharedQueue) -> None:
+        assert self.channel is not None
+        self._declare_shared(shared)
+        self.channel.basic_qos(prefetch_count=shared.prefetch_count)
+        self.channel.basic_consume(
+            queue=shared.name,
+            on_message_callback=partial(shared_receive_callback, self, shared))
+
+    def _declare_shared(self, shared: _SharedQueue) -> None:
+        assert self.channel is not None
+        durable, exclusive, auto_delete = shared.options
+        # Failed events are published to the dead-letter exchange by the
+        # subscriber, the queue itself doesn't dead-letter.
+        self._declare_queues(shared.name, shared.binding_keys, False, durable, exclusive, auto_delete)
+        if shared.dead_letter:
+            self.channel.exchange_declare(
+                exchange=shared.dead_letter_exchange,
+                exchange_type=self.exchange_type)
+            self.channel.queue_declare(queue=shared.name + '-dl', durable=True)
+            self.bind_routing_keys(shared.dead_letter_exchange, shared.name + '-dl', shared.binding_keys)
+
+    @requires_broker
+    def register_batch(self,
+                       handler: Callable[[List[DomainEvent]], Any],
+                       name: str,
+                       binding_keys: Union[List[str], Tuple[str]],
+                       max_batch_size: int = 100,
+                       max_wait: float = 1.0,
+                       dead_letter: bool = False,
+                       durable: bool = True,
+                       exclusive: bool = False,
+                       auto_delete: bool = False,
+                       max_retries: int = 0,
+                       ) -> None:
+        """
+        Register a handler that processes domain events in batches. Events
+        are collected until ``max_batch_size`` events arrived or ``max_wait``
+        seconds passed since the first one, and the handler is called with a
+        list of ``DomainEvent`` objects. Batches of one handler are processed
+        one after another; the next batch is prefetched meanwhile.
+
+        If the handler returns normally, all events of the batch are
+        acknowledged at once. To report failures of single events, return a
+        dict mapping the index of each failed event to an exception, or raise
+        ``domain_event_broker.BatchError``. ``Retry`` schedules a retry of the
+        event, other exceptions dead-letter or discard it. If the handler
+        raises any other exception, this applies to the whole batch.
+
+        :param int max_batch_size: Maximum number of events per batch.
+        :param float max_wait: Maximum number of seconds to wait for a batch
+            to fill up.
+
+        The other parameters are the same as for ``register``.
+        """
+        if self.connection is None or self.channel is None:
+            raise Exception('Not connected to broker.')
+
+        collector = _BatchCollector(
+            handler, name, name + '-retry', max_retries, max_batch_size, max_wait)
+        subscribe = partial(
+            self._subscribe_batch, collector, binding_keys, dead_letter,
+            durable, exclusive, auto_delete)
+        subscribe()
+        self.batch_collectors.append(collector)
+        self.registrations.append(subscribe)
+
+    def _subscribe_batch(self,
+                         collector: _BatchCollector,
+                         binding_keys: Union[List[str], Tuple[str]],
+                         dead_letter: bool,
+                         durable: bool,
+                         exclusive: bool,
+                         auto_delete: bool,
+                         ) -> None:
+        assert self.connection is not None
+        self._declare_queues(collector.name, binding_keys, dead_letter, durable, exclusive, auto_delete)
+        # The multiple ack of a batch must not cover deliveries of other
+        # handlers, so each batch handler consumes on a channel of its own.
+        channel = self.connection.channel()
+        collector.attach(channel)
+        channel.basic_qos(prefetch_count=2 * collector.max_batch_size)
+        channel.basic_consume(queue=collector.name, on_message_callback=collector.receive)
+
+    def _declare_queues(self,
+                        name: str,
+                        binding_keys: Union[List[str], Tuple[str]],
+                        dead_letter: bool,
+                        durable: bool,
+                        exclusive: bool,
+                        auto_delete: bool,
+                        ) -> str:
+        # Declare the queue of a handler and its retry and dead-letter
+        # exchanges. Returns the name of the retry exchange.
+        assert self.channel is not None
         retry_exchange = name + '-retry'
         dead_letter_exchange = name + '-dlx'
 
@@ -401,23 +1609,111 @@ class Subscriber(Transport):
             exchange_type=self.exchange_type)
         # Bind the consumer queue to the retry exchange
         self.bind_routing_keys(retry_exchange, name, binding_keys)
+        return retry_exchange
 
-        callback = partial(
-            receive_callback,
-            self,
-            handler,
-            name,
-            retry_exchange,
-            max_retries)
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(queue=name, on_message_callback=callback)
+    def _channels(self) -> List[Any]:
+        channels: List[Any] = [] if self.channel is None else [self.channel]
+        return channels + [collector.channel for collector in self.batch_collectors]
 
     @requires_broker
     def stop_consuming(self) -> None:
-        if self.channel is not None:
-            self.channel.stop_consuming()
+        """
+        Stop consuming and disconnect right away. Events that are still being
+        handled can't be acknowledged anymore and will be delivered again.
+        Use ``drain`` to wait for them.
+        """
+        for consumer_channel in self._channels():
+            if consumer_channel.is_open:
+                consumer_channel.stop_consuming()
+        self.stopping.set()
+        self.disconnect()
+
+    @requires_broker
+    def drain(self, timeout: float = 30.0) -> None:
+        """
+        Stop consuming gracefully: cancel the consumers, so that no new events
+        are delivered, wait up to ``timeout`` seconds for the events in flight
+        to be handled and acknowledged, and disconnect.
+
+        Like any other method, this must be called from the thread running
+        ``start_consuming``, e.g. in a callback scheduled with
+        ``connection.add_callback_threadsafe`` or ``connection.call_later``.
+        ``start_consuming`` returns once the subscriber has been drained.
+        """
+        if self.draining:
+            return
+        self.drain_deadline = time.monotonic() + timeout
+        for collector in self.batch_collectors:
+            collector.flush()
+        for consumer_channel in self._channels():
+            if consumer_channel.is_open:
+                # Messages delivered but not yet dispatched are requeued
+                for consumer_tag in list(consumer_channel.consumer_tags):
+                    consumer_channel.basic_cancel(consumer_tag)
+        if not self.consuming:
+            self._finish_drain()
+
+    def _finish_drain(self) -> None:
+        # Process acknowledgements of the worker threads until all events are
+        # settled. Must not be called from a connection callback.
+        assert self.drain_deadline is not None
+        while self.in_flight and self.connection is not None and self.connection.is_open:
+            remaining = self.drain_deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.connection.process_data_events(time_limit=remaining)
+        if self.in_flight:
+            log.warning("{} events still in flight after draining".format(self.in_flight))
         self.disconnect()
 
+    def _consume(self) -> None:
+        assert self.connection is not None and self.channel is not None
+        if self.batch_collectors:
+            # Batch handlers consume on channels of their own
+            while self.connection is not None and any(
+                    consumer_channel.consumer_tags for consumer_channel in self._channels()):
+                self.connection.process_data_events(time_limit=None)
+        else:
+            self.channel.start_consuming()
+
+    def _resubscribe(self, deadline: Optional[float] = None) -> bool:
+        # Reconnect with exponential backoff and subscribe all registered
+        # handlers again. Events in flight on the lost connection will be
+        # delivered again by the broker. Gives up when the subscriber is
+        # stopped or drained, or at ``deadline``; returns whether it succeeded.
+        # Channel errors that recur on every attempt are raised right away.
+        delay = RECONNECT_DELAY
+        while not (self.stopping.is_set() or self.draining):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            try:
+                self.reconnect()
+                self.unsettled = 0
+                for subscribe in self.registrations:
+                    subscribe()
+            except CONNECTION_ERRORS as error:
+                if isinstance(error, ChannelClosedByBroker) and error.reply_code in PERMANENT_REPLY_CODES:
+                    raise
+                self.failed_reconnects += 1
+                # Jitter keeps a fleet of subscribers from reconnecting at once
+                wait = random.uniform(delay / 2, delay)
+                if deadline is not None:
+                    wait = min(wait, max(0.0, deadline - time.monotonic()))
+                log.warning("Reconnecting to broker failed, retrying in {:.1f}s".format(wait), exc_info=True)
+                self.stopping.wait(wait)
+                delay = min(delay * 2, self.max_reconnect_delay)
+            else:
+                self.reconnects += 1
+                log.info("Reconnected to broker and resumed {} handlers".format(len(self.registrations)))
+                return True
+        log.info("Stopped reconnecting to broker")
+        try:
+            self.disconnect()
+        except CONNECTION_ERRORS:
+            self.channel = None
+            self.connection = None
+        return False
+
     @requires_broker
     def start_consuming(self, timeout: Optional[float] = None) -> None:
         """
@@ -426,12 +1722,33 @@ class Subscriber(Transport):
         """
         if self.connection is None or self.channel is None:
             raise Exception('Not connected to broker.')
+        deadline = None
         if timeout:
+            deadline = time.monotonic() + timeout
             self.connection.call_later(timeout, self.stop_consuming)
+        self.stopping.clear()
+        self.consuming = True
         try:
-            self.channel.start_consuming()
+            while True:
+                try:
+                    self._consume()
+                except CONNECTION_ERRORS:
+                    if not self.auto_reconnect or self.draining:
+                        raise
+                    log.warning("Lost connection to broker while consuming", exc_info=True)
+                    if not self._resubscribe(deadline):
+                        break
+                    if deadline is not None:
+                        assert self.connection is not None
+                        self.connection.call_later(max(0.0, deadline - time.monotonic()), self.stop_consuming)
+                else:
+                    break
+            if self.draining:
+                self._finish_drain()
         except KeyboardInterrupt:
             self.stop_consuming()
         except:  # noqa: E722
             self.stop_consuming()
             raise
+        finally:
+            self.consuming = False